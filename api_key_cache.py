@@ -0,0 +1,73 @@
+import logging
+import os
+
+from cachetools import TTLCache
+
+from database import API_KEY_NOTIFY_CHANNEL
+
+logger = logging.getLogger('jugalbandi_telegram')
+
+
+class ApiKeyCache:
+    """
+    In process cache of validated API keys and their remaining quota, so that authentication does not need a database
+    round trip on every request. Entries expire after `ttl` seconds, are dropped as soon as the quota runs out and can
+    optionally be invalidated by all the workers through postgres LISTEN/NOTIFY.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.listener_connection = None
+        self.engine = None
+
+    async def validate(self, api_key, db_object, pending_usage=0) -> bool:
+        if api_key in self.entries:
+            return True
+        remaining_quota = await db_object.get_remaining_api_quota(api_key=api_key)
+        if remaining_quota is None or remaining_quota - pending_usage <= 0:
+            return False
+        self.entries[api_key] = remaining_quota - pending_usage
+        return True
+
+    def get_remaining_quota(self, api_key):
+        return self.entries.get(api_key)
+
+    def set_remaining_quota(self, api_key, remaining_quota):
+        if remaining_quota is None or remaining_quota <= 0:
+            self.invalidate(api_key)
+        else:
+            self.entries[api_key] = remaining_quota
+
+    def consume(self, api_key, used=1):
+        remaining_quota = self.entries.get(api_key)
+        if remaining_quota is not None:
+            self.set_remaining_quota(api_key, remaining_quota - used)
+
+    def invalidate(self, api_key=None):
+        if api_key:
+            self.entries.pop(api_key, None)
+        else:
+            self.entries.clear()
+
+    async def listen(self, engine, channel=API_KEY_NOTIFY_CHANNEL):
+        """
+        Keeps one connection of the pool subscribed to the token change notifications. The payload of a notification
+        is the changed api key, an empty payload drops the whole cache.
+        """
+        self.engine = engine
+        self.listener_connection = await engine.acquire()
+        await self.listener_connection.add_listener(channel, self.on_notification)
+
+    def on_notification(self, connection, pid, channel, payload):
+        logger.debug(f'API key cache invalidated by notification on {channel}')
+        self.invalidate(payload or None)
+
+    async def close(self, channel=API_KEY_NOTIFY_CHANNEL):
+        if self.listener_connection is not None:
+            await self.listener_connection.remove_listener(channel, self.on_notification)
+            await self.engine.release(self.listener_connection)
+            self.listener_connection = None
+
+
+api_key_cache = ApiKeyCache(maxsize=int(os.getenv('API_KEY_CACHE_SIZE', 1024)),
+                            ttl=int(os.getenv('API_KEY_CACHE_TTL', 300)))
@@ -0,0 +1,54 @@
+import asyncio
+import os
+import wave
+from io import BytesIO
+
+# every transcoding is one ffmpeg process, at most this many of them run at the same time
+transcoding_semaphore = asyncio.Semaphore(int(os.getenv('AUDIO_TRANSCODING_CONCURRENCY', os.cpu_count() or 2)))
+
+
+class TranscodingError(Exception):
+    pass
+
+
+async def run_ffmpeg(audio_data: bytes, input_format, output_arguments) -> bytes:
+    """
+    Transcodes `audio_data` with ffmpeg reading from stdin and writing to stdout, so that nothing touches the disk and
+    the event loop only waits on the pipes.
+    """
+    async with transcoding_semaphore:
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', input_format, '-i', 'pipe:0', *output_arguments,
+            'pipe:1',
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        output, error = await process.communicate(input=audio_data)
+    if process.returncode != 0:
+        raise TranscodingError(error.decode('utf-8', 'ignore'))
+    return output
+
+
+async def ogg_to_wav(ogg_data: bytes, frame_rate=16000) -> bytes:
+    """Mono 16 bit wav, the format needed by the speech to text APIs"""
+    # ffmpeg can not seek back in a pipe to fill in the wav header sizes, so raw samples are read and the header is
+    # written here
+    pcm_data = await run_ffmpeg(ogg_data, 'ogg', ['-ar', str(frame_rate), '-ac', '1', '-f', 's16le'])
+    wav_file = BytesIO()
+    with wave.open(wav_file, 'wb') as wav_writer:
+        wav_writer.setnchannels(1)
+        wav_writer.setsampwidth(2)
+        wav_writer.setframerate(frame_rate)
+        wav_writer.writeframes(pcm_data)
+    return wav_file.getvalue()
+
+
+async def wav_to_mp3(wav_data: bytes) -> (bytes, float):
+    mp3_data = await run_ffmpeg(wav_data, 'wav', ['-f', 'mp3'])
+    return mp3_data, get_wav_duration_seconds(wav_data)
+
+
+def get_wav_duration_seconds(wav_data: bytes):
+    try:
+        with wave.open(BytesIO(wav_data)) as wav_file:
+            return wav_file.getnframes() / wav_file.getframerate()
+    except (wave.Error, EOFError, ZeroDivisionError):
+        return None
@@ -1,192 +1,319 @@
+import asyncio
 import datetime
-import os.path
+import logging
 import re
-from io import BytesIO
-
-import requests
+import uuid
+from dataclasses import dataclass, field
 
 import pytz
 
 from utils import mask_sensitive_info
 from bot_preference import scheme_v1
-from cloud_filestorage import upload_file_and_get_public_url
+from cloud_filestorage import media_uploader, get_public_url
+from conversation_summarizer import conversation_summarizer
+from log_sink import log_sink
 from io_processing import process_incoming_voice, process_outgoing_voice, process_outgoing_text, process_incoming_text
-from translator import translator
-
-
-async def chatbot_flow(db_object, chat_id, message, message_type, acknowledgements):
-    date = datetime.datetime.now(pytz.UTC)
-    user_regional_lang_text = None
-    response = 'We are facing some issues, we will fix it soon'
-    stt_success = False
-    davinci_success = False
-    bot_success = False
-    stt_api_name = None
-    english_to_vernacular_translation_success = False
-    english_to_vernacular_translation_api_name = None
-    vernacular_to_english_translation_success = False
-    vernacular_to_english_translation_api_name = None
-    tts_success = False
-    tts_service_name = None
-    user_audio_file_link = None
-    bot_audio_file_link = None
-    inbound_audio_file_name = 'temp.mp3'
-    outbound_audio_file_name = 'temp.mp3'
+from stage_graph import StageGraph
+from translator import get_translator, get_http_session, translator
+from tts_cache import tts_cache, TTS_MEDIA_FOLDER
+from user_context import user_context_loader, UserContext
+
+logger = logging.getLogger('jugalbandi_telegram')
+
+
+@dataclass
+class ChatTurn:
+    """Everything one turn of the chat produces, the stages of `chatbot_flow` fill it in"""
+    chat_id: int
+    message: str
+    message_type: str
+    date: datetime.datetime
+    # id of the conversation history row of the turn, its links are corrected by it after the row is logged
+    turn_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    user_context: UserContext = None
+    translate: translator = None
+    language_preference: str = None
+    bot_preference: str = None
+    user_regional_lang_text: str = None
+    response: str = 'We are facing some issues, we will fix it soon'
+    stt_success: bool = False
+    davinci_success: bool = False
+    bot_success: bool = False
+    stt_api_name: str = None
+    english_to_vernacular_translation_success: bool = False
+    english_to_vernacular_translation_api_name: str = None
+    vernacular_to_english_translation_success: bool = False
+    vernacular_to_english_translation_api_name: str = None
+    tts_success: bool = False
+    tts_service_name: str = None
+    tts_cache_key: str = None
+    user_audio_file_link: str = None
+    bot_audio_file_link: str = None
+    # link of the primary TTS provider, the conversation is logged with it before the response is synthesized
+    expected_bot_audio_file_link: str = None
+    audio_content_type: str = None
+    audio_data: bytes = None
+    current_conversation_chunk_id: str = None
+    current_scheme_conversation_summary: str = None
+    rolling_summary: str = None
+    current_scheme_name: str = None
+    davinci_response: str = None
+    new_conversation_chunk_id: str = None
+    current_prompt: str = None
+    next_prompt_name: str = None
+    next_prompt: str = None
+    llm_output: str = None
+    regional_lang_text: str = None
+    events: asyncio.Queue = None
+
+    def publish(self, event, data):
+        """Hands a partial result to the streaming endpoint, if the turn is streamed"""
+        if self.events is not None:
+            self.events.put_nowait((event, data))
+
+    @property
+    def input_success(self):
+        return (self.stt_success and self.vernacular_to_english_translation_success) or (
+                self.message_type == 'text' and self.vernacular_to_english_translation_success)
 
+    @property
+    def uses_scheme_v1(self):
+        return self.bot_preference == 'scheme_v1' or self.bot_preference is None
+
+
+def clear_user_audio_file_link_on_failure(turn: ChatTurn, db_object):
+    async def on_complete(audio_file_link, success):
+        if not success:
+            # a conversation logged from now on has no link, one logged before is corrected once it is written
+            turn.user_audio_file_link = None
+            log_sink.update_conversation(turn.turn_id, lambda: db_object.clear_user_audio_file_link(turn.turn_id))
+    return on_complete
+
+
+async def load_user_context(turn: ChatTurn, db_object):
+    # language, bot preference and latest prompt of the user, this also adds the default row for failure
+    turn.user_context = await user_context_loader.load(db_object, turn.chat_id)
     # create translator object based on user language preference
-    language_preference = await db_object.get_language_preference(chat_id=chat_id)
-    translate = translator(input_language=language_preference)
-
-    bot_preference = await db_object.get_bot_preference(chat_id=chat_id)
-
-    # add default row for failure
-    if not await db_object.check_failure_exist(chat_id=chat_id):
-        await db_object.insert_user_prompt(chat_id=chat_id, conversation_chunk_id='FAILURE' + str(chat_id),
-                                           scheme_name=None,
-                                           conversation_summary=None,
-                                           bot_preference=None,
-                                           prompt_type=None)
-
-    if message_type == 'text':
-        if not re.search(r'[\.\?\!]$', message):
-            message = message + '.'
-        message, user_regional_lang_text, vernacular_to_english_translation_success, vernacular_to_english_translation_api_name = process_incoming_text(
-            message, translate)
+    turn.language_preference = turn.user_context.language_preference
+    turn.translate = get_translator(input_language=turn.language_preference)
+    turn.bot_preference = turn.user_context.bot_preference
+
+
+async def download_audio(turn: ChatTurn):
+    async with get_http_session().get(turn.message) as audio_response:
+        turn.audio_content_type = audio_response.headers.get('Content-Type')
+        turn.audio_data = await audio_response.read()
+
+
+async def process_text_input(turn: ChatTurn):
+    if not re.search(r'[\.\?\!]$', turn.message):
+        turn.message = turn.message + '.'
+    turn.message, turn.user_regional_lang_text, turn.vernacular_to_english_translation_success, \
+        turn.vernacular_to_english_translation_api_name = await process_incoming_text(turn.message, turn.translate)
+
+
+async def process_voice_input(turn: ChatTurn, db_object):
+    if 'audio/ogg' not in (turn.audio_content_type or ''):
+        turn.response = 'We only support audio or text input, please provide your query in one of these'
+        return
+    inbound_audio_file_name = str(turn.chat_id) + '-Inbound-' + str(datetime.datetime.now()).replace(' ', '-') + '.ogg'
+    # nothing reads the inbound audio right away, its link is logged before the upload has finished
+    turn.user_audio_file_link = media_uploader.upload_in_background(
+        turn.audio_data, phone_number=turn.chat_id, remote_filename=inbound_audio_file_name,
+        on_complete=clear_user_audio_file_link_on_failure(turn, db_object))
+    turn.message, turn.user_regional_lang_text, turn.stt_success, turn.stt_api_name, \
+        turn.vernacular_to_english_translation_success, turn.vernacular_to_english_translation_api_name = \
+        await process_incoming_voice(turn.audio_data, turn.language_preference, translate=turn.translate)
+
+
+async def generate_response(turn: ChatTurn, db_object):
+    turn.message = mask_sensitive_info(turn.message)
+    if turn.uses_scheme_v1:
+        turn.current_conversation_chunk_id, turn.current_scheme_conversation_summary, turn.current_scheme_name, \
+            turn.davinci_response, turn.new_conversation_chunk_id, turn.current_prompt, turn.next_prompt_name, \
+            turn.next_prompt, turn.llm_output, turn.rolling_summary = await scheme_v1(
+            db_object, turn.message, turn.chat_id, prompts=turn.user_context.prompts_v1())
     else:
-        # audio processing pending
-        audio_link = message
-        audio_response = requests.get(audio_link)
-        if 'audio/ogg' in audio_response.headers.get('Content-Type'):
-            audio_data = audio_response.content
-            inbound_audio_file_name = str(chat_id) + '-Inbound-' + str(datetime.datetime.now()).replace(' ',
-                                                                                                        '-') + '.ogg'
-            with open(inbound_audio_file_name, 'wb') as f:
-                f.write(audio_data)
-            audio_file = BytesIO(audio_data)
-            message, user_regional_lang_text, stt_success, stt_api_name, vernacular_to_english_translation_success, vernacular_to_english_translation_api_name = process_incoming_voice(
-                audio_file,
-                language_preference,
-                translate=translate)
-            user_audio_file_link = await upload_file_and_get_public_url(filename=inbound_audio_file_name,
-                                                                        phone_number=chat_id,
-                                                                        remote_filename=inbound_audio_file_name)
-        else:
-            response = 'We only support audio or text input, please provide your query in one of these'
-
-    if (stt_success and vernacular_to_english_translation_success) or (
-            message_type == 'text' and vernacular_to_english_translation_success):
-        # Acknowledge the request
-        if message_type != 'text':
-            temp_response = acknowledgements[language_preference] + user_regional_lang_text
-        message = mask_sensitive_info(message)
-        if bot_preference == 'scheme_v1' or bot_preference is None:
-            current_conversation_chunk_id, current_scheme_conversation_summary, current_scheme_name, davinci_response, new_conversation_chunk_id, current_prompt, next_prompt_name, next_prompt, llm_output = await scheme_v1(
-                db_object, message, chat_id)
-        else:
-            current_conversation_chunk_id, current_scheme_conversation_summary, current_scheme_name, davinci_response, new_conversation_chunk_id, current_prompt, next_prompt_name, next_prompt, llm_output = '', '', '', '', '', '', '', '', ''
+        turn.current_conversation_chunk_id, turn.current_scheme_conversation_summary, turn.current_scheme_name, \
+            turn.davinci_response, turn.new_conversation_chunk_id, turn.current_prompt, turn.next_prompt_name, \
+            turn.next_prompt, turn.llm_output, turn.rolling_summary = '', '', '', '', '', '', '', '', '', ''
 
-        if davinci_response == 'Because Server is overloaded, I am unable to answer you at the moment. Please retry.':
-            davinci_success = False
-        else:
-            davinci_success = True
-        if davinci_response == 'Sorry, I could not understand that information. Please answer in different wording.':
-            bot_success = False
-        else:
-            bot_success = True
-
-        davinci_response = davinci_response.split("Bot:")[-1].lstrip().strip()
-        davinci_response = davinci_response.replace('"', '').replace("'", '')
-        # if message_type != 'text':
-        _, regional_lang_text, english_to_vernacular_translation_success, english_to_vernacular_translation_api_name = process_outgoing_text(
-            message=davinci_response,
-            translate=translate)
-        response = regional_lang_text
-        # else:
-        #     regional_lang_text = davinci_response
-        #
-        #     response = regional_lang_text
-
-        # update the db user prompts with prompts history and chat memory
-        current_scheme_conversation_summary = current_scheme_conversation_summary.replace("'", "")
-
-        await db_object.update_user_prompt(conversation_summary=current_scheme_conversation_summary,
-                                           chunk_id=new_conversation_chunk_id)
-
-        if message_type != 'text':
-            # perform TTS
-            audio, duration_seconds, tts_service_name = process_outgoing_voice(message=regional_lang_text,
-                                                                               translate=translate)
-
-            if audio:
-                tts_success = True
-                # send the audio response to user
-                outbound_audio_file_name = str(chat_id) + '-Outbound-' \
-                                           + str(datetime.datetime.now()).replace(' ', '-') + '.mp3'
-                with open(outbound_audio_file_name, 'wb') as f:
-                    f.write(audio.getvalue())
-                bot_audio_file_link = await upload_file_and_get_public_url(filename=outbound_audio_file_name,
-                                                                           phone_number=chat_id,
-                                                                           remote_filename=outbound_audio_file_name)
-            else:
-                tts_success = False
-
-        # Log the conversation event
-        await db_object.insert_conversation(chat_id=chat_id, user_audio_file_link=user_audio_file_link,
-                                            bot_audio_file_link=bot_audio_file_link,
-                                            conversation_chunk_id=new_conversation_chunk_id,
-                                            bot_preference=bot_preference,
-                                            scheme_name=current_scheme_name, user_message=message,
-                                            bot_response=davinci_response,
-                                            user_message_translated=user_regional_lang_text,
-                                            bot_response_translated=regional_lang_text,
-                                            date=date, language_preference=language_preference,
-                                            current_prompt=current_prompt,
-                                            next_prompt_name=next_prompt_name, next_prompt=next_prompt,
-                                            llm_output=llm_output)
-        # insert service log
-        await db_object.insert_service_logs(chat_id=chat_id, conversation_chunk_id=new_conversation_chunk_id,
-                                            created_at=date, message_type=message_type,
-                                            bot_preference=bot_preference,
-                                            davinci_success=davinci_success, bot_success=bot_success,
-                                            vernacular_to_english_translation_api_success=vernacular_to_english_translation_success,
-                                            vernacular_to_english_translation_api_name=vernacular_to_english_translation_api_name,
-                                            english_to_vernacular_translation_api_success=english_to_vernacular_translation_success,
-                                            english_to_vernacular_translation_api_name=english_to_vernacular_translation_api_name,
-                                            stt_api_success=stt_success, stt_api_name=stt_api_name,
-                                            tts_api_success=tts_success,
-                                            tts_api_name=tts_service_name)
+    if turn.davinci_response == 'Because Server is overloaded, I am unable to answer you at the moment. Please retry.':
+        turn.davinci_success = False
+    else:
+        turn.davinci_success = True
+    if turn.davinci_response == 'Sorry, I could not understand that information. Please answer in different wording.':
+        turn.bot_success = False
+    else:
+        turn.bot_success = True
+
+    turn.davinci_response = turn.davinci_response.split("Bot:")[-1].lstrip().strip()
+    turn.davinci_response = turn.davinci_response.replace('"', '').replace("'", '')
+
+
+async def translate_response(turn: ChatTurn):
+    _, turn.regional_lang_text, turn.english_to_vernacular_translation_success, \
+        turn.english_to_vernacular_translation_api_name = await process_outgoing_text(message=turn.davinci_response,
+                                                                                      translate=turn.translate)
+    turn.response = turn.regional_lang_text
+    turn.publish('text', turn.response)
+    if turn.message_type != 'text':
+        # the synthesized response is stored under this key, so its link is known before TTS has finished
+        turn.tts_cache_key = tts_cache.make_key(language=turn.translate.input_language, gender='female',
+                                                provider=turn.translate.tts_provider, text=turn.regional_lang_text)
+        turn.bot_audio_file_link = get_public_url(TTS_MEDIA_FOLDER, tts_cache.get_remote_filename(turn.tts_cache_key))
+        turn.expected_bot_audio_file_link = turn.bot_audio_file_link
+
+
+async def update_user_context(turn: ChatTurn):
+    # the turn was stored together with the response, only the cached prompts and chat memory are updated
+    if turn.uses_scheme_v1:
+        user_context_loader.update(turn.chat_id, conversation_chunk_id=turn.new_conversation_chunk_id,
+                                   scheme_name=turn.current_scheme_name,
+                                   conversation_summary=turn.current_scheme_conversation_summary,
+                                   rolling_summary=turn.rolling_summary,
+                                   prompt_type=turn.next_prompt_name)
+
+
+async def synthesize_response(turn: ChatTurn):
+    # same response in same language was already synthesized and uploaded
+    cached_speech = await tts_cache.get(turn.tts_cache_key)
+    if cached_speech:
+        turn.tts_success = True
+        turn.tts_service_name = cached_speech.tts_service_name
+        turn.bot_audio_file_link = cached_speech.audio_url
+        return
+
+    # perform TTS
+    audio, duration_seconds, turn.tts_service_name = await process_outgoing_voice(message=turn.regional_lang_text,
+                                                                                  translate=turn.translate)
+    if not audio:
+        turn.tts_success = False
+        return
+    if turn.tts_service_name != turn.translate.tts_provider:
+        # audio of the fallback provider is stored under its own key, never under the key of the primary provider
+        turn.tts_cache_key = tts_cache.make_key(language=turn.translate.input_language, gender='female',
+                                                provider=turn.tts_service_name, text=turn.regional_lang_text)
+    try:
+        # the client fetches the response audio as soon as it gets the link, so this upload is awaited
+        turn.bot_audio_file_link = await media_uploader.upload(
+            audio, phone_number=TTS_MEDIA_FOLDER, remote_filename=tts_cache.get_remote_filename(turn.tts_cache_key))
+    except Exception:
+        logger.exception('Failed to upload the synthesized response')
+        turn.tts_success = False
+        return
+    turn.tts_success = True
+    await tts_cache.set(turn.tts_cache_key, audio_url=turn.bot_audio_file_link,
+                        tts_service_name=turn.tts_service_name, audio=audio)
+
+
+async def update_logged_bot_audio_file_link(turn: ChatTurn, db_object):
+    if turn.bot_audio_file_link and not turn.tts_success:
+        turn.bot_audio_file_link = None
+    turn.publish('audio_url', turn.bot_audio_file_link)
+    if turn.bot_audio_file_link != turn.expected_bot_audio_file_link:
+        # no audio, or audio of another provider than the one of the logged link, the row of the turn is corrected
+        # once the log sink has written it
+        bot_audio_file_link = turn.bot_audio_file_link
+        log_sink.update_conversation(turn.turn_id,
+                                     lambda: db_object.update_bot_audio_file_link(turn.turn_id, bot_audio_file_link))
+
+
+async def log_conversation(turn: ChatTurn, db_object):
+    # Log the conversation event
+    await log_sink.insert_conversation(db_object, chat_id=turn.chat_id, user_audio_file_link=turn.user_audio_file_link,
+                                       bot_audio_file_link=turn.bot_audio_file_link,
+                                       conversation_chunk_id=turn.new_conversation_chunk_id,
+                                       bot_preference=turn.bot_preference,
+                                       scheme_name=turn.current_scheme_name, user_message=turn.message,
+                                       bot_response=turn.davinci_response,
+                                       user_message_translated=turn.user_regional_lang_text,
+                                       bot_response_translated=turn.regional_lang_text,
+                                       date=turn.date, language_preference=turn.language_preference,
+                                       current_prompt=turn.current_prompt,
+                                       next_prompt_name=turn.next_prompt_name, next_prompt=turn.next_prompt,
+                                       llm_output=turn.llm_output, turn_id=turn.turn_id)
+
+
+async def log_service_usage(turn: ChatTurn, db_object):
+    # insert service log
+    await log_sink.insert_service_logs(db_object, chat_id=turn.chat_id,
+                                       conversation_chunk_id=turn.new_conversation_chunk_id,
+                                       created_at=turn.date, message_type=turn.message_type,
+                                       bot_preference=turn.bot_preference,
+                                       davinci_success=turn.davinci_success, bot_success=turn.bot_success,
+                                       vernacular_to_english_translation_api_success=turn.vernacular_to_english_translation_success,
+                                       vernacular_to_english_translation_api_name=turn.vernacular_to_english_translation_api_name,
+                                       english_to_vernacular_translation_api_success=turn.english_to_vernacular_translation_success,
+                                       english_to_vernacular_translation_api_name=turn.english_to_vernacular_translation_api_name,
+                                       stt_api_success=turn.stt_success, stt_api_name=turn.stt_api_name,
+                                       tts_api_success=turn.tts_success,
+                                       tts_api_name=turn.tts_service_name)
+
+
+def add_input_stages(stages: StageGraph, turn: ChatTurn, db_object):
+    stages.add('user_context', lambda: load_user_context(turn, db_object))
+    if turn.message_type == 'text':
+        stages.add('user_input', lambda: process_text_input(turn), 'user_context')
+    else:
+        # the audio is downloaded while the user context is loaded
+        stages.add('audio_download', lambda: download_audio(turn))
+        stages.add('user_input', lambda: process_voice_input(turn, db_object), 'user_context', 'audio_download')
+
+
+def add_response_stages(stages: StageGraph, turn: ChatTurn, db_object):
+    stages.add('llm', lambda: generate_response(turn, db_object))
+    stages.add('outgoing_translation', lambda: translate_response(turn), 'llm')
+    stages.add('user_context_update', lambda: update_user_context(turn), 'llm')
+    # the conversation is logged while the response is synthesized, the service log needs the TTS result
+    stages.add('conversation_log', lambda: log_conversation(turn, db_object), 'outgoing_translation')
+    if turn.message_type != 'text':
+        stages.add('tts', lambda: synthesize_response(turn), 'outgoing_translation')
+        stages.add('bot_audio_link_cleanup', lambda: update_logged_bot_audio_file_link(turn, db_object),
+                   'tts', 'conversation_log')
+        stages.add('service_log', lambda: log_service_usage(turn, db_object), 'tts')
     else:
-        # send the text response to user
-        new_conversation_chunk_id = 'FAILURE' + str(chat_id)
-        current_scheme_name = None
-        bot_preference = None
-        current_prompt = None
-        await db_object.insert_conversation(chat_id=chat_id, user_audio_file_link=user_audio_file_link,
-                                            bot_audio_file_link=bot_audio_file_link,
-                                            conversation_chunk_id=new_conversation_chunk_id,
-                                            bot_preference=bot_preference,
-                                            scheme_name=current_scheme_name, user_message=message,
-                                            bot_response=response,
-                                            user_message_translated=user_regional_lang_text,
-                                            bot_response_translated=response,
-                                            date=date, language_preference=language_preference,
-                                            current_prompt=current_prompt,
-                                            next_prompt_name=None, next_prompt=None, llm_output=None)
-        # insert service log
-        await db_object.insert_service_logs(chat_id=chat_id, conversation_chunk_id=new_conversation_chunk_id,
-                                            created_at=date, message_type=message_type, bot_preference=bot_preference,
-                                            davinci_success=davinci_success, bot_success=bot_success,
-                                            vernacular_to_english_translation_api_success=vernacular_to_english_translation_success,
-                                            vernacular_to_english_translation_api_name=vernacular_to_english_translation_api_name,
-                                            english_to_vernacular_translation_api_success=english_to_vernacular_translation_success,
-                                            english_to_vernacular_translation_api_name=english_to_vernacular_translation_api_name,
-                                            stt_api_success=stt_success, stt_api_name=stt_api_name,
-                                            tts_api_success=tts_success,
-                                            tts_api_name=tts_service_name)
-
-    # clean up
-    if os.path.isfile(inbound_audio_file_name):
-        os.remove(inbound_audio_file_name)
-    if os.path.isfile(outbound_audio_file_name):
-        os.remove(outbound_audio_file_name)
-    return response, bot_audio_file_link
+        stages.add('service_log', lambda: log_service_usage(turn, db_object), 'outgoing_translation')
+
+
+def add_failure_stages(stages: StageGraph, turn: ChatTurn, db_object):
+    # send the text response to user
+    turn.new_conversation_chunk_id = 'FAILURE' + str(turn.chat_id)
+    turn.current_scheme_name = None
+    turn.bot_preference = None
+    turn.current_prompt = None
+    turn.davinci_response = turn.response
+    turn.regional_lang_text = turn.response
+    turn.publish('text', turn.response)
+    stages.add('conversation_log', lambda: log_conversation(turn, db_object))
+    stages.add('service_log', lambda: log_service_usage(turn, db_object))
+
+
+async def chatbot_flow(db_object, chat_id, message, message_type, acknowledgements, events: asyncio.Queue = None):
+    """
+    Answers one chat message. The steps are stages of a dependency graph, every stage starts as soon as the stages it
+    needs have finished, so that for voice notes the latency is the critical path download, STT, LLM, translation
+    and TTS. When `events` is given, the acknowledgement of a voice note, the text response and the audio url are put
+    on it as (event, data) tuples as soon as each of them is ready.
+    """
+    turn = ChatTurn(chat_id=chat_id, message=message, message_type=message_type, date=datetime.datetime.now(pytz.UTC),
+                    events=events)
+    stages = StageGraph()
+    try:
+        add_input_stages(stages, turn, db_object)
+        await stages.wait()
+        if turn.input_success:
+            # Acknowledge the request
+            if message_type != 'text':
+                turn.publish('acknowledgement', acknowledgements[turn.language_preference] + turn.user_regional_lang_text)
+            add_response_stages(stages, turn, db_object)
+        else:
+            add_failure_stages(stages, turn, db_object)
+        await stages.wait()
+        if turn.input_success and turn.uses_scheme_v1:
+            # long conversations are compressed once the turn is answered
+            conversation_summarizer.schedule(db_object, chat_id, turn.new_conversation_chunk_id,
+                                             turn.current_scheme_conversation_summary)
+    finally:
+        logger.info(f'chatbot_flow stages for {chat_id}: {stages.format_timings()}')
+    return turn.response, turn.bot_audio_file_link
@@ -1,26 +1,95 @@
+import asyncio
+import logging
 import os
 
 from google.cloud import storage
 from google.oauth2 import service_account
 
+logger = logging.getLogger('jugalbandi_telegram')
+
 credentials = service_account.Credentials.from_service_account_file(os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'))
 client = storage.Client(credentials=credentials)
 
+content_types = {'.gif': 'image/gif',
+                 '.jpg': 'image/jpg',
+                 '.jpeg': 'image/jpeg',
+                 '.png': 'image/png',
+                 '.PNG': 'image/png',
+                 '.pdf': 'application/pdf',
+                 '.ogg': 'audio/ogg',
+                 '.mp3': 'audio/mpeg'}
+
+buckets = {}
+
+
+def get_bucket() -> storage.Bucket:
+    # client.bucket only builds the handle, unlike client.get_bucket it does not call the API
+    bucket_name = os.getenv('BUCKET_NAME')
+    if bucket_name not in buckets:
+        buckets[bucket_name] = client.bucket(bucket_name)
+    return buckets[bucket_name]
+
+
+def get_blob(phone_number, remote_filename) -> storage.Blob:
+    return get_bucket().blob(os.path.join(f'chatbot/media_files/{phone_number}', remote_filename))
+
+
+def get_public_url(phone_number, remote_filename) -> str:
+    """The url only depends on bucket and object name, so it is known before the upload"""
+    return get_blob(phone_number, remote_filename).public_url
+
+
+class MediaUploader:
+    """
+    Uploads media to the bucket from a worker thread, the object is made public in the same request with a predefined
+    ACL. Uploads are retried with exponential backoff and can run as background tasks, in which case the public url is
+    returned right away and `on_complete(public_url, success)` is awaited once the upload has finished or failed.
+    """
+
+    def __init__(self, retries=3, retry_delay=1):
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.background_tasks = set()
+
+    async def upload(self, data: bytes, phone_number, remote_filename) -> str:
+        name, file_extension = os.path.splitext(remote_filename)
+        blob = get_blob(phone_number, remote_filename)
+        for attempt in range(self.retries + 1):
+            try:
+                await asyncio.to_thread(blob.upload_from_string, data, content_type=content_types[file_extension],
+                                        predefined_acl='publicRead')
+                return blob.public_url
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                logger.info(f'Upload of {blob.name} failed, retrying')
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+    def upload_in_background(self, data: bytes, phone_number, remote_filename, on_complete=None) -> str:
+        public_url = get_public_url(phone_number, remote_filename)
+        task = asyncio.create_task(self.upload_and_notify(data, phone_number, remote_filename, on_complete))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return public_url
+
+    async def upload_and_notify(self, data, phone_number, remote_filename, on_complete):
+        try:
+            public_url = await self.upload(data, phone_number, remote_filename)
+            success = True
+        except Exception:
+            logger.exception(f'Failed to upload {remote_filename}')
+            public_url = get_public_url(phone_number, remote_filename)
+            success = False
+        if on_complete is not None:
+            try:
+                await on_complete(public_url, success)
+            except Exception:
+                logger.exception(f'Upload callback for {remote_filename} failed')
 
-async def upload_file_and_get_public_url(filename, phone_number, remote_filename):
-    name, file_extension = os.path.splitext(filename)
+    async def stop(self):
+        """Waits for the uploads still running in background"""
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
 
-    content_type = {'.gif': 'image/gif',
-                    '.jpg': 'image/jpg',
-                    '.jpeg': 'image/jpeg',
-                    '.png': 'image/png',
-                    '.PNG': 'image/png',
-                    '.pdf': 'application/pdf',
-                    '.ogg': 'audio/ogg',
-                    '.mp3': 'audio/mpeg'}
 
-    bucket = client.get_bucket(os.getenv('BUCKET_NAME'))
-    blob = bucket.blob(os.path.join(f'chatbot/media_files/{phone_number}', remote_filename))
-    blob.upload_from_filename(filename, content_type=content_type[file_extension])
-    blob.make_public()
-    return blob.public_url
+media_uploader = MediaUploader(retries=int(os.getenv('MEDIA_UPLOAD_RETRIES', 3)),
+                               retry_delay=float(os.getenv('MEDIA_UPLOAD_RETRY_DELAY', 1)))
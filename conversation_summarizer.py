@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import os
+
+from openai_utility.openai_utils import OPENAI_FAILURE_RESPONSE, acall_openAI_api
+from prompt_budget import prompt_budget, split_history
+from scheme_prompts import prompts
+from user_context import user_context_loader
+
+logger = logging.getLogger('jugalbandi_telegram')
+
+
+def format_turns(turns) -> str:
+    """Conversation turns as the conversation history text of the prompts"""
+    return ''.join(('\n\nUser: ' if turn['role'] == 'user' else '\nBot: ') + turn['text'] for turn in turns)
+
+
+class ConversationSummarizer:
+    """
+    Keeps the conversation history of long chats short. After a chat turn has been answered, a conversation with more
+    than `summarize_after_turns` raw turns gets its older turns compressed by the LLM into a short structured summary,
+    merged with the previous one and stored in `rolling_summary` next to the conversation history. The history then
+    starts at the newest `keep_raw_turns` turns, so the prompt of later turns is this summary plus a few raw turns.
+    The summarized turns stay stored in jugalbandi_conversation_turns.
+
+    Summaries run as background tasks, at most one per conversation chunk at a time.
+
+    The turns are counted in the history kept for the prompts, which has at most `max_history_turns` turns, so
+    summarizing has to start before that.
+    """
+
+    def __init__(self, summarize_after_turns=12, keep_raw_turns=4, max_tokens=256, max_history_turns=None):
+        if max_history_turns is not None and 0 < max_history_turns <= summarize_after_turns:
+            raise ValueError(f'Conversations are summarized after {summarize_after_turns} turns but the history keeps '
+                             f'only {max_history_turns}, CONVERSATION_SUMMARIZE_AFTER_TURNS has to be less than '
+                             f'PROMPT_MAX_HISTORY_TURNS')
+        self.summarize_after_turns = summarize_after_turns
+        self.keep_raw_turns = keep_raw_turns
+        self.max_tokens = max_tokens
+        self.running = set()
+        self.background_tasks = set()
+
+    def schedule(self, db_object, chat_id, conversation_chunk_id, conversation_summary):
+        if self.summarize_after_turns <= 0 or not conversation_chunk_id or conversation_chunk_id in self.running:
+            return
+        turns = split_history(conversation_summary or '')
+        if len(turns) <= self.summarize_after_turns:
+            return
+        self.running.add(conversation_chunk_id)
+        task = asyncio.create_task(self.summarize(db_object, chat_id, conversation_chunk_id))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        task.add_done_callback(lambda _: self.running.discard(conversation_chunk_id))
+
+    async def summarize(self, db_object, chat_id, conversation_chunk_id):
+        try:
+            conversation = await db_object.get_conversation_turns(conversation_chunk_id)
+            if conversation is None:
+                return
+            prompt_row, turns = conversation
+            # a turn is a user message and a bot response
+            summarized_turns = turns[:max(len(turns) - 2 * self.keep_raw_turns, 0)]
+            summarized_history = (prompt_row['conversation_summary'] or '') + format_turns(summarized_turns)
+            if not summarized_history.strip():
+                return
+            history_start_seq = prompt_row['history_start_seq']
+            new_history_start_seq = summarized_turns[-1]['seq'] + 1 if summarized_turns else history_start_seq
+
+            prompt = prompts['conversation_summarization'] + "\n\nPrevious Summary:\n\"\"\"\n" + \
+                     ((prompt_row['rolling_summary'] or '').strip() or 'None') + "\n\"\"\"\n\nConversation:\n\"\"\"" + \
+                     summarized_history.rstrip() + "\n\"\"\"\n\nSummary:\n"
+            summary = await acall_openAI_api(prompt, max_tokens=self.max_tokens)
+            if not summary or summary == OPENAI_FAILURE_RESPONSE:
+                return
+            # quotes are stripped from the conversation history before it is stored as well
+            compressed = await db_object.compress_conversation(conversation_chunk_id, history_start_seq,
+                                                               prompt_row['conversation_summary'] or '',
+                                                               new_history_start_seq, summary.strip().replace("'", ""))
+            if not compressed:
+                logger.info(f'Conversation {conversation_chunk_id} changed while it was summarized')
+                return
+            # the cached history may have newer turns than were read here, it is loaded again
+            user_context_loader.invalidate(chat_id)
+        except Exception:
+            logger.exception(f'Failed to summarize conversation {conversation_chunk_id}')
+
+    async def stop(self):
+        """Waits for the summaries still running in background"""
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+
+
+conversation_summarizer = ConversationSummarizer(
+    summarize_after_turns=int(os.getenv('CONVERSATION_SUMMARIZE_AFTER_TURNS', 12)),
+    keep_raw_turns=int(os.getenv('CONVERSATION_KEEP_RAW_TURNS', 4)),
+    max_history_turns=prompt_budget.max_history_turns)
@@ -0,0 +1,219 @@
+"""
+Checks llm_output_parser against the regular expressions the scheme FSM used before, on the outputs of
+llm_output_corpus.json and fuzzed variants of them (truncated, wrapped in prose, repeated payloads, changed quotes), and
+times parsing every output the way the FSM conditions read it.
+
+    python data/benchmark_llm_output_parser.py [corpus.json ...] [--variants N] [--repeat N]
+
+tests/test_llm_output_parser.py runs the same equivalence check.
+
+Outputs logged in jugalbandi_users_conversation_history.llm_output can be added as a corpus, a JSON list of strings
+or of {"output": ...} objects. Outputs of several prompts logged as one text are split on the prompts separator.
+"""
+import argparse
+import ast
+import json
+import os
+import random
+import re
+import sys
+import time
+
+DATA_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+CORPUS_PATH = os.path.join(DATA_DIRECTORY, 'llm_output_corpus.json')
+
+sys.path.append(os.path.dirname(DATA_DIRECTORY))
+
+from llm_output_parser import LLMOutput, parse_scheme_filtering_output
+
+PROMPTS_SEPARATOR = '\n\n' + '-' * 100 + '\n\n'
+FILTERING_PROMPTS = ('scheme_filtering_prompt', 'scheme_filtering_chatgpt_prompt')
+
+
+def legacy_trigger(llm_output):
+    if '{"Extracted_Info":' in llm_output:
+        return 'information_extraction'
+    elif 'ChangingScheme' in llm_output:
+        return 'scheme_change'
+    elif 'user_selected_filtered_scheme' in llm_output:
+        return 'user_selected_scheme_from_options'
+    return 'continue_scheme_conversation'
+
+
+def legacy_payload(llm_output, marker_regex):
+    try:
+        payload = ast.literal_eval(re.sub(marker_regex, r'\2', llm_output, flags=re.DOTALL))
+    except Exception:
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
+def legacy_bot_response(llm_output):
+    if "user_message" in llm_output:
+        user_message_str = re.sub(r'(^.*)({\"user_message.*)', r'\2', llm_output, flags=re.DOTALL)
+        try:
+            return ast.literal_eval(user_message_str)['user_message']
+        except Exception:
+            return re.sub(r'{\"user_message\"\:\s+\"', '', user_message_str)
+    elif "- Lets think step by step" in llm_output:
+        return llm_output.split('\n-')[-1].strip()
+    return llm_output
+
+
+def legacy_scheme_filtering(llm_output):
+    clarifying_questions = re.findall(r'{\s*\'user_message\':.*}', llm_output, re.DOTALL)
+    try:
+        clarifying_question = ast.literal_eval(clarifying_questions[-1])['user_message']
+    except Exception:
+        clarifying_question = None
+    try:
+        scheme_search_result_str = re.search(r'relevant_schemes_list.*(\[.*\])', llm_output).groups()[0]
+    except AttributeError:
+        return 'error'
+    try:
+        scheme_search_result = ast.literal_eval(re.sub(', “', ', "“', scheme_search_result_str))
+    except Exception:
+        scheme_search_result = None
+    return clarifying_question, scheme_search_result
+
+
+def legacy_fsm_reads(llm_output):
+    """What the conditions of the FSM read from an output, parsing it again for every read like before"""
+    trigger = legacy_trigger(llm_output)
+    reads = {'trigger': trigger}
+    if trigger == 'information_extraction':
+        # checked before the scheme search and by the condition of every information_extraction transition
+        for _ in range(5):
+            reads['extracted_info'] = legacy_payload(llm_output, r'(^.*)({\"Extracted_Info.*)')
+    elif trigger == 'user_selected_scheme_from_options':
+        for _ in range(2):
+            reads['selected_scheme'] = legacy_payload(llm_output, r'(^.*)({\'user_selected_filtered_scheme.*)')
+    elif trigger == 'continue_scheme_conversation':
+        reads['bot_response'] = legacy_bot_response(llm_output)
+    return reads
+
+
+def bot_response(parsed_output):
+    if parsed_output.mentions_user_message:
+        try:
+            return parsed_output.user_message['user_message']
+        except Exception:
+            return parsed_output.user_message_fallback
+    elif parsed_output.thinks_step_by_step:
+        return parsed_output.last_step
+    return parsed_output.text
+
+
+def fsm_reads(llm_output):
+    parsed_output = LLMOutput(llm_output)
+    reads = {'trigger': parsed_output.trigger}
+    if reads['trigger'] == 'information_extraction':
+        for _ in range(5):
+            reads['extracted_info'] = parsed_output.extracted_info
+    elif reads['trigger'] == 'user_selected_scheme_from_options':
+        for _ in range(2):
+            reads['selected_scheme'] = parsed_output.selected_scheme
+    elif reads['trigger'] == 'continue_scheme_conversation':
+        reads['bot_response'] = bot_response(parsed_output)
+    return reads
+
+
+def scheme_filtering(llm_output):
+    try:
+        return parse_scheme_filtering_output(llm_output)
+    except ValueError:
+        return 'error'
+
+
+def mutate(llm_output, rng):
+    mutation = rng.randrange(9)
+    if mutation == 0:
+        return llm_output[:rng.randrange(len(llm_output) + 1)]
+    elif mutation == 1:
+        return rng.choice(['Sure! ', 'Bot: ', '\n\n', 'Output:\n']) + llm_output
+    elif mutation == 2:
+        return llm_output + rng.choice(['\n', ' Hope this helps.', '}', '\n\nUser: thanks'])
+    elif mutation == 3:
+        return llm_output + '\n' + llm_output
+    elif mutation == 4:
+        marker = rng.choice(['ChangingScheme', 'user_message', 'user_selected_filtered_scheme', '{"Extracted_Info',
+                             '- Lets think step by step', 'relevant_schemes_list'])
+        position = rng.randrange(len(llm_output) + 1)
+        return llm_output[:position] + ' ' + marker + ' ' + llm_output[position:]
+    elif mutation == 5:
+        return llm_output.replace('"', "'") if rng.random() < 0.5 else llm_output.replace("'", '"')
+    elif mutation == 6:
+        return llm_output.replace(': ', ':') if rng.random() < 0.5 else llm_output.replace(':', ': ')
+    elif mutation == 7:
+        position = rng.randrange(len(llm_output) + 1)
+        return llm_output[:position] + rng.choice(['{', '}', '[', ']', '\n-', '"', "'", '“']) + llm_output[position:]
+    return llm_output.replace('\n', '\n\n')
+
+
+def fuzz(llm_output, rng):
+    """A variant of the output with the kind of damage and noise seen in LLM completions"""
+    for _ in range(rng.randint(1, 3)):
+        llm_output = mutate(llm_output, rng)
+    return llm_output
+
+
+def load_corpus(paths):
+    outputs = []
+    for path in paths:
+        for entry in json.load(open(path)):
+            entry = entry if isinstance(entry, dict) else {'output': entry}
+            for output in (entry.get('output') or '').split(PROMPTS_SEPARATOR):
+                outputs.append((entry.get('prompt'), output))
+    return outputs
+
+
+def get_fuzzed_outputs(corpus, variants, seed=0):
+    """The outputs of the corpus followed by `variants` fuzzed variants of each"""
+    rng = random.Random(seed)
+    return corpus + [(prompt, fuzz(llm_output, rng)) for prompt, llm_output in corpus for _ in range(variants)]
+
+
+def find_mismatches(outputs) -> list:
+    """(output, legacy result, parser result) of the outputs the parser reads differently than before"""
+    mismatches = []
+    for prompt, llm_output in outputs:
+        if prompt in FILTERING_PROMPTS:
+            expected, actual = legacy_scheme_filtering(llm_output), scheme_filtering(llm_output)
+        else:
+            expected, actual = legacy_fsm_reads(llm_output), fsm_reads(llm_output)
+        if expected != actual:
+            mismatches.append((llm_output, expected, actual))
+    return mismatches
+
+
+def benchmark(outputs, repeat):
+    fsm_outputs = [llm_output for prompt, llm_output in outputs if prompt not in FILTERING_PROMPTS]
+    filtering_outputs = [llm_output for prompt, llm_output in outputs if prompt in FILTERING_PROMPTS]
+    for name, function, function_outputs in (('legacy FSM reads', legacy_fsm_reads, fsm_outputs),
+                                             ('parser FSM reads', fsm_reads, fsm_outputs),
+                                             ('legacy scheme filtering', legacy_scheme_filtering, filtering_outputs),
+                                             ('parser scheme filtering', scheme_filtering, filtering_outputs)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for llm_output in function_outputs:
+                function(llm_output)
+        elapsed = time.perf_counter() - start
+        print(f'{name}: {elapsed / max(repeat * len(function_outputs), 1) * 1e6:.1f} us per output')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('corpus', nargs='*', default=[CORPUS_PATH])
+    parser.add_argument('--variants', type=int, default=200, help='fuzzed variants of every output')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    outputs = get_fuzzed_outputs(corpus, args.variants, args.seed)
+    mismatches = find_mismatches(outputs)
+    for llm_output, expected, actual in mismatches:
+        print(f'Mismatch for {llm_output!r}:\n  legacy {expected!r}\n  parser {actual!r}')
+    print(f'{len(outputs)} outputs ({len(corpus)} from the corpus), {len(mismatches)} mismatches')
+    benchmark(corpus, args.repeat)
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,103 @@
+"""
+Converts the pickled langchain FAISS index (scheme_indices_eligibility.pickle) to the native scheme index loaded by
+`scheme_index.py`: the raw float32 vectors in an .npy file and a metadata file mapping row ids to scheme names.
+
+Only the standard library is used, so the conversion neither needs langchain, faiss nor numpy to be installed.
+
+    python convert_scheme_index.py [scheme_indices_eligibility.pickle] [scheme_index]
+"""
+import json
+import os
+import pickle
+import struct
+import sys
+
+SCHEME_INDEX_FORMAT_VERSION = 1
+FAISS_METRIC_L2 = 1
+FAISS_INDEX_HEADER = struct.Struct('<4siqqqBi')
+
+
+class PickledObject:
+    """Stands in for every class of the pickle, only the pickled state is kept"""
+
+    def __init__(self, *args):
+        self.args = args
+        self.state = None
+
+    def __setstate__(self, state):
+        self.state = state
+
+    def __call__(self, *args, **kwargs):
+        return PickledObject(*args)
+
+
+def get_attribute(obj, name):
+    return PickledObject(obj, name)
+
+
+class StateOnlyUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if (module, name) == ('builtins', 'getattr'):
+            return get_attribute
+        return type(name, (PickledObject,), {'__module__': module})
+
+
+def get_fields(obj) -> dict:
+    """Attributes of a pickled object, pydantic models keep them in a nested `__dict__`"""
+    state = obj.state if isinstance(obj, PickledObject) else obj
+    if isinstance(state, tuple):
+        state = state[0]
+    if isinstance(state, dict) and isinstance(state.get('__dict__'), dict):
+        return state['__dict__']
+    return state
+
+
+def read_faiss_flat_l2_index(index_bytes) -> (int, int, bytes):
+    """Reads a serialized faiss IndexFlatL2 and returns dimension, number of vectors and the raw float32 vectors"""
+    fourcc, dimension, ntotal, _, _, is_trained, metric_type = FAISS_INDEX_HEADER.unpack_from(index_bytes)
+    if fourcc != b'IxF2' or metric_type != FAISS_METRIC_L2:
+        raise ValueError(f'Only flat L2 faiss indexes are supported, got {fourcc} with metric {metric_type}')
+    offset = FAISS_INDEX_HEADER.size
+    (size,) = struct.unpack_from('<Q', index_bytes, offset)
+    offset += 8
+    if size != dimension * ntotal:
+        raise ValueError(f'Expected {dimension * ntotal} floats, found {size}')
+    return dimension, ntotal, index_bytes[offset:offset + size * 4]
+
+
+def write_npy(path, data: bytes, shape):
+    """Writes little endian float32 data in the .npy format version 1.0"""
+    header = repr({'descr': '<f4', 'fortran_order': False, 'shape': tuple(shape)})
+    header_length = len(header) + 1
+    header += ' ' * (-(10 + header_length) % 64) + '\n'
+    with open(path, 'wb') as f:
+        f.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+        f.write(data)
+
+
+def convert(pickle_path, output_directory):
+    with open(pickle_path, 'rb') as f:
+        vector_store = get_fields(StateOnlyUnpickler(f).load())
+
+    embeddings = get_fields(vector_store['embedding_function'].args[0])
+    dimension, ntotal, vectors = read_faiss_flat_l2_index(get_fields(vector_store['index'])['this'])
+    documents = get_fields(vector_store['docstore'])['_dict']
+    index_to_docstore_id = vector_store['index_to_docstore_id']
+    scheme_names = [get_fields(documents[index_to_docstore_id[i]])['metadata']['source'] for i in range(ntotal)]
+
+    os.makedirs(output_directory, exist_ok=True)
+    write_npy(os.path.join(output_directory, 'vectors.npy'), vectors, (ntotal, dimension))
+    metadata = {'format_version': SCHEME_INDEX_FORMAT_VERSION,
+                'embedding_model': embeddings.get('query_model_name', 'text-embedding-ada-002'),
+                'metric': 'squared_l2',
+                'dimension': dimension,
+                'score_thresholds': {'exact_match': 0.3, 'match': 0.5},
+                'scheme_names': scheme_names}
+    with open(os.path.join(output_directory, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f, ensure_ascii=False, indent=1)
+    print(f'Converted {ntotal} vectors of dimension {dimension} to {output_directory}')
+
+
+if __name__ == "__main__":
+    convert(sys.argv[1] if len(sys.argv) > 1 else 'scheme_indices_eligibility.pickle',
+            sys.argv[2] if len(sys.argv) > 2 else 'scheme_index')
@@ -0,0 +1,36 @@
+"""
+Builds the scheme index for SCHEME_EMBEDDING_PROVIDER=local, embedding the schemes on the CPU with the same
+sentence-transformers model which embeds the queries. Needs the optional sentence-transformers package.
+
+    python create_local_scheme_index.py [model] [exact match threshold] [match threshold]
+
+The score thresholds are squared L2 distances between normalized vectors (2 - 2 * cosine similarity) and depend on
+the model, check them against a few known questions after building.
+"""
+import json
+import os
+import sys
+
+sys.path.append('..')
+
+from embedding_providers import LocalEmbeddingProvider, LOCAL_EMBEDDING_MODEL
+from scheme_index import SchemeIndex
+
+
+def create_local_scheme_index(scheme_data, model, score_thresholds, output_directory):
+    provider = LocalEmbeddingProvider(model)
+    scheme_texts = [scheme['scheme_name'] + '\n' + scheme['details'] + '\n' + scheme['eligibility_criteria']
+                    for scheme in scheme_data]
+    vectors = provider.encode(scheme_texts)
+    scheme_index = SchemeIndex(vectors, [scheme['scheme_name'] for scheme in scheme_data], model, score_thresholds)
+    scheme_index.save(output_directory)
+    print(f'Indexed {len(scheme_index)} schemes with {model} in {output_directory}')
+
+
+if __name__ == "__main__":
+    model = sys.argv[1] if len(sys.argv) > 1 else LOCAL_EMBEDDING_MODEL
+    score_thresholds = {'exact_match': float(sys.argv[2]) if len(sys.argv) > 2 else 0.5,
+                        'match': float(sys.argv[3]) if len(sys.argv) > 3 else 0.9}
+    data = json.load(open('myschemes_scraped_combined.json'))
+    create_local_scheme_index(data, model, score_thresholds,
+                              os.path.join('..', LocalEmbeddingProvider.default_index_directory))
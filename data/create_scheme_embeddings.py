@@ -3,6 +3,7 @@ from langchain.docstore.document import Document
 import pickle
 from langchain.embeddings.openai import OpenAIEmbeddings
 import json
+from convert_scheme_index import convert
 from openai_utils import call_chatgpt_api
 from dotenv import load_dotenv
 from tqdm import tqdm
@@ -22,6 +23,8 @@ def create_scheme_embeddings(scheme_data):
 
     with open("../data/scheme_indices_eligibility.pickle", "wb") as f:
         pickle.dump(FAISS.from_documents(scheme_summaries, OpenAIEmbeddings()), f)
+    # the API loads the native index, not the pickle
+    convert("../data/scheme_indices_eligibility.pickle", "../data/scheme_index")
 
 def create_scheme_summary(scheme_data):
     max_characters = 4000 * 4  #### max token limit for OpenAI is 4096 and roughly 4 characters per token
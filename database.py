@@ -1,127 +1,233 @@
+import asyncio
 import datetime
-import json
 import os
 
 import asyncpg
 import pytz
 
-all_prompts = json.load(open('./data/prompts.json'))
-all_scheme_info = json.load(open('./data/myschemes_scraped_combined.json'))
-all_scheme_info_dict = {i['scheme_name']: i for i in all_scheme_info}
-
-
-async def create_engine(timeout=5):
+from scheme_prompts import load_specific_scheme_prompt, prompts
+
+SCHEMA_MIGRATION_LOCK_ID = 7_271_923
+API_KEY_NOTIFY_CHANNEL = 'jugalbandi_tokens_changed'
+CONVERSATION_HISTORY_COLUMNS = ('chat_id', 'created_at', 'language_preference', 'user_audio_file_link',
+                                'bot_audio_file_link', 'conversation_chunk_id', 'bot_preference', 'scheme_name',
+                                'user_message', 'bot_response', 'user_message_translated', 'bot_response_translated',
+                                'current_prompt', 'next_prompt_name', 'next_prompt', 'llm_output', 'turn_id')
+# the conversation history of a chunk is the text written before the turns were stored as rows
+# (conversation_summary), followed by the turns from history_start_seq on. `$1` limits the number of turns read.
+CONVERSATION_HISTORY_SQL = '''
+    SELECT coalesce(p.conversation_summary, '') || coalesce(string_agg(
+        CASE t.role WHEN 'user' THEN E'\\n\\nUser: ' ELSE E'\\nBot: ' END || t.text, '' ORDER BY t.seq), '')
+        AS conversation_summary
+    FROM (SELECT role, text, seq FROM jugalbandi_conversation_turns
+          WHERE conversation_chunk_id = p.conversation_chunk_id and seq >= p.history_start_seq
+          ORDER BY seq DESC LIMIT $1) t
+'''
+SERVICE_LOG_COLUMNS = ('chat_id', 'conversation_chunk_id', 'created_at', 'message_type', 'bot_preference',
+                       'davinci_success', 'bot_success', 'vernacular_to_english_translation_api_success',
+                       'vernacular_to_english_translation_api_name', 'english_to_vernacular_translation_api_success',
+                       'english_to_vernacular_translation_api_name', 'stt_api_success', 'stt_api_name',
+                       'tts_api_success', 'tts_api_name')
+
+
+async def create_engine(timeout=300, min_size=None, max_size=None):
+    """
+    Creates the asyncpg connection pool. The pool is meant to be created once per process and shared by all requests,
+    schema creation is not done here (see `create_schema` and `migrate`).
+    """
+    min_size = int(os.getenv('DATABASE_POOL_MIN_SIZE', 2)) if min_size is None else min_size
+    max_size = int(os.getenv('DATABASE_POOL_MAX_SIZE', 10)) if max_size is None else max_size
     engine = await asyncpg.create_pool(
         host=os.getenv('DATABASE_IP'),
-        port=5432,
+        port=int(os.getenv('DATABASE_PORT', 5432)),
         user=os.getenv('DATABASE_USERNAME'),
         password=os.getenv('DATABASE_PASSWORD'),
-        database=os.getenv('DATABASE_NAME'), max_inactive_connection_lifetime=timeout
+        database=os.getenv('DATABASE_NAME'),
+        min_size=min_size,
+        max_size=max(min_size, max_size),
+        max_inactive_connection_lifetime=timeout
     )
-    await create_schema(engine)
     return engine
 
 
+async def migrate():
+    """
+    One time migration step which creates the tables and indexes. Run it with `python database.py` before starting the API.
+    """
+    engine = await create_engine(min_size=1, max_size=1)
+    try:
+        await create_schema(engine)
+    finally:
+        await engine.close()
+
+
 async def create_schema(engine):
     async with engine.acquire() as connection:
-        await connection.execute('''
-            CREATE TABLE IF NOT EXISTS jugalbandi_users (
-                id SERIAL PRIMARY KEY,
-                first_name TEXT,
-                last_name TEXT,
-                chat_id BIGINT UNIQUE NOT NULL,
-                phone_number BIGINT UNIQUE,
-                telegram_username TEXT,
-                language_preference TEXT DEFAULT 'en',
-                bot_preference TEXT,
-                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-            );
-            CREATE TABLE IF NOT EXISTS jugalbandi_tokens (
-                id SERIAL PRIMARY KEY,
-                first_name TEXT,
-                last_name TEXT,
-                phone_number BIGINT UNIQUE,
-                email TEXT,
-                api_key TEXT UNIQUE NOT NULL,
-                desciption TEXT,
-                available_quota BIGINT NOT NULL,
-                used_quota BIGINT NOT NULL,
-                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-            );
-            CREATE TABLE IF NOT EXISTS jugalbandi_user_prompts (
-                id SERIAL PRIMARY KEY,
-                chat_id BIGINT NOT NULL,
-                FOREIGN KEY (chat_id) REFERENCES jugalbandi_users(chat_id),
-                conversation_chunk_id TEXT UNIQUE,
-                scheme_name TEXT,
-                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                conversation_summary TEXT,
-                prompt_type TEXT,
-                bot_preference TEXT
-            );
-            CREATE TABLE IF NOT EXISTS jugalbandi_service_logs (
-                id SERIAL PRIMARY KEY,
-                chat_id BIGINT NOT NULL,
-                FOREIGN KEY (chat_id) REFERENCES jugalbandi_users(chat_id),
-                conversation_chunk_id TEXT,
-                FOREIGN KEY (conversation_chunk_id) REFERENCES jugalbandi_user_prompts(conversation_chunk_id),
-                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                message_type TEXT,
-                bot_preference TEXT,
-                davinci_success BOOL,
-                bot_success BOOL,
-                vernacular_to_english_translation_api_success BOOL,
-                vernacular_to_english_translation_api_name TEXT,
-                english_to_vernacular_translation_api_success BOOL,
-                english_to_vernacular_translation_api_name TEXT,
-                stt_api_success BOOL,
-                stt_api_name TEXT,
-                tts_api_success BOOL,
-                tts_api_name TEXT
-            );
-            CREATE TABLE IF NOT EXISTS jugalbandi_users_conversation_history (
-                id SERIAL PRIMARY KEY,
-                chat_id BIGINT NOT NULL,
-                FOREIGN KEY (chat_id) REFERENCES jugalbandi_users(chat_id),
-                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                language_preference TEXT DEFAULT 'hi',
-                user_audio_file_link TEXT,
-                bot_audio_file_link TEXT,
-                conversation_chunk_id TEXT,
-                FOREIGN KEY (conversation_chunk_id) REFERENCES jugalbandi_user_prompts(conversation_chunk_id),
-                bot_preference TEXT,
-                scheme_name TEXT,
-                user_message TEXT,
-                bot_response TEXT,
-                user_message_translated TEXT,
-                bot_response_translated TEXT,
-                current_prompt TEXT,
-                next_prompt_name TEXT,
-                next_prompt TEXT,
-                llm_output TEXT
-                
-            );
-            CREATE INDEX IF NOT EXISTS user_chat_id_idx ON jugalbandi_users(chat_id);
-            CREATE INDEX IF NOT EXISTS token_key_idx ON jugalbandi_tokens(api_key);
-            CREATE INDEX IF NOT EXISTS prompts_chat_id_idx ON jugalbandi_user_prompts(chat_id);
-            CREATE INDEX IF NOT EXISTS chat_id_idx ON jugalbandi_users_conversation_history(chat_id);
-            CREATE INDEX IF NOT EXISTS user_chat_id_idx ON jugalbandi_service_logs(chat_id);
-        ''')
+        # serialise concurrent migrations (e.g. several workers starting together) on an advisory lock
+        await connection.execute('SELECT pg_advisory_lock($1)', SCHEMA_MIGRATION_LOCK_ID)
+        try:
+            await connection.execute('''
+                CREATE TABLE IF NOT EXISTS jugalbandi_users (
+                    id SERIAL PRIMARY KEY,
+                    first_name TEXT,
+                    last_name TEXT,
+                    chat_id BIGINT UNIQUE NOT NULL,
+                    phone_number BIGINT UNIQUE,
+                    telegram_username TEXT,
+                    language_preference TEXT DEFAULT 'en',
+                    bot_preference TEXT,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+                CREATE TABLE IF NOT EXISTS jugalbandi_tokens (
+                    id SERIAL PRIMARY KEY,
+                    first_name TEXT,
+                    last_name TEXT,
+                    phone_number BIGINT UNIQUE,
+                    email TEXT,
+                    api_key TEXT UNIQUE NOT NULL,
+                    desciption TEXT,
+                    available_quota BIGINT NOT NULL,
+                    used_quota BIGINT NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+                CREATE TABLE IF NOT EXISTS jugalbandi_user_prompts (
+                    id SERIAL PRIMARY KEY,
+                    chat_id BIGINT NOT NULL,
+                    FOREIGN KEY (chat_id) REFERENCES jugalbandi_users(chat_id),
+                    conversation_chunk_id TEXT UNIQUE,
+                    scheme_name TEXT,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    conversation_summary TEXT,
+                    rolling_summary TEXT DEFAULT '',
+                    last_turn_seq INTEGER NOT NULL DEFAULT 0,
+                    history_start_seq INTEGER NOT NULL DEFAULT 0,
+                    prompt_type TEXT,
+                    bot_preference TEXT
+                );
+                ALTER TABLE jugalbandi_user_prompts ADD COLUMN IF NOT EXISTS rolling_summary TEXT DEFAULT '';
+                ALTER TABLE jugalbandi_user_prompts ADD COLUMN IF NOT EXISTS last_turn_seq INTEGER NOT NULL DEFAULT 0;
+                ALTER TABLE jugalbandi_user_prompts
+                ADD COLUMN IF NOT EXISTS history_start_seq INTEGER NOT NULL DEFAULT 0;
+                CREATE TABLE IF NOT EXISTS jugalbandi_conversation_turns (
+                    conversation_chunk_id TEXT NOT NULL,
+                    FOREIGN KEY (conversation_chunk_id) REFERENCES jugalbandi_user_prompts(conversation_chunk_id),
+                    seq INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (conversation_chunk_id, seq)
+                );
+                CREATE OR REPLACE VIEW jugalbandi_conversation_summaries AS
+                SELECT p.conversation_chunk_id, coalesce(p.conversation_summary, '') || coalesce(string_agg(
+                    CASE t.role WHEN 'user' THEN E'\\n\\nUser: ' ELSE E'\\nBot: ' END || t.text, '' ORDER BY t.seq), '')
+                    AS conversation_summary
+                FROM jugalbandi_user_prompts p
+                LEFT JOIN jugalbandi_conversation_turns t
+                ON t.conversation_chunk_id = p.conversation_chunk_id and t.seq >= p.history_start_seq
+                GROUP BY p.id;
+                CREATE TABLE IF NOT EXISTS jugalbandi_service_logs (
+                    id SERIAL PRIMARY KEY,
+                    chat_id BIGINT NOT NULL,
+                    FOREIGN KEY (chat_id) REFERENCES jugalbandi_users(chat_id),
+                    conversation_chunk_id TEXT,
+                    FOREIGN KEY (conversation_chunk_id) REFERENCES jugalbandi_user_prompts(conversation_chunk_id),
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    message_type TEXT,
+                    bot_preference TEXT,
+                    davinci_success BOOL,
+                    bot_success BOOL,
+                    vernacular_to_english_translation_api_success BOOL,
+                    vernacular_to_english_translation_api_name TEXT,
+                    english_to_vernacular_translation_api_success BOOL,
+                    english_to_vernacular_translation_api_name TEXT,
+                    stt_api_success BOOL,
+                    stt_api_name TEXT,
+                    tts_api_success BOOL,
+                    tts_api_name TEXT
+                );
+                CREATE TABLE IF NOT EXISTS jugalbandi_users_conversation_history (
+                    id SERIAL PRIMARY KEY,
+                    chat_id BIGINT NOT NULL,
+                    FOREIGN KEY (chat_id) REFERENCES jugalbandi_users(chat_id),
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    language_preference TEXT DEFAULT 'hi',
+                    user_audio_file_link TEXT,
+                    bot_audio_file_link TEXT,
+                    conversation_chunk_id TEXT,
+                    FOREIGN KEY (conversation_chunk_id) REFERENCES jugalbandi_user_prompts(conversation_chunk_id),
+                    bot_preference TEXT,
+                    scheme_name TEXT,
+                    user_message TEXT,
+                    bot_response TEXT,
+                    user_message_translated TEXT,
+                    bot_response_translated TEXT,
+                    current_prompt TEXT,
+                    next_prompt_name TEXT,
+                    next_prompt TEXT,
+                    llm_output TEXT,
+                    turn_id TEXT
+                );
+                ALTER TABLE jugalbandi_users_conversation_history ADD COLUMN IF NOT EXISTS turn_id TEXT;
+                CREATE INDEX IF NOT EXISTS user_chat_id_idx ON jugalbandi_users(chat_id);
+                CREATE INDEX IF NOT EXISTS token_key_idx ON jugalbandi_tokens(api_key);
+                CREATE INDEX IF NOT EXISTS prompts_chat_id_idx ON jugalbandi_user_prompts(chat_id);
+                CREATE INDEX IF NOT EXISTS chat_id_idx ON jugalbandi_users_conversation_history(chat_id);
+                CREATE INDEX IF NOT EXISTS conversation_turn_id_idx ON jugalbandi_users_conversation_history(turn_id);
+                CREATE INDEX IF NOT EXISTS user_chat_id_idx ON jugalbandi_service_logs(chat_id);
+                CREATE TABLE IF NOT EXISTS jugalbandi_llm_completion_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    model TEXT,
+                    completion TEXT NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+                CREATE INDEX IF NOT EXISTS llm_completion_cache_created_at_idx
+                ON jugalbandi_llm_completion_cache(created_at);
+                CREATE TABLE IF NOT EXISTS jugalbandi_translation_memory (
+                    source_language TEXT NOT NULL,
+                    target_language TEXT NOT NULL,
+                    provider TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    translated_text TEXT NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (source_language, target_language, provider, text_hash)
+                );
+                CREATE TABLE IF NOT EXISTS jugalbandi_tts_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    audio_url TEXT NOT NULL,
+                    tts_service_name TEXT,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+            ''')
+            # notify the workers caching api keys when a key is revoked or its quota is changed
+            await connection.execute(f'''
+                CREATE OR REPLACE FUNCTION notify_jugalbandi_tokens_changed() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM pg_notify('{API_KEY_NOTIFY_CHANNEL}', OLD.api_key);
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+                DROP TRIGGER IF EXISTS jugalbandi_tokens_changed_trigger ON jugalbandi_tokens;
+                CREATE TRIGGER jugalbandi_tokens_changed_trigger
+                AFTER UPDATE OF api_key, available_quota OR DELETE ON jugalbandi_tokens
+                FOR EACH ROW EXECUTE FUNCTION notify_jugalbandi_tokens_changed();
+            ''')
+        finally:
+            await connection.execute('SELECT pg_advisory_unlock($1)', SCHEMA_MIGRATION_LOCK_ID)
 
 
 class PostgresDatabase:
     def __init__(self, engine):
         self.engine = engine
 
-    async def update_api_quota(self, api_key):
+    async def update_api_quota(self, api_key, used=1):
+        """Atomically adds `used` to the used quota of the key and returns its remaining quota"""
         async with self.engine.acquire() as connection:
-            # Check if user with given chat_id already exists
-            existing_user = await connection.fetchrow(
-                'SELECT * FROM jugalbandi_tokens WHERE api_key = $1', api_key
+            remaining_quota = await connection.fetchval(
+                """UPDATE jugalbandi_tokens SET used_quota = used_quota + $1 WHERE api_key = $2
+                RETURNING available_quota - used_quota""", used, api_key
             )
-            await connection.execute('Update jugalbandi_tokens set used_quota = $1 WHERE api_key = $2',
-                                     existing_user['used_quota'] + 1, api_key)
+        return remaining_quota
 
     async def check_user(self, chat_id):
         async with self.engine.acquire() as connection:
@@ -162,13 +268,16 @@ class PostgresDatabase:
             )
         return {'success': True}
 
-    async def check_api_key(self, api_key):
+    async def get_remaining_api_quota(self, api_key):
         async with self.engine.acquire() as connection:
-            # Check if user with given chat_id already exists
-            existing_user = await connection.fetchrow(
-                'SELECT * FROM jugalbandi_tokens WHERE api_key = $1', api_key
+            remaining_quota = await connection.fetchval(
+                'SELECT available_quota - used_quota FROM jugalbandi_tokens WHERE api_key = $1', api_key
             )
-        if existing_user and existing_user['available_quota'] > existing_user['used_quota']:
+        return remaining_quota
+
+    async def check_api_key(self, api_key):
+        remaining_quota = await self.get_remaining_api_quota(api_key)
+        if remaining_quota is not None and remaining_quota > 0:
             return True
         else:
             return False
@@ -176,7 +285,8 @@ class PostgresDatabase:
     async def clear_memory(self, chat_id):
         async with self.engine.acquire() as connection:
             await connection.execute(
-                '''UPDATE jugalbandi_user_prompts SET conversation_summary= '',
+                '''UPDATE jugalbandi_user_prompts SET conversation_summary= '', rolling_summary= '',
+                history_start_seq = last_turn_seq + 1,
                 prompt_type ='user_information_extraction', scheme_name='' WHERE chat_id = $1''',
                 chat_id
             )
@@ -206,6 +316,13 @@ class PostgresDatabase:
 
         return {'success': True}
 
+    async def insert_service_logs_batch(self, service_logs: list[dict]):
+        """Inserts many service logs (keyword arguments of `insert_service_logs`) with a single COPY"""
+        records = [tuple(service_log[column] for column in SERVICE_LOG_COLUMNS) for service_log in service_logs]
+        async with self.engine.acquire() as connection:
+            await connection.copy_records_to_table('jugalbandi_service_logs', records=records,
+                                                   columns=SERVICE_LOG_COLUMNS)
+
     async def get_bot_preference(self, chat_id):
         async with self.engine.acquire() as connection:
             result = await connection.fetchrow(
@@ -230,16 +347,49 @@ class PostgresDatabase:
     async def insert_conversation(self, chat_id, user_audio_file_link, bot_audio_file_link, conversation_chunk_id,
                                   bot_preference, scheme_name,
                                   user_message, bot_response, user_message_translated, bot_response_translated,
-                                  date, language_preference, current_prompt, next_prompt_name, next_prompt, llm_output):
+                                  date, language_preference, current_prompt, next_prompt_name, next_prompt, llm_output,
+                                  turn_id=None):
         async with self.engine.acquire() as connection:
             await connection.execute(
                 '''INSERT INTO jugalbandi_users_conversation_history 
-                (chat_id, created_at, language_preference, user_audio_file_link, bot_audio_file_link, conversation_chunk_id, bot_preference, scheme_name, user_message, bot_response, user_message_translated, bot_response_translated, current_prompt, next_prompt_name, next_prompt, llm_output) 
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16)''',
+                (chat_id, created_at, language_preference, user_audio_file_link, bot_audio_file_link, conversation_chunk_id, bot_preference, scheme_name, user_message, bot_response, user_message_translated, bot_response_translated, current_prompt, next_prompt_name, next_prompt, llm_output, turn_id) 
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17)''',
                 chat_id, date, language_preference, user_audio_file_link, bot_audio_file_link, conversation_chunk_id,
                 bot_preference, scheme_name,
                 user_message, bot_response, user_message_translated, bot_response_translated, current_prompt,
-                next_prompt_name, next_prompt, str(llm_output)
+                next_prompt_name, next_prompt, str(llm_output), turn_id
+            )
+
+    async def insert_conversations(self, conversations: list[dict]):
+        """Inserts many conversation events (keyword arguments of `insert_conversation`) with a single COPY"""
+        records = [(c['chat_id'], c['date'], c['language_preference'], c['user_audio_file_link'],
+                    c['bot_audio_file_link'], c['conversation_chunk_id'], c['bot_preference'], c['scheme_name'],
+                    c['user_message'], c['bot_response'], c['user_message_translated'], c['bot_response_translated'],
+                    c['current_prompt'], c['next_prompt_name'], c['next_prompt'], str(c['llm_output']),
+                    c['turn_id'])
+                   for c in conversations]
+        async with self.engine.acquire() as connection:
+            await connection.copy_records_to_table('jugalbandi_users_conversation_history', records=records,
+                                                   columns=CONVERSATION_HISTORY_COLUMNS)
+
+    async def update_bot_audio_file_link(self, turn_id, bot_audio_file_link):
+        """Replaces the response audio link logged for a turn, None removes it"""
+        async with self.engine.acquire() as connection:
+            await connection.execute(
+                '''UPDATE jugalbandi_users_conversation_history
+                SET bot_audio_file_link = $2
+                WHERE turn_id = $1''',
+                turn_id, bot_audio_file_link
+            )
+
+    async def clear_user_audio_file_link(self, turn_id):
+        """Removes the link of a user audio whose upload has failed from the row of its turn"""
+        async with self.engine.acquire() as connection:
+            await connection.execute(
+                '''UPDATE jugalbandi_users_conversation_history
+                SET user_audio_file_link = NULL
+                WHERE turn_id = $1''',
+                turn_id
             )
 
     async def insert_user_prompt(self, chat_id, conversation_chunk_id='',
@@ -272,14 +422,68 @@ class PostgresDatabase:
         else:
             return False
 
-    async def update_user_prompt(self, conversation_summary, chunk_id):
+    async def append_conversation_turn(self, chunk_id, scheme_name, prompt_type, user_message, bot_response,
+                                       clear_history=False):
+        """
+        Appends the user message and the bot response of a turn to the conversation and updates scheme and prompt type
+        of the chunk, in one statement whose cost does not depend on the length of the conversation. With
+        `clear_history` the conversation restarts with this turn.
+        """
         async with self.engine.acquire() as conn:
             await conn.execute(
+                '''
+                WITH chunk AS (
+                    UPDATE jugalbandi_user_prompts
+                    SET updated_at = $2, scheme_name = $3, prompt_type = $4, last_turn_seq = last_turn_seq + 2,
+                    history_start_seq = CASE WHEN $7 THEN last_turn_seq + 1 ELSE history_start_seq END,
+                    conversation_summary = CASE WHEN $7 THEN '' ELSE conversation_summary END,
+                    rolling_summary = CASE WHEN $7 THEN '' ELSE rolling_summary END
+                    WHERE conversation_chunk_id = $1
+                    RETURNING last_turn_seq
+                )
+                INSERT INTO jugalbandi_conversation_turns (conversation_chunk_id, seq, role, text, created_at)
+                SELECT $1, last_turn_seq - 1, 'user', $5::text, $2 FROM chunk
+                UNION ALL
+                SELECT $1, last_turn_seq, 'bot', $6::text, $2 FROM chunk;
+                ''', chunk_id, datetime.datetime.now(pytz.UTC), scheme_name, prompt_type, user_message, bot_response,
+                clear_history
+            )
+
+    async def get_conversation_turns(self, chunk_id):
+        """
+        Reads the conversation history of the chunk as its prompt row (conversation_summary written before the turns
+        were stored as rows, rolling_summary and history_start_seq) and its turns in order, None for unknown chunks
+        """
+        async with self.engine.acquire() as conn:
+            prompt = await conn.fetchrow(
+                '''SELECT conversation_summary, rolling_summary, history_start_seq FROM jugalbandi_user_prompts
+                WHERE conversation_chunk_id = $1''', chunk_id
+            )
+            if prompt is None:
+                return None
+            turns = await conn.fetch(
+                '''SELECT seq, role, text FROM jugalbandi_conversation_turns
+                WHERE conversation_chunk_id = $1 and seq >= $2 ORDER BY seq''', chunk_id, prompt['history_start_seq']
+            )
+        return prompt, turns
+
+    async def compress_conversation(self, chunk_id, history_start_seq, conversation_summary, new_history_start_seq,
+                                    rolling_summary) -> bool:
+        """
+        Replaces the turns before `new_history_start_seq`, and the text written before the turns were stored as rows,
+        with `rolling_summary`. Nothing is changed when the history no longer starts where it was read, e.g. because
+        memory was cleared meanwhile.
+        """
+        async with self.engine.acquire() as conn:
+            result = await conn.fetchval(
                 '''
                 UPDATE jugalbandi_user_prompts
-                SET updated_at = $1 ,conversation_summary= $2 WHERE conversation_chunk_id = $3;
-                ''', datetime.datetime.now(pytz.UTC), conversation_summary, chunk_id
+                SET conversation_summary = '', rolling_summary = $5, history_start_seq = $4
+                WHERE conversation_chunk_id = $1 and history_start_seq = $2 and coalesce(conversation_summary, '') = $3
+                RETURNING history_start_seq;
+                ''', chunk_id, history_start_seq, conversation_summary, new_history_start_seq, rolling_summary
             )
+        return result is not None
 
     async def update_user_prompt_with_new_scheme(self, chunk_id, scheme_name, prompt_type):
         async with self.engine.acquire() as conn:
@@ -338,8 +542,9 @@ class PostgresDatabase:
         async with self.engine.acquire() as connection:
             result = await connection.fetchrow(
                 '''
-                SELECT conversation_chunk_id, scheme_name, conversation_summary FROM jugalbandi_user_prompts 
-                WHERE chat_id = $1 order by created_at desc limit 1''',
+                SELECT p.conversation_chunk_id, p.scheme_name, s.conversation_summary FROM jugalbandi_user_prompts p
+                JOIN jugalbandi_conversation_summaries s ON s.conversation_chunk_id = p.conversation_chunk_id
+                WHERE p.chat_id = $1 order by p.created_at desc limit 1''',
                 chat_id
             )
         if result is None:
@@ -347,40 +552,147 @@ class PostgresDatabase:
         else:
             current_scheme_conversation_summary = result['conversation_summary']
             current_scheme_name = result['scheme_name']
-            scheme_chatbot_prompt = json.load(open('data/prompts.json'))['scheme_chatbot_prompt']
             current_prompt, current_scheme_summary = await load_specific_scheme_prompt(current_scheme_name,
-                                                                                       scheme_chatbot_prompt,
+                                                                                       prompts['scheme_chatbot_prompt'],
                                                                                        self.engine)
             current_conversation_chunk_id = result['conversation_chunk_id']
             return current_scheme_conversation_summary, current_scheme_name, current_prompt, current_conversation_chunk_id
 
-    async def get_prompts_v1(self, chat_id):
-        from scheme_v1_prompt_engineering import load_specific_scheme_prompt
+    async def get_prompts_v1(self, chat_id, history_turns=None):
+        """Latest scheme_v1 prompt of the user with the last `history_turns` turns of its conversation"""
         async with self.engine.acquire() as connection:
             result = await connection.fetchrow(
-                '''
-                SELECT * FROM jugalbandi_user_prompts 
-                WHERE chat_id = $1 and bot_preference = 'scheme_v1' order by updated_at desc limit 1''',
-                chat_id
+                f'''
+                SELECT p.conversation_chunk_id, p.scheme_name, p.rolling_summary, p.prompt_type, h.conversation_summary
+                FROM (
+                    SELECT * FROM jugalbandi_user_prompts
+                    WHERE chat_id = $2 and bot_preference = 'scheme_v1' order by updated_at desc limit 1
+                ) p
+                LEFT JOIN LATERAL ({CONVERSATION_HISTORY_SQL}) h ON TRUE''',
+                history_turns and history_turns * 2, chat_id
+            )
+        return build_prompts_v1(result)
+
+    async def get_llm_completion(self, cache_key, ttl):
+        async with self.engine.acquire() as connection:
+            completion = await connection.fetchval(
+                '''SELECT completion FROM jugalbandi_llm_completion_cache
+                WHERE cache_key = $1 and created_at > NOW() - make_interval(secs => $2)''', cache_key, ttl
+            )
+        return completion
+
+    async def insert_llm_completion(self, cache_key, model, completion):
+        async with self.engine.acquire() as connection:
+            await connection.execute(
+                '''INSERT INTO jugalbandi_llm_completion_cache (cache_key, model, completion, created_at)
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT (cache_key) DO UPDATE SET completion = EXCLUDED.completion, created_at = EXCLUDED.created_at''',
+                cache_key, model, completion, datetime.datetime.now(pytz.UTC)
+            )
+
+    async def prune_llm_completions(self, ttl, max_rows):
+        """Deletes the expired completions and the oldest ones above `max_rows`"""
+        async with self.engine.acquire() as connection:
+            await connection.execute(
+                '''DELETE FROM jugalbandi_llm_completion_cache WHERE created_at <= NOW() - make_interval(secs => $1)
+                or cache_key IN (SELECT cache_key FROM jugalbandi_llm_completion_cache
+                order by created_at desc offset $2)''', ttl, max_rows
             )
-        if result is None or 'FAILURE' in result['conversation_chunk_id']:
-            return '', '', '', '', 'user_information_extraction'
+
+    async def get_translations(self, source_language, target_language, provider, text_hashes) -> dict:
+        async with self.engine.acquire() as connection:
+            result = await connection.fetch(
+                '''SELECT text_hash, translated_text FROM jugalbandi_translation_memory
+                WHERE source_language = $1 and target_language = $2 and provider = $3 and text_hash = ANY($4::text[])''',
+                source_language, target_language, provider, text_hashes
+            )
+        return {i['text_hash']: i['translated_text'] for i in result}
+
+    async def insert_translations(self, source_language, target_language, provider, translations: dict):
+        async with self.engine.acquire() as connection:
+            await connection.executemany(
+                '''INSERT INTO jugalbandi_translation_memory
+                (source_language, target_language, provider, text_hash, translated_text)
+                VALUES ($1, $2, $3, $4, $5) ON CONFLICT DO NOTHING''',
+                [(source_language, target_language, provider, text_hash, translated_text)
+                 for text_hash, translated_text in translations.items()]
+            )
+
+    async def get_tts_audio(self, cache_key):
+        async with self.engine.acquire() as connection:
+            result = await connection.fetchrow(
+                'SELECT audio_url, tts_service_name FROM jugalbandi_tts_cache WHERE cache_key = $1', cache_key
+            )
+        return result
+
+    async def insert_tts_audio(self, cache_key, audio_url, tts_service_name):
+        async with self.engine.acquire() as connection:
+            await connection.execute(
+                '''INSERT INTO jugalbandi_tts_cache (cache_key, audio_url, tts_service_name) VALUES ($1, $2, $3)
+                ON CONFLICT (cache_key) DO NOTHING''',
+                cache_key, audio_url, tts_service_name
+            )
+
+    async def get_user_context(self, chat_id, history_turns=None):
+        """
+        Reads language and bot preference of the user together with the latest scheme_v1 prompt row and the last
+        `history_turns` turns of its conversation, and makes sure the FAILURE row of the user exists, all in one round
+        trip. The FAILURE row is only inserted when it is missing, so the usual request does not write.
+        """
+        async with self.engine.acquire() as connection:
+            result = await connection.fetchrow(
+                f'''
+                WITH failure_prompt AS (
+                    INSERT INTO jugalbandi_user_prompts (chat_id, conversation_chunk_id, created_at, updated_at)
+                    SELECT chat_id, $3, NOW(), NOW() FROM jugalbandi_users WHERE chat_id = $2
+                    AND NOT EXISTS (SELECT 1 FROM jugalbandi_user_prompts WHERE conversation_chunk_id = $3)
+                    ON CONFLICT (conversation_chunk_id) DO NOTHING
+                )
+                SELECT u.language_preference, u.bot_preference, p.conversation_chunk_id, p.scheme_name,
+                h.conversation_summary, p.rolling_summary, p.prompt_type
+                FROM jugalbandi_users u
+                LEFT JOIN LATERAL (
+                    SELECT conversation_chunk_id, scheme_name, conversation_summary, rolling_summary, prompt_type,
+                    history_start_seq
+                    FROM jugalbandi_user_prompts
+                    WHERE chat_id = u.chat_id and bot_preference = 'scheme_v1' order by updated_at desc limit 1
+                ) p ON TRUE
+                LEFT JOIN LATERAL ({CONVERSATION_HISTORY_SQL}) h ON TRUE
+                WHERE u.chat_id = $2''',
+                history_turns and history_turns * 2, chat_id, 'FAILURE' + str(chat_id)
+            )
+        return result
+
+
+def build_prompts_v1(result):
+    """
+    Builds (conversation summary, scheme name, prompt, conversation chunk id, prompt type, rolling summary) of the
+    scheme_v1 bot from the latest prompt row of the user
+    """
+    if result is None or result['conversation_chunk_id'] is None or 'FAILURE' in result['conversation_chunk_id']:
+        return '', '', '', '', 'user_information_extraction', ''
+    else:
+        current_prompt_type = result['prompt_type']
+        current_scheme_conversation_summary = result['conversation_summary']
+        current_scheme_name = result['scheme_name']
+        current_conversation_chunk_id = result['conversation_chunk_id']
+        rolling_summary = result['rolling_summary'] or ''
+
+        if current_prompt_type == 'specific_scheme_conversation':
+            current_prompt, scheme_summary = load_specific_scheme_prompt(current_scheme_name)
+        elif current_prompt_type == 'user_information_extraction':
+            current_prompt = prompts['user_information_extraction']
+        elif current_prompt_type == 'specific_scheme_name_disambiguation':
+            current_prompt = prompts['scheme_name_disambiguation_filtered_schemes'] + '\n' + '\n'.join(
+                current_scheme_name.split('||'))
         else:
-            current_prompt_type = result['prompt_type']
-            current_scheme_conversation_summary = result['conversation_summary']
-            current_scheme_name = result['scheme_name']
-            current_conversation_chunk_id = result['conversation_chunk_id']
+            current_prompt = ''
+
+        return current_scheme_conversation_summary, current_scheme_name, current_prompt, current_conversation_chunk_id, current_prompt_type, rolling_summary
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
 
-            if current_prompt_type == 'specific_scheme_conversation':
-                scheme_chatbot_prompt = all_prompts['scheme_chatbot_prompt']
-                current_prompt, scheme_summary = load_specific_scheme_prompt(current_scheme_name,
-                                                                             scheme_chatbot_prompt)
-            elif current_prompt_type == 'user_information_extraction':
-                current_prompt = all_prompts['user_information_extraction']
-            elif current_prompt_type == 'specific_scheme_name_disambiguation':
-                current_prompt = all_prompts['scheme_name_disambiguation_filtered_schemes'] + '\n' + '\n'.join(
-                    current_scheme_name.split('||'))
-            else:
-                current_prompt = ''
-
-            return current_scheme_conversation_summary, current_scheme_name, current_prompt, current_conversation_chunk_id, current_prompt_type
+    load_dotenv()
+    asyncio.run(migrate())
@@ -0,0 +1,168 @@
+import re
+
+import numpy as np
+
+CASTE_ABBREVIATION_REGEX = re.compile(r'\(([A-Z]+)\)')
+# particularly vulnerable tribal groups are scheduled tribes as well
+CASTE_GROUPS = {'general': {'general'}, 'ews': {'ews', 'general'}, 'obc': {'obc'}, 'sc': {'sc'}, 'st': {'st'},
+                'pvtg': {'pvtg', 'st'}}
+# values of a restricted field meaning that the scheme is not restricted on it
+UNRESTRICTED_VALUES = {'all', 'both', ''}
+# age groups which only apply with that gender or disability
+GENDER_AGE_GROUPS = {'female': 'female', 'transgender': 'transgender'}
+DISABILITY_AGE_GROUPS = {'pwd'}
+MAXIMUM_AGE = 200
+
+
+def normalize_value(value) -> str:
+    return str(value).strip().casefold()
+
+
+def normalize_caste(caste):
+    """'Scheduled Tribe (ST)' and 'ST' -> 'st'"""
+    abbreviation = CASTE_ABBREVIATION_REGEX.search(str(caste))
+    caste = normalize_value(abbreviation.group(1) if abbreviation else caste)
+    return caste if caste in CASTE_GROUPS else None
+
+
+def normalize_yes_no(value):
+    value = normalize_value(value)
+    return value if value in ('yes', 'no') else None
+
+
+def normalize_age(age):
+    try:
+        age = int(float(str(age).strip()))
+    except ValueError:
+        return None
+    return age if 0 <= age < MAXIMUM_AGE else None
+
+
+def normalize_user_profile(user_profile: dict) -> dict:
+    """
+    Facts the extraction prompt put in `User_Profile`, normalized to the values of the scheme catalog. Missing,
+    unknown and malformed facts are left out, they do not restrict the schemes.
+    """
+    user_profile = user_profile if isinstance(user_profile, dict) else {}
+    normalizers = {'Gender': ('gender', normalize_value), 'Age': ('age', normalize_age),
+                   'Caste': ('caste', normalize_caste), 'State': ('state', normalize_value),
+                   'Residence': ('residence', normalize_value), 'Is_BPL': ('bpl', normalize_yes_no),
+                   'Is_Student': ('student', normalize_yes_no), 'Occupation': ('occupation', normalize_value),
+                   'Disability': ('disability', normalize_yes_no)}
+    facts = {}
+    for key, (fact, normalizer) in normalizers.items():
+        value = user_profile.get(key)
+        if value is None or normalize_value(value) in ('', 'none', 'unknown', 'null'):
+            continue
+        value = normalizer(value)
+        if value is not None:
+            facts[fact] = value
+    return facts
+
+
+class EligibilityIndex:
+    """
+    Columnar index over the structured eligibility fields of the scheme catalog (gender, age, caste,
+    beneficiaryState, residence, isBpl, isStudent, occupation, disability). For every value of a field a boolean row
+    mask of the schemes open to users with that value is precomputed, so matching the facts of a user is a few vector
+    ANDs. A fact only excludes schemes which are restricted on that field to other values, facts the user has not
+    stated never exclude a scheme.
+    """
+
+    def __init__(self, scheme_names: list[str], schemes_information_dict: dict):
+        self.scheme_names = scheme_names
+        schemes = [schemes_information_dict.get(scheme_name) or {} for scheme_name in scheme_names]
+        self.rows = len(schemes)
+        self.all_rows = np.ones(self.rows, dtype=bool)
+        self.restrictions = {'gender': self.build_restriction(schemes, 'gender'),
+                             'state': self.build_restriction(schemes, 'beneficiaryState'),
+                             'residence': self.build_restriction(schemes, 'residence'),
+                             'occupation': self.build_restriction(schemes, 'occupation'),
+                             'caste': self.build_restriction(schemes, 'caste', normalize_caste)}
+        # schemes requiring the user to be below poverty line, a student or disabled
+        self.requirements = {'bpl': self.build_requirement(schemes, 'isBpl'),
+                             'student': self.build_requirement(schemes, 'isStudent'),
+                             'disability': self.build_requirement(schemes, 'disability')}
+        self.age_groups, self.has_age_ranges, self.minimum_ages, self.maximum_ages = self.build_age_ranges(schemes)
+
+    def build_restriction(self, schemes, field, normalizer=normalize_value):
+        """(rows open to everyone, {value: rows open to that value})"""
+        unrestricted = np.zeros(self.rows, dtype=bool)
+        allowed = {}
+        for row, scheme in enumerate(schemes):
+            values = scheme.get(field) or []
+            values = [values] if isinstance(values, str) else values
+            if not values or any(normalize_value(value) in UNRESTRICTED_VALUES for value in values):
+                unrestricted[row] = True
+                continue
+            for value in values:
+                value = normalizer(value)
+                if value is not None:
+                    allowed.setdefault(value, np.zeros(self.rows, dtype=bool))[row] = True
+        return unrestricted, allowed
+
+    def build_requirement(self, schemes, field):
+        return np.array([normalize_yes_no(scheme.get(field)) == 'yes' for scheme in schemes], dtype=bool)
+
+    def build_age_ranges(self, schemes):
+        """Minimum and maximum age of every scheme for every age group (caste, female, widowed, ...) as columns"""
+        age_groups = sorted({group for scheme in schemes for group in (scheme.get('age') or {})})
+        has_age_ranges = np.zeros((self.rows, len(age_groups)), dtype=bool)
+        minimum_ages = np.zeros((self.rows, len(age_groups)), dtype=np.int16)
+        maximum_ages = np.full((self.rows, len(age_groups)), MAXIMUM_AGE, dtype=np.int16)
+        for row, scheme in enumerate(schemes):
+            for column, group in enumerate(age_groups):
+                age_range = (scheme.get('age') or {}).get(group)
+                if isinstance(age_range, dict):
+                    has_age_ranges[row, column] = True
+                    minimum_ages[row, column] = age_range.get('gte', 0)
+                    maximum_ages[row, column] = age_range.get('lte', MAXIMUM_AGE)
+        return age_groups, has_age_ranges, minimum_ages, maximum_ages
+
+    def get_age_mask(self, age, facts) -> np.ndarray:
+        """
+        A scheme is open when the age is in its range of any group the user may belong to, or when it has no range
+        for these groups
+        """
+        columns = []
+        for column, group in enumerate(self.age_groups):
+            if group in CASTE_GROUPS and facts.get('caste') is not None:
+                applies = group in CASTE_GROUPS[facts['caste']]
+            elif group in GENDER_AGE_GROUPS and facts.get('gender') is not None:
+                applies = facts['gender'] == GENDER_AGE_GROUPS[group]
+            elif group in DISABILITY_AGE_GROUPS:
+                applies = facts.get('disability') != 'no'
+            else:
+                applies = True
+            if applies:
+                columns.append(column)
+        has_age_ranges = self.has_age_ranges[:, columns]
+        in_range = has_age_ranges & (self.minimum_ages[:, columns] <= age) & (age <= self.maximum_ages[:, columns])
+        return in_range.any(axis=1) | ~has_age_ranges.any(axis=1)
+
+    def get_mask(self, facts: dict) -> np.ndarray:
+        """Boolean row mask of the schemes the user with the normalized `facts` may be eligible for"""
+        mask = self.all_rows.copy()
+        for fact, (unrestricted, allowed) in self.restrictions.items():
+            value = facts.get(fact)
+            if value is None:
+                continue
+            if fact == 'caste':
+                allowed_rows = [allowed[caste] for caste in CASTE_GROUPS[value] if caste in allowed]
+            else:
+                allowed_rows = [allowed[value]] if value in allowed else []
+            mask &= np.logical_or.reduce([unrestricted] + allowed_rows)
+        for fact, required in self.requirements.items():
+            if facts.get(fact) == 'no':
+                mask &= ~required
+        if facts.get('age') is not None:
+            mask &= self.get_age_mask(facts['age'], facts)
+        return mask
+
+    def eligible_rows(self, user_profile: dict, rows=None) -> np.ndarray:
+        """Row ids, out of `rows` if given, of the schemes the user may be eligible for"""
+        mask = self.get_mask(normalize_user_profile(user_profile))
+        if rows is None:
+            return np.flatnonzero(mask)
+        rows = np.asarray(rows, dtype=np.int64)
+        return rows[mask[rows]]
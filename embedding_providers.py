@@ -0,0 +1,112 @@
+import abc
+import asyncio
+import logging
+import os
+
+import numpy as np
+from cachetools import TTLCache
+
+from openai_utility.openai_utils import acall_embeddings_api
+
+logger = logging.getLogger('jugalbandi_telegram')
+
+LOCAL_EMBEDDING_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+
+
+def normalize_query(text) -> str:
+    return ' '.join(text.split())
+
+
+class EmbeddingProvider(abc.ABC):
+    """Embeds search queries, every provider has its own scheme index built with the same model"""
+    name = None
+    default_index_directory = None
+
+    def __init__(self, model):
+        self.model = model
+
+    @abc.abstractmethod
+    async def embed(self, text) -> np.ndarray:
+        pass
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    name = 'openai'
+    default_index_directory = './data/scheme_index'
+
+    def __init__(self, model='text-embedding-ada-002'):
+        super().__init__(model)
+
+    async def embed(self, text) -> np.ndarray:
+        return np.asarray(await acall_embeddings_api(text, model=self.model), dtype=np.float32)
+
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """
+    Embeds on the CPU of the worker with a sentence-transformers model, so that scheme search works offline. The
+    optional sentence-transformers package has to be installed and the matching index built with
+    data/create_local_scheme_index.py.
+    """
+    name = 'local'
+    default_index_directory = './data/scheme_index_local'
+
+    def __init__(self, model=LOCAL_EMBEDDING_MODEL):
+        super().__init__(model)
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError('SCHEME_EMBEDDING_PROVIDER=local needs the sentence-transformers package')
+        self.encoder = SentenceTransformer(model, device='cpu')
+
+    def encode(self, texts) -> np.ndarray:
+        return self.encoder.encode(texts, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+    async def embed(self, text) -> np.ndarray:
+        # the model runs outside the event loop, numpy and torch release the GIL while computing
+        return (await asyncio.to_thread(self.encode, [text]))[0]
+
+
+class CachedEmbeddingProvider(EmbeddingProvider):
+    """Keeps the embeddings of recent queries, repeated and retried questions do not embed again"""
+
+    def __init__(self, provider: EmbeddingProvider, maxsize=4096, ttl=86400):
+        super().__init__(provider.model)
+        self.provider = provider
+        self.name = provider.name
+        self.default_index_directory = provider.default_index_directory
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    async def embed(self, text) -> np.ndarray:
+        key = normalize_query(text)
+        embedding = self.entries.get(key)
+        if embedding is not None:
+            self.hits += 1
+            return embedding
+        self.misses += 1
+        embedding = await self.provider.embed(key)
+        embedding.setflags(write=False)
+        self.entries[key] = embedding
+        return embedding
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+
+embedding_providers = {OpenAIEmbeddingProvider.name: OpenAIEmbeddingProvider,
+                       LocalEmbeddingProvider.name: LocalEmbeddingProvider}
+
+
+def get_embedding_provider(name=None, model=None) -> EmbeddingProvider:
+    """Provider configured with SCHEME_EMBEDDING_PROVIDER and SCHEME_EMBEDDING_MODEL, with the query cache in front"""
+    name = name or os.getenv('SCHEME_EMBEDDING_PROVIDER', OpenAIEmbeddingProvider.name)
+    model = model or os.getenv('SCHEME_EMBEDDING_MODEL')
+    if name not in embedding_providers:
+        raise ValueError(f'Unknown embedding provider {name}, expected one of {", ".join(embedding_providers)}')
+    provider = embedding_providers[name](model) if model else embedding_providers[name]()
+    cache_size = int(os.getenv('EMBEDDING_CACHE_SIZE', 4096))
+    if cache_size > 0:
+        provider = CachedEmbeddingProvider(provider, maxsize=cache_size,
+                                           ttl=float(os.getenv('EMBEDDING_CACHE_TTL', 86400)))
+    return provider
@@ -1,7 +1,6 @@
 import logging
-from io import BytesIO
 
-from pydub import AudioSegment
+from audio_transcoding import wav_to_mp3
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -12,13 +11,13 @@ logging.basicConfig(
 logger = logging.getLogger('jugalbandi_telegram')
 
 
-def process_incoming_voice(audio_bytes_data, language_preference, translate):
+async def process_incoming_voice(audio_bytes_data, language_preference, translate):
     try:
-        regional_lang_text, api_name = translate.audioInput2text(audio_data=audio_bytes_data)
+        regional_lang_text, api_name = await translate.audioInput2text(audio_data=audio_bytes_data)
         s2t_success = True
         try:
             message, translation_api_name = \
-                translate.indicTrans(text=regional_lang_text, source=language_preference, dest='en')
+                await translate.indicTrans(text=regional_lang_text, source=language_preference, dest='en')
             translation_success = True
         except:
             message = None
@@ -34,29 +33,26 @@ def process_incoming_voice(audio_bytes_data, language_preference, translate):
     return message, regional_lang_text, s2t_success, api_name, translation_success, translation_api_name
 
 
-def process_outgoing_voice(message, translate):
+async def process_outgoing_voice(message, translate):
     try:
-        audio_content, is_google = translate.text2speech(text=message, language=translate.input_language)
+        audio_content, is_google = await translate.text2speech(text=message, language=translate.input_language)
         if audio_content and not is_google:
-            audio = AudioSegment.from_file(audio_content, format="wav")
-            audio_file = BytesIO()
-            audio.export(audio_file, format='mp3')
+            audio_file, duration_seconds = await wav_to_mp3(audio_content)
             tts_service_name = 'bhashini'
-            return audio_file, audio.duration_seconds, tts_service_name
+            return audio_file, duration_seconds, tts_service_name
         else:
             logger.debug('Used google t2s api')
             tts_service_name = 'google'
-            audio_file = BytesIO(audio_content)
-            return audio_file, None, tts_service_name
+            return audio_content, None, tts_service_name
     except:
         tts_service_name = None
         return False, None, tts_service_name
 
 
-def process_incoming_text(message, translate):
+async def process_incoming_text(message, translate):
     regional_lang_text = message
     try:
-        message, translation_api_name = translate.indicTrans(text=message, source=translate.input_language, dest='en')
+        message, translation_api_name = await translate.indicTrans(text=message, source=translate.input_language, dest='en')
         success = True
     except:
         logger.info("Translation API failed")
@@ -66,10 +62,10 @@ def process_incoming_text(message, translate):
     return message, regional_lang_text, success, translation_api_name
 
 
-def process_outgoing_text(message, translate):
+async def process_outgoing_text(message, translate):
     try:
         regional_lang_text, translation_api_name = \
-            translate.indicTrans(text=message, source='en', dest=translate.input_language)
+            await translate.indicTrans(text=message, source='en', dest=translate.input_language)
         success = True
     except:
         success = False
@@ -0,0 +1,123 @@
+import ast
+import functools
+import re
+
+# markers of the payloads and keywords the FSM prompts ask the LLM for, payloads are the trailing dict after the last
+# occurrence of their marker
+MARKER_REGEX = re.compile(r'''(?P<extracted_info>\{"Extracted_Info(?P<extracted_info_key>":)?)'''
+                          r'''|(?P<selected_scheme>\{'user_selected_filtered_scheme)'''
+                          r'''|(?P<selected_scheme_key>user_selected_filtered_scheme)'''
+                          r'''|(?P<user_message>\{"user_message)'''
+                          r'''|(?P<user_message_key>user_message)'''
+                          r'''|(?P<changing_scheme>ChangingScheme)'''
+                          r'''|(?P<step_by_step>- Lets think step by step)''')
+USER_MESSAGE_PREFIX_REGEX = re.compile(r'{\"user_message\"\:\s+\"')
+CLARIFYING_QUESTION_REGEX = re.compile(r'{\s*\'user_message\':.*}', re.DOTALL)
+RELEVANT_SCHEMES_REGEX = re.compile(r'relevant_schemes_list.*(\[.*\])')
+# opening curly quote of a scheme name left unquoted by the LLM
+UNQUOTED_SCHEME_NAME_REGEX = re.compile(', “')
+
+
+def literal_eval_dict(text):
+    """The python literal in `text` if it is a dict, None when it is malformed or something else"""
+    try:
+        payload = ast.literal_eval(text)
+    except Exception:
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
+class LLMOutput:
+    """
+    Output of the scheme FSM prompts, scanned once for all markers when created. The trigger of the FSM and the
+    payloads read by its conditions are derived from that scan, every payload is evaluated at most once and shared by
+    all the conditions reading it.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.positions = {}
+        self.has_extracted_info_key = False
+        for match in MARKER_REGEX.finditer(text):
+            self.positions[match.lastgroup] = match.start()
+            if match.lastgroup == 'extracted_info' and match.group('extracted_info_key'):
+                self.has_extracted_info_key = True
+
+    def __contains__(self, marker):
+        return marker in self.positions
+
+    @property
+    def trigger(self) -> str:
+        if self.has_extracted_info_key:
+            ###### this is output from user information extraction prompt
+            return 'information_extraction'
+        elif 'changing_scheme' in self:
+            #### user is talking about different scheme, do need extraction
+            return 'scheme_change'
+        elif 'selected_scheme' in self or 'selected_scheme_key' in self:
+            ####### Need to disambiguate from multiple matching schemes given to user
+            return 'user_selected_scheme_from_options'
+        else:
+            #### this is a specific scheme conversation
+            return 'continue_scheme_conversation'
+
+    def get_payload_text(self, marker) -> str:
+        """The output from the last occurrence of `marker` on, the whole output when the marker is missing"""
+        return self.text[self.positions[marker]:] if marker in self else self.text
+
+    @functools.cached_property
+    def extracted_info(self):
+        """{'Extracted_Info': {...}, 'User_Message': ...} of the user information extraction prompt"""
+        return literal_eval_dict(self.get_payload_text('extracted_info'))
+
+    @functools.cached_property
+    def selected_scheme(self):
+        """{'user_selected_filtered_scheme': ...} of the scheme name disambiguation prompt"""
+        return literal_eval_dict(self.get_payload_text('selected_scheme'))
+
+    @property
+    def mentions_user_message(self) -> bool:
+        return 'user_message' in self or 'user_message_key' in self
+
+    @functools.cached_property
+    def user_message(self):
+        """{"user_message": ...} of the scheme chatbot prompt"""
+        return literal_eval_dict(self.get_payload_text('user_message'))
+
+    @property
+    def user_message_fallback(self) -> str:
+        """The trailing {"user_message": ... of an output which can not be parsed, without the dict syntax before the text"""
+        return USER_MESSAGE_PREFIX_REGEX.sub('', self.get_payload_text('user_message'))
+
+    @property
+    def thinks_step_by_step(self) -> bool:
+        return 'step_by_step' in self
+
+    @property
+    def last_step(self) -> str:
+        return self.text.split('\n-')[-1].strip()
+
+
+@functools.lru_cache(maxsize=64)
+def parse_llm_output(text: str) -> LLMOutput:
+    """Parsed output, the same output is scanned only once even when it is parsed in several places"""
+    return LLMOutput(text)
+
+
+def parse_scheme_filtering_output(text: str):
+    """
+    Returns the clarifying question and the relevant_schemes_list of the scheme filtering prompt output, each None when
+    it can not be parsed. Raises ValueError when the output has no relevant_schemes_list.
+    """
+    clarifying_questions = CLARIFYING_QUESTION_REGEX.findall(text)
+    clarifying_question = literal_eval_dict(clarifying_questions[-1]) if clarifying_questions else None
+    clarifying_question = clarifying_question.get('user_message') if clarifying_question is not None else None
+
+    relevant_schemes = RELEVANT_SCHEMES_REGEX.search(text)
+    if relevant_schemes is None:
+        raise ValueError('Scheme filtering output has no relevant_schemes_list')
+    try:
+        scheme_search_result = ast.literal_eval(UNQUOTED_SCHEME_NAME_REGEX.sub(', "“', relevant_schemes.groups()[0]))
+    except Exception:
+        scheme_search_result = None
+    return clarifying_question, scheme_search_result
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import os
+
+from database import PostgresDatabase
+
+logger = logging.getLogger('jugalbandi_telegram')
+
+CONVERSATION = 'conversation'
+SERVICE_LOG = 'service_log'
+
+
+class ConversationLogSink:
+    """
+    Background writer for the conversation history and service logs. Records are queued on the response path and
+    written in batches with COPY, either every `flush_interval` seconds or as soon as `batch_size` records are waiting.
+    When the queue is full, or the sink is not running, records are written directly so that nothing is dropped. A
+    batch which can not be copied is written record by record, only records which fail on their own are lost.
+
+    Conversation records carry the id of their turn. `update_conversation` corrects the row of a turn in background
+    once that record has been written, without waiting for the records of other turns.
+    """
+
+    def __init__(self, maxsize=1000, batch_size=100, flush_interval=1):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = None
+        self.engine = None
+        self.writer_task = None
+        # turn id -> future resolved once the conversation record of the turn has been written
+        self.pending_conversations = {}
+        self.background_tasks = set()
+
+    def start(self, engine):
+        self.engine = engine
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self.writer_task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stops accepting records and waits until everything queued has been written"""
+        if self.writer_task is None:
+            return
+        writer_task, self.writer_task = self.writer_task, None
+        await self.queue.join()
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        writer_task.cancel()
+        try:
+            await writer_task
+        except asyncio.CancelledError:
+            pass
+
+    async def insert_conversation(self, db_object, **conversation):
+        self.pending_conversations[conversation['turn_id']] = asyncio.get_running_loop().create_future()
+        if not self.enqueue(CONVERSATION, conversation):
+            try:
+                await db_object.insert_conversation(**conversation)
+            finally:
+                self.mark_written(conversation)
+
+    def mark_written(self, conversation):
+        written = self.pending_conversations.pop(conversation['turn_id'], None)
+        if written is not None and not written.done():
+            written.set_result(None)
+
+    def update_conversation(self, turn_id, update):
+        """Runs `update()` in background once the conversation record of the turn has been written"""
+        task = asyncio.create_task(self.run_update(turn_id, update))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def run_update(self, turn_id, update):
+        written = self.pending_conversations.get(turn_id)
+        if written is not None:
+            await written
+        try:
+            await update()
+        except Exception:
+            logger.exception(f'Failed to update the conversation record of turn {turn_id}')
+
+    async def insert_service_logs(self, db_object, **service_log):
+        if not self.enqueue(SERVICE_LOG, service_log):
+            await db_object.insert_service_logs(**service_log)
+
+    def enqueue(self, kind, record) -> bool:
+        if self.writer_task is None:
+            return False
+        try:
+            self.queue.put_nowait((kind, record))
+            return True
+        except asyncio.QueueFull:
+            logger.info('Log sink queue is full, writing the record directly')
+            return False
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            try:
+                deadline = asyncio.get_running_loop().time() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    timeout = deadline - asyncio.get_running_loop().time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout=timeout))
+                    except asyncio.TimeoutError:
+                        break
+                await self.write(batch)
+            finally:
+                for kind, record in batch:
+                    if kind == CONVERSATION:
+                        self.mark_written(record)
+                    self.queue.task_done()
+
+    async def write(self, batch):
+        db_object = PostgresDatabase(self.engine)
+        conversations = [record for kind, record in batch if kind == CONVERSATION]
+        service_logs = [record for kind, record in batch if kind == SERVICE_LOG]
+        if conversations:
+            await self.write_records(CONVERSATION, conversations, db_object.insert_conversations,
+                                     db_object.insert_conversation)
+        if service_logs:
+            await self.write_records(SERVICE_LOG, service_logs, db_object.insert_service_logs_batch,
+                                     db_object.insert_service_logs)
+
+    async def write_records(self, kind, records, insert_batch, insert_record):
+        """
+        Writes the records with one COPY, retried once. If the COPY still fails the records are inserted one by one, so
+        that a bad record only loses itself.
+        """
+        for attempt in range(2):
+            try:
+                await insert_batch(records)
+                return
+            except Exception:
+                logger.exception(f'Failed to write {len(records)} {kind} records, attempt {attempt + 1}')
+        for record in records:
+            try:
+                await insert_record(**record)
+            except Exception:
+                logger.exception(f'Failed to write {kind} record {record}')
+
+
+log_sink = ConversationLogSink(maxsize=int(os.getenv('LOG_SINK_QUEUE_SIZE', 1000)),
+                               batch_size=int(os.getenv('LOG_SINK_BATCH_SIZE', 100)),
+                               flush_interval=float(os.getenv('LOG_SINK_FLUSH_INTERVAL', 1)))
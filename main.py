@@ -1,21 +1,39 @@
+import asyncio
+import json
+import os
+
 import uvicorn
 from fastapi import FastAPI, Request, Security, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.utils import get_openapi
+from fastapi.responses import StreamingResponse
 from fastapi.security.api_key import APIKey, APIKeyHeader
+from dotenv import load_dotenv
+
+# configuration is read when the modules below are imported
+load_dotenv()
 
 from models.register_user import RegisterUser, RegisterUserResponse
 from models.change_language import ChangeLanguage, ChangeLanguageResponse
 from models.clear_memory import ClearMemoryResponse, ClearMemory
 from models.greetings import GreetingsInput, GreetingsResponse
 from models.chat import ChatResponse, ChatInput
+from api_key_cache import api_key_cache
+from cloud_filestorage import media_uploader
+from conversation_summarizer import conversation_summarizer
+from log_sink import log_sink
+from openai_utility.completion_cache import completion_cache
+from openai_utility.openai_utils import close_openai_session
+from prompt_budget import prompt_budget
+from quota_accounting import quota_accountant
+from translation_memory import translation_memory
+from translator import close_translator_sessions
+from tts_cache import tts_cache
+from user_context import user_context_loader
 from chat import chatbot_flow
-from database import create_engine, PostgresDatabase
+from database import create_engine, create_schema, PostgresDatabase
 from wasabi import msg
 
-from dotenv import load_dotenv
-load_dotenv()
-
 app = FastAPI(title='JugalBandi API')
 language_options = {'English': 'en', 'हिन्दी': 'hi', 'বাংলা': 'bn', 'தமிழ்': 'ta', 'తెలుగు': 'te', 'ਪੰਜਾਬੀ': 'pa'}
 greeting_messages = {'en': "Now please ask your question either by typing it or by recording it in a voice note",
@@ -67,24 +85,57 @@ app.add_middleware(
 api_key_header = APIKeyHeader(name="Authorization", auto_error=False)
 
 
-async def get_api_key(api_key: str = Security(api_key_header)):
-    db_engine = await create_engine()
-    db_object = PostgresDatabase(engine=db_engine)
+@app.on_event("startup")
+async def startup():
+    # the first prompt of a worker should not wait for the tokenizer on the event loop
+    await prompt_budget.load_tokenizer()
+    # single connection pool for the lifetime of the worker, shared by all the requests
+    app.state.db_engine = await create_engine()
+    if os.getenv('RUN_DB_MIGRATIONS', 'false').lower() == 'true':
+        await create_schema(app.state.db_engine)
+    if os.getenv('API_KEY_CACHE_NOTIFY', 'false').lower() == 'true':
+        await api_key_cache.listen(app.state.db_engine)
+    quota_accountant.start(app.state.db_engine)
+    log_sink.start(app.state.db_engine)
+    if os.getenv('LLM_CACHE_PERSISTENT', 'false').lower() == 'true':
+        completion_cache.enable_persistent_tier(app.state.db_engine)
+    if os.getenv('TRANSLATION_MEMORY_PERSISTENT', 'false').lower() == 'true':
+        translation_memory.enable_persistent_tier(app.state.db_engine)
+    if os.getenv('TTS_CACHE_PERSISTENT', 'false').lower() == 'true':
+        tts_cache.enable_persistent_tier(app.state.db_engine)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await media_uploader.stop()
+    await conversation_summarizer.stop()
+    await log_sink.stop()
+    await completion_cache.stop()
+    await translation_memory.stop()
+    await quota_accountant.stop()
+    await api_key_cache.close()
+    await app.state.db_engine.close()
+    await close_openai_session()
+    await close_translator_sessions()
+
+
+def get_db_object(request: Request) -> PostgresDatabase:
+    return PostgresDatabase(engine=request.app.state.db_engine)
+
+
+async def get_api_key(api_key: str = Security(api_key_header), db_object: PostgresDatabase = Depends(get_db_object)):
     api_key = api_key.strip() if isinstance(api_key, str) else None
-    if api_key and await db_object.check_api_key(api_key=api_key):
-        await db_engine.close()
+    if api_key and await quota_accountant.authorize(api_key=api_key, db_object=db_object):
         return api_key
     else:
-        await db_engine.close()
         raise HTTPException(
             status_code=403, detail="Could not validate API KEY"
         )
 
 
 @app.post("/register_user/", response_model=RegisterUserResponse)
-async def register_user(data: RegisterUser, request: Request, api_key: APIKey = Depends(get_api_key)):
-    db_engine = await create_engine()
-    db_object = PostgresDatabase(engine=db_engine)
+async def register_user(data: RegisterUser, request: Request, api_key: APIKey = Depends(get_api_key),
+                        db_object: PostgresDatabase = Depends(get_db_object)):
     client_ip_address = request.headers.get('x-forwarded-for')
     msg.info(f'{client_ip_address}  :: Register request received :: {str(data)}')
 
@@ -103,65 +154,59 @@ async def register_user(data: RegisterUser, request: Request, api_key: APIKey =
     response = await db_object.insert_user(first_name, last_name, chat_id, phone_number, telegram_username,
                                            bot_preference,
                                            language_preference)
-    await db_engine.close()
     return response
 
 
 @app.post("/change_language/", response_model=ChangeLanguageResponse)
-async def change_language(data: ChangeLanguage, request: Request, api_key: APIKey = Depends(get_api_key)):
-    db_engine = await create_engine()
-    db_object = PostgresDatabase(engine=db_engine)
+async def change_language(data: ChangeLanguage, request: Request, api_key: APIKey = Depends(get_api_key),
+                          db_object: PostgresDatabase = Depends(get_db_object)):
     client_ip_address = request.headers.get('x-forwarded-for')
     msg.info(f'{client_ip_address}  :: Language change request received :: {str(data)}')
 
     chat_id = data.chat_id
     language_preference = language_options[data.language_preference]
     response = await db_object.update_language_preference(chat_id=chat_id, language_preference=language_preference)
-    await db_engine.close()
+    user_context_loader.invalidate(chat_id)
     return response
 
 
 @app.post("/clear_memory/", response_model=ClearMemoryResponse)
-async def clear_memory(data: ClearMemory, request: Request, api_key: APIKey = Depends(get_api_key)):
-    db_engine = await create_engine()
-    db_object = PostgresDatabase(engine=db_engine)
+async def clear_memory(data: ClearMemory, request: Request, api_key: APIKey = Depends(get_api_key),
+                       db_object: PostgresDatabase = Depends(get_db_object)):
     client_ip_address = request.headers.get('x-forwarded-for')
     msg.info(f'{client_ip_address}  :: Clear Memory request received :: {str(data)}')
 
     chat_id = data.chat_id
     response = await db_object.clear_memory(chat_id=chat_id)
-    await db_engine.close()
+    user_context_loader.invalidate(chat_id)
     return response
 
 
 @app.post("/greetings/",
           response_model=GreetingsResponse)
 async def greetings(data: GreetingsInput, request: Request,
-                    api_key: APIKey = Depends(get_api_key)):
+                    api_key: APIKey = Depends(get_api_key),
+                    db_object: PostgresDatabase = Depends(get_db_object)):
     """
     This is chat API that take input message. Message can either be audio or string
     """
-    db_engine = await create_engine()
-    db_object = PostgresDatabase(engine=db_engine)
     client_ip_address = request.headers.get('x-forwarded-for')
     msg.info(f'{client_ip_address}  :: Greetings request received :: {str(data)}')
     chat_id = data.chat_id
     language_preference = await db_object.get_language_preference(chat_id=chat_id)
     message = greeting_messages[language_preference]
     response = {"response": message}
-    await db_engine.close()
     return response
 
 
 @app.post("/chat/",
           response_model=ChatResponse)
 async def chat(data: ChatInput, request: Request,
-               api_key: APIKey = Depends(get_api_key)):
+               api_key: APIKey = Depends(get_api_key),
+               db_object: PostgresDatabase = Depends(get_db_object)):
     """
     This is chat API that take input message. Message can either be audio or string
     """
-    db_engine = await create_engine(timeout=600)
-    db_object = PostgresDatabase(engine=db_engine)
     client_ip_address = request.headers.get('x-forwarded-for')
     msg.info(f'{client_ip_address}  :: Chat request received :: {str(data)}')
     message = data.message
@@ -171,11 +216,58 @@ async def chat(data: ChatInput, request: Request,
     platform = data.platform
     response, audio_url = await chatbot_flow(db_object=db_object, chat_id=chat_id, message=message,
                                              message_type=message_type, acknowledgements=acknowledgement)
-    await db_object.update_api_quota(api_key=api_key)
-    await db_engine.close()
+    quota_accountant.consume(api_key)
     response = {"text": response, "audio_url": audio_url}
     return response
 
 
+# chat turns whose streaming client has disconnected are still answered and logged
+detached_chat_turns = set()
+
+
+def format_server_sent_event(event, data) -> str:
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+async def stream_chat_events(db_object, data: ChatInput, api_key):
+    events = asyncio.Queue()
+    flow = asyncio.create_task(chatbot_flow(db_object=db_object, chat_id=data.chat_id, message=data.message,
+                                            message_type=data.message_type, acknowledgements=acknowledgement,
+                                            events=events))
+    flow.add_done_callback(lambda _: events.put_nowait(None))
+    try:
+        while (event := await events.get()) is not None:
+            yield format_server_sent_event(*event)
+        try:
+            response, audio_url = await flow
+        except Exception:
+            msg.fail(f'Chat request of {data.chat_id} failed')
+            yield format_server_sent_event('error', {'detail': 'We are facing some issues, we will fix it soon'})
+            return
+        quota_accountant.consume(api_key)
+        yield format_server_sent_event('done', {"text": response, "audio_url": audio_url})
+    finally:
+        if not flow.done():
+            detached_chat_turns.add(flow)
+            flow.add_done_callback(detached_chat_turns.discard)
+
+
+@app.post("/chat/stream/",
+          response_class=StreamingResponse,
+          responses={200: {"content": {"text/event-stream": {}}}})
+async def chat_stream(data: ChatInput, request: Request,
+                      api_key: APIKey = Depends(get_api_key),
+                      db_object: PostgresDatabase = Depends(get_db_object)):
+    """
+    Streaming version of the chat API. Partial results are sent as server sent events as soon as they are ready:
+    `acknowledgement` with the transcribed question (voice notes only), `text` with the answer, `audio_url` with the
+    spoken answer (voice notes only) and finally `done` with the same body as the chat API, or `error`.
+    """
+    client_ip_address = request.headers.get('x-forwarded-for')
+    msg.info(f'{client_ip_address}  :: Chat stream request received :: {str(data)}')
+    return StreamingResponse(stream_chat_events(db_object, data, api_key), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 if __name__ == '__main__':
     uvicorn.run(app, host="0.0.0.0", port=8080)
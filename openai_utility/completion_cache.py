@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('jugalbandi_telegram')
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Removes line ending and outer whitespace differences, whitespace inside the prompt is tokenized and changes what
+    the model sees
+    """
+    return prompt.replace('\r\n', '\n').strip()
+
+
+class CompletionCache:
+    """
+    Cache of deterministic (temperature 0) LLM completions keyed on model, normalized prompt and request parameters.
+    An in memory LRU tier with TTL is always used when `maxsize` > 0, completions can additionally be kept in the
+    `jugalbandi_llm_completion_cache` table so that they are shared by all workers and survive restarts.
+    """
+
+    def __init__(self, maxsize=1024, ttl=86400, persistent_max_rows=100000):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.persistent_max_rows = persistent_max_rows
+        self.entries = OrderedDict()
+        self.engine = None
+        self.background_tasks = set()
+        self.writes_since_prune = 0
+        self.memory_hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 or self.engine is not None
+
+    def enable_persistent_tier(self, engine):
+        self.engine = engine
+
+    @staticmethod
+    def make_key(model, prompt, **params) -> str:
+        if not isinstance(prompt, str):
+            # chat messages
+            prompt = [{**message, 'content': normalize_prompt(message['content'])} for message in prompt]
+        else:
+            prompt = normalize_prompt(prompt)
+        key = json.dumps({'model': model, 'prompt': prompt, 'params': params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    async def get(self, cache_key):
+        entry = self.entries.get(cache_key)
+        if entry is not None:
+            completion, expires_at = entry
+            if expires_at > time.monotonic():
+                self.entries.move_to_end(cache_key)
+                self.memory_hits += 1
+                return completion
+            del self.entries[cache_key]
+
+        if self.engine is not None:
+            from database import PostgresDatabase
+            try:
+                completion = await PostgresDatabase(self.engine).get_llm_completion(cache_key, self.ttl)
+            except Exception:
+                logger.exception('Failed to read the persistent LLM completion cache')
+                completion = None
+            if completion is not None:
+                self.persistent_hits += 1
+                self.store_in_memory(cache_key, completion)
+                return completion
+
+        self.misses += 1
+        return None
+
+    async def set(self, cache_key, model, completion):
+        self.store_in_memory(cache_key, completion)
+        if self.engine is not None:
+            # the persistent write is not on the response path
+            task = asyncio.create_task(self.store_persistently(cache_key, model, completion))
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+
+    def store_in_memory(self, cache_key, completion):
+        if self.maxsize <= 0:
+            return
+        self.entries[cache_key] = (completion, time.monotonic() + self.ttl)
+        self.entries.move_to_end(cache_key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    async def store_persistently(self, cache_key, model, completion):
+        from database import PostgresDatabase
+
+        db_object = PostgresDatabase(self.engine)
+        try:
+            await db_object.insert_llm_completion(cache_key, model, completion)
+            self.writes_since_prune += 1
+            if self.writes_since_prune >= 1000:
+                self.writes_since_prune = 0
+                await db_object.prune_llm_completions(self.ttl, self.persistent_max_rows)
+        except Exception:
+            logger.exception('Failed to write the persistent LLM completion cache')
+
+    async def stop(self):
+        """Waits for the persistent writes still running in background"""
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {'memory_hits': self.memory_hits, 'persistent_hits': self.persistent_hits, 'misses': self.misses,
+                'memory_entries': len(self.entries)}
+
+
+completion_cache = CompletionCache(maxsize=int(os.getenv('LLM_CACHE_SIZE', 1024)),
+                                   ttl=float(os.getenv('LLM_CACHE_TTL', 86400)),
+                                   persistent_max_rows=int(os.getenv('LLM_CACHE_PERSISTENT_MAX_ROWS', 100000)))
@@ -1,8 +1,56 @@
+import asyncio
 import os
 import sys
 
+import aiohttp
 import openai
 
+from openai_utility.completion_cache import completion_cache
+
+OPENAI_FAILURE_RESPONSE = "Because Server is overloaded, I am unable to answer you at the moment. Please retry."
+
+# shared by all the async calls of the process
+openai_semaphore = asyncio.Semaphore(int(os.getenv('OPENAI_MAX_CONCURRENCY', 16)))
+openai_timeout = float(os.getenv('OPENAI_TIMEOUT', 120))
+openai_session = None
+
+
+def get_openai_session() -> aiohttp.ClientSession:
+    """Pooled HTTP session used for every async OpenAI request of the process"""
+    global openai_session
+    if openai_session is None or openai_session.closed:
+        connector = aiohttp.TCPConnector(limit=int(os.getenv('OPENAI_MAX_CONNECTIONS', 32)))
+        openai_session = aiohttp.ClientSession(connector=connector)
+    return openai_session
+
+
+async def close_openai_session():
+    global openai_session
+    if openai_session is not None:
+        await openai_session.close()
+        openai_session = None
+
+
+def check_openai_environment():
+    if os.getenv('OPENAI_API_KEY') is None:
+        sys.exit('Missing OpenAI API key in environment variable "OPENAPI_KEY"')
+    if os.getenv('OPEN_AI_MODEL') is None:
+        sys.exit('Missing OpenAI model name in environment variable "OPEN_AI_MODEL"')
+    openai.api_key = os.getenv('OPENAI_API_KEY')
+
+
+async def call_openai_with_deadline(api_resource, timeout=None, **params):
+    """
+    Awaits `api_resource.acreate` on the shared session, limited by the process wide concurrency limit and a deadline
+    """
+    timeout = openai_timeout if timeout is None else timeout
+    async with openai_semaphore:
+        session_token = openai.aiosession.set(get_openai_session())
+        try:
+            return await asyncio.wait_for(api_resource.acreate(request_timeout=timeout, **params), timeout=timeout)
+        finally:
+            openai.aiosession.reset(session_token)
+
 
 def call_openAI_api(prompt, max_tokens=256,temperature=0):
     if os.getenv('OPENAI_API_KEY') is None:
@@ -40,4 +88,60 @@ def call_chatgpt_api(messages, max_tokens=128,temperature=0):
         response = completions.choices[0].message.content
     except:
         response = "Because Server is overloaded, I am unable to answer you at the moment. Please retry."
-    return response
\ No newline at end of file
+    return response
+
+
+async def acall_openAI_api(prompt, max_tokens=256, temperature=0, timeout=None):
+    """Async version of `call_openAI_api` which does not block the event loop"""
+    check_openai_environment()
+    model_engine = os.getenv('OPEN_AI_MODEL')
+    cacheable = temperature == 0 and completion_cache.enabled
+    if cacheable:
+        cache_key = completion_cache.make_key(model_engine, prompt, max_tokens=max_tokens, temperature=temperature)
+        cached_response = await completion_cache.get(cache_key)
+        if cached_response is not None:
+            return cached_response
+    retry_limit = 2
+    response = OPENAI_FAILURE_RESPONSE
+    while retry_limit > 0:
+        try:
+            completions = await call_openai_with_deadline(openai.Completion, timeout=timeout, engine=model_engine,
+                                                          prompt=prompt, max_tokens=max_tokens, n=1, stop=None,
+                                                          temperature=temperature, user="1")
+            response = completions.choices[0].text
+            if cacheable:
+                await completion_cache.set(cache_key, model_engine, response)
+            break
+        except Exception:
+            retry_limit -= 1
+    return response
+
+
+async def acall_chatgpt_api(messages, max_tokens=128, temperature=0, timeout=None):
+    """Async version of `call_chatgpt_api` which does not block the event loop"""
+    check_openai_environment()
+    model_engine = 'gpt-3.5-turbo'
+    cacheable = temperature == 0 and completion_cache.enabled
+    if cacheable:
+        cache_key = completion_cache.make_key(model_engine, messages, max_tokens=max_tokens, temperature=temperature)
+        cached_response = await completion_cache.get(cache_key)
+        if cached_response is not None:
+            return cached_response
+    try:
+        completions = await call_openai_with_deadline(openai.ChatCompletion, timeout=timeout, model=model_engine,
+                                                      messages=messages, max_tokens=max_tokens, n=1, stop=None,
+                                                      temperature=temperature, user="1")
+        response = completions.choices[0].message.content
+        if cacheable:
+            await completion_cache.set(cache_key, model_engine, response)
+    except Exception:
+        response = OPENAI_FAILURE_RESPONSE
+    return response
+
+
+async def acall_embeddings_api(text, model='text-embedding-ada-002', timeout=None) -> list[float]:
+    """Embedding of `text`, newlines are replaced with spaces the same way as when the scheme index was built"""
+    check_openai_environment()
+    response = await call_openai_with_deadline(openai.Embedding, timeout=timeout, model=model,
+                                               input=[text.replace('\n', ' ')])
+    return response['data'][0]['embedding']
@@ -0,0 +1,139 @@
+import asyncio
+import functools
+import logging
+import os
+from dataclasses import dataclass
+
+logger = logging.getLogger('jugalbandi_telegram')
+
+HISTORY_TURN_SEPARATOR = '\nUser:'
+# text-davinci-003, the completion of `max_tokens` has to fit in the context window as well
+DEFAULT_CONTEXT_WINDOW_TOKENS = 4097
+DEFAULT_MAX_HISTORY_TURNS = 19
+DEFAULT_PROMPT_TOKEN_BUDGETS = {'user_information_extraction': 2500,
+                                'specific_scheme_name_disambiguation': 2500,
+                                'specific_scheme_conversation': 3000}
+# tokens per character of english text, used when the tokenizer can not be loaded
+ESTIMATED_TOKENS_PER_CHARACTER = 0.25
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model(model)
+    except Exception as e:
+        logger.warning(f'No tokenizer for {model}, token counts are estimated: {e}')
+        return None
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text, model) -> int:
+    """Tokens of `text` for `model`, the scheme prompts and history turns repeat on every turn so counts are cached"""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return int(len(text) * ESTIMATED_TOKENS_PER_CHARACTER) + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def split_history(conversation_summary) -> list[str]:
+    """
+    Splits the conversation summary into its turns, each starting with the user message. Joining the turns gives back
+    the conversation summary.
+    """
+    parts = conversation_summary.split(HISTORY_TURN_SEPARATOR)
+    turns = [HISTORY_TURN_SEPARATOR + part for part in parts[1:]]
+    if parts[0].strip() or not turns:
+        return [parts[0]] + turns if parts[0] else turns
+    # blank lines before the first turn belong to it
+    return [parts[0] + turns[0]] + turns[1:]
+
+
+def join_history(turns) -> str:
+    return ''.join(turns)
+
+
+@dataclass
+class PromptBudgetReport:
+    state: str
+    budget: int
+    section_tokens: dict
+    kept_turns: int
+    dropped_turns: int
+    dropped_tokens: int
+
+    @property
+    def prompt_tokens(self) -> int:
+        return sum(self.section_tokens.values())
+
+    @property
+    def over_budget(self) -> bool:
+        return self.prompt_tokens > self.budget
+
+
+class PromptBudget:
+    """
+    Fits the prompt of a FSM state into its token budget. Instructions, scheme details and the user turn are always
+    sent, the conversation history gets the tokens which are left and its oldest turns are dropped first.
+
+    The budget of a state is PROMPT_TOKEN_BUDGET_<STATE>, e.g. PROMPT_TOKEN_BUDGET_SPECIFIC_SCHEME_CONVERSATION, and
+    never more than the context window of the model less the completion tokens.
+    """
+
+    def __init__(self, model=None, context_window=None, max_history_turns=None):
+        self.model = model or os.getenv('OPEN_AI_MODEL', 'text-davinci-003')
+        self.context_window = context_window or int(
+            os.getenv('LLM_CONTEXT_WINDOW_TOKENS', DEFAULT_CONTEXT_WINDOW_TOKENS))
+        self.max_history_turns = max_history_turns or int(
+            os.getenv('PROMPT_MAX_HISTORY_TURNS', DEFAULT_MAX_HISTORY_TURNS))
+
+    async def load_tokenizer(self):
+        """Loads the tokenizer in a thread, tiktoken downloads and parses its BPE file the first time"""
+        await asyncio.to_thread(get_encoding, self.model)
+
+    def get_budget(self, state, max_tokens) -> int:
+        default_budget = DEFAULT_PROMPT_TOKEN_BUDGETS.get(state, self.context_window - max_tokens)
+        budget = int(os.getenv(f'PROMPT_TOKEN_BUDGET_{state.upper()}', default_budget))
+        return min(budget, self.context_window - max_tokens)
+
+    def count_tokens(self, text) -> int:
+        return count_tokens(text, self.model) if text else 0
+
+    def fit_history(self, state, conversation_summary, max_tokens, **sections) -> (str, PromptBudgetReport):
+        """
+        Returns the newest turns of the conversation history which fit next to the other `sections` of the prompt
+        (instructions, scheme_details, rolling_summary, user_turn) and a report of the tokens per section and the dropped
+        turns
+        """
+        budget = self.get_budget(state, max_tokens)
+        section_tokens = {name: self.count_tokens(text) for name, text in sections.items()}
+        available_tokens = budget - sum(section_tokens.values())
+        turns = split_history(conversation_summary.strip())
+        kept_turns = []
+        history_tokens = 0
+        for turn in reversed(turns[-self.max_history_turns:]):
+            turn_tokens = self.count_tokens(turn)
+            if history_tokens + turn_tokens > available_tokens:
+                break
+            kept_turns.append(turn)
+            history_tokens += turn_tokens
+        kept_turns.reverse()
+        section_tokens['history'] = history_tokens
+        dropped_turns = turns[:len(turns) - len(kept_turns)]
+        report = PromptBudgetReport(state=state, budget=budget, section_tokens=section_tokens,
+                                    kept_turns=len(kept_turns), dropped_turns=len(dropped_turns),
+                                    dropped_tokens=sum(self.count_tokens(turn) for turn in dropped_turns))
+        if report.dropped_turns:
+            logger.info(f'Prompt budget of {state} dropped {report.dropped_turns} history turns '
+                        f'({report.dropped_tokens} tokens), sections {section_tokens}')
+        if report.over_budget:
+            logger.warning(f'Prompt of {state} is {report.prompt_tokens} tokens even without history, '
+                           f'budget {budget}, sections {section_tokens}')
+        return join_history(kept_turns), report
+
+    def trim_history(self, conversation_summary) -> str:
+        """The newest turns of the conversation history which are kept for the next turn"""
+        return join_history(split_history(conversation_summary)[-self.max_history_turns:])
+
+
+prompt_budget = PromptBudget()
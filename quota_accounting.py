@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import os
+from collections import defaultdict
+
+from api_key_cache import api_key_cache
+from database import PostgresDatabase
+
+logger = logging.getLogger('jugalbandi_telegram')
+
+
+class QuotaAccountant:
+    """
+    Write-behind accounting of the API quota used by this worker. Requests are counted in memory and checked against
+    the locally known remaining budget of the key, the counts are flushed periodically with one atomic
+    `used_quota = used_quota + n` update per key which also refreshes the local budget.
+
+    Usage between two flushes of the other workers is not visible locally, so a key can overshoot its quota by at most
+    what all the workers serve in one flush interval.
+    """
+
+    def __init__(self, cache, flush_interval=5):
+        self.cache = cache
+        self.flush_interval = flush_interval
+        self.pending = defaultdict(int)
+        self.engine = None
+        self.flush_task = None
+
+    async def authorize(self, api_key, db_object) -> bool:
+        return await self.cache.validate(api_key=api_key, db_object=db_object,
+                                         pending_usage=self.pending.get(api_key, 0))
+
+    def consume(self, api_key, used=1):
+        self.pending[api_key] += used
+        self.cache.consume(api_key, used)
+
+    async def flush(self):
+        if not self.pending or self.engine is None:
+            return
+        pending, self.pending = self.pending, defaultdict(int)
+        db_object = PostgresDatabase(self.engine)
+        for api_key, used in pending.items():
+            try:
+                remaining_quota = await db_object.update_api_quota(api_key=api_key, used=used)
+            except Exception:
+                logger.exception('Failed to flush used quota, will retry on next flush')
+                self.pending[api_key] += used
+                continue
+            if remaining_quota is not None:
+                # requests counted after the swap are not part of the returned remaining quota yet
+                self.cache.set_remaining_quota(api_key, remaining_quota - self.pending.get(api_key, 0))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self, engine):
+        self.engine = engine
+        self.flush_task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+            self.flush_task = None
+        await self.flush()
+
+
+quota_accountant = QuotaAccountant(api_key_cache, flush_interval=float(os.getenv('QUOTA_FLUSH_INTERVAL', 5)))
@@ -0,0 +1,104 @@
+import json
+import os
+import re
+
+import numpy as np
+
+SCHEME_INDEX_DIRECTORY = './data/scheme_index'
+SCHEME_INDEX_FORMAT_VERSION = 1
+# calibrated for text-embedding-ada-002, indexes of other models keep their own thresholds in the metadata
+DEFAULT_SCORE_THRESHOLDS = {'exact_match': 0.3, 'match': 0.5}
+NO_ROWS = np.array([], dtype=np.int64)
+
+
+def normalize_partition_key(value) -> str:
+    """Catalog and LLM spell some categories differently, e.g. 'Science, IT & Communications'"""
+    return re.sub(r'\s*,\s*', ',', str(value)).strip().casefold()
+
+
+class SchemeIndex:
+    """
+    Exact nearest neighbour index over the scheme embeddings. The vectors are memory mapped read only from
+    `vectors.npy`, so all workers of a host share the same pages of the page cache instead of each holding a
+    deserialized copy. `metadata.json` maps row ids to scheme names and records the embedding model and its score
+    thresholds. Scores are squared L2 distances, the same as the faiss IndexFlatL2 the index was converted from (see
+    data/convert_scheme_index.py).
+
+    Rows can be partitioned by list valued fields of the scheme catalog, like `schemeCategory`, so that the search
+    ranks only the schemes of one partition and returns the true top k inside it.
+    """
+
+    def __init__(self, vectors: np.ndarray, scheme_names: list[str], embedding_model, score_thresholds=None):
+        if vectors.shape[0] != len(scheme_names):
+            raise ValueError(f'Index has {vectors.shape[0]} vectors but {len(scheme_names)} scheme names')
+        self.vectors = vectors
+        self.scheme_names = scheme_names
+        self.embedding_model = embedding_model
+        self.score_thresholds = {**DEFAULT_SCORE_THRESHOLDS, **(score_thresholds or {})}
+        self.exact_match_threshold = self.score_thresholds['exact_match']
+        self.score_threshold = self.score_thresholds['match']
+        self.squared_norms = np.einsum('ij,ij->i', vectors, vectors)
+        self.partitions = {}
+
+    @classmethod
+    def load(cls, directory=SCHEME_INDEX_DIRECTORY):
+        with open(os.path.join(directory, 'metadata.json')) as f:
+            metadata = json.load(f)
+        if metadata['format_version'] != SCHEME_INDEX_FORMAT_VERSION or metadata['metric'] != 'squared_l2':
+            raise ValueError(f'Unsupported scheme index format {metadata["format_version"]} in {directory}')
+        vectors = np.load(os.path.join(directory, 'vectors.npy'), mmap_mode='r')
+        if vectors.dtype != np.float32 or vectors.ndim != 2 or vectors.shape[1] != metadata['dimension']:
+            raise ValueError(f'Unexpected vectors {vectors.dtype} {vectors.shape} in {directory}')
+        return cls(vectors, metadata['scheme_names'], metadata['embedding_model'], metadata.get('score_thresholds'))
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'vectors.npy'), np.ascontiguousarray(self.vectors, dtype='<f4'))
+        metadata = {'format_version': SCHEME_INDEX_FORMAT_VERSION,
+                    'embedding_model': self.embedding_model,
+                    'metric': 'squared_l2',
+                    'dimension': self.vectors.shape[1],
+                    'score_thresholds': self.score_thresholds,
+                    'scheme_names': self.scheme_names}
+        with open(os.path.join(directory, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f, ensure_ascii=False, indent=1)
+
+    def __len__(self):
+        return len(self.scheme_names)
+
+    def partition_by(self, field, schemes_information_dict):
+        """Groups the row ids by every value of `field` of the schemes in the catalog"""
+        partition = {}
+        for row, scheme_name in enumerate(self.scheme_names):
+            values = (schemes_information_dict.get(scheme_name) or {}).get(field) or []
+            for value in [values] if isinstance(values, str) else values:
+                partition.setdefault(normalize_partition_key(value), []).append(row)
+        self.partitions[field] = {value: np.array(rows, dtype=np.int64) for value, rows in partition.items()}
+
+    def rows_with(self, field, value) -> np.ndarray:
+        """Row ids of the schemes having `value` in `field`, `field` has to be partitioned with `partition_by`"""
+        if not value:
+            return NO_ROWS
+        return self.partitions[field].get(normalize_partition_key(value), NO_ROWS)
+
+    def search(self, query_vector, k=10, rows=None) -> list[tuple[str, float]]:
+        """
+        Returns the `k` nearest schemes as (scheme name, squared L2 distance), nearest first. When `rows` is given
+        only those row ids are searched.
+        """
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        if rows is None:
+            vectors, squared_norms = self.vectors, self.squared_norms
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+            vectors, squared_norms = self.vectors[rows], self.squared_norms[rows]
+        # |x - q|^2 = |x|^2 - 2 x.q + |q|^2
+        distances = squared_norms - 2 * (vectors @ query_vector) + query_vector @ query_vector
+        np.maximum(distances, 0, out=distances)
+        k = min(k, len(distances))
+        if k <= 0:
+            return []
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest], kind='stable')]
+        row_ids = nearest if rows is None else rows[nearest]
+        return [(self.scheme_names[row], float(distance)) for row, distance in zip(row_ids, distances[nearest])]
@@ -0,0 +1,153 @@
+import math
+import re
+from collections import Counter
+
+TOKEN_REGEX = re.compile(r'\w+')
+URL_REGEX = re.compile(r'\S*(?:https?://|www\.|\.(?:in|com|org|net)\b)\S*')
+NAME_PART_SEPARATOR_REGEX = re.compile(r'\s[-–:(]\s?')
+# words which do not tell schemes apart, they are neither ranked nor used to derive acronyms
+STOP_WORDS = {'a', 'about', 'am', 'an', 'and', 'any', 'are', 'by', 'can', 'do', 'for', 'from', 'get', 'how', 'i',
+              'in', 'is', 'it', 'know', 'me', 'my', 'of', 'on', 'or', 'phase', 'please', 'scheme', 'schemes', 'tell',
+              'the', 'to', 'under', 'want', 'what', 'with'}
+# fields of a scheme written in prose, the lowercase words used in them are dictionary words
+PROSE_FIELDS = ('details', 'benefits', 'eligibility_criteria', 'application_process', 'documents_required')
+
+
+def tokenize(text) -> list[str]:
+    return TOKEN_REGEX.findall(str(text).casefold())
+
+
+def get_terms(text) -> list[str]:
+    return [token for token in tokenize(text) if token not in STOP_WORDS]
+
+
+def get_acronym(scheme_name) -> str:
+    """'Pradhan Mantri Awas Yojana' -> 'pmay'"""
+    return ''.join(token[0] for token in get_terms(scheme_name) if token.isalpha())
+
+
+def get_acronyms(scheme_name) -> set[str]:
+    """Acronyms of the whole name and of its main part, 'Pradhan Mantri Awas Yojana - Urban' -> {'pmayu', 'pmay'}"""
+    acronyms = {get_acronym(scheme_name), get_acronym(NAME_PART_SEPARATOR_REGEX.split(scheme_name)[0])}
+    # one or two letters are too ambiguous to name a scheme
+    return {acronym for acronym in acronyms if len(acronym) >= 3}
+
+
+def get_dictionary_words(schemes: list[dict]) -> set[str]:
+    """Words written in lowercase in the prose of the schemes, links left out"""
+    return {token for scheme in schemes for field in PROSE_FIELDS
+            for token in TOKEN_REGEX.findall(URL_REGEX.sub(' ', str(scheme.get(field) or '')))
+            if token.isalpha() and token.islower()}
+
+
+def contains_phrase(tokens_text, phrase_tokens) -> bool:
+    return bool(phrase_tokens) and f' {" ".join(phrase_tokens)} ' in tokens_text
+
+
+class SchemeLexicalIndex:
+    """
+    In memory BM25 index over scheme name, short title, tags and the acronyms of the name. It resolves queries which
+    name a scheme, by its name, short title or acronym, without embedding the query, and provides the lexical ranking
+    fused with the vector ranking for everything else.
+
+    Short titles and acronyms name a scheme only when they are distinctive: indexed for that scheme alone, not only
+    made of dictionary, tag or stop words, and written in capitals in the query like the codes they are. 'SCHOLARSHIP',
+    'DAY' or 'NAP' in a question are ordinary words and 'PMAY' is shared by the rural and the urban scheme.
+    """
+
+    def __init__(self, schemes: list[dict], k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.scheme_names = []
+        self.name_tokens = []
+        self.name_phrases = []
+        self.code_phrases = []
+        self.term_frequencies = []
+        self.document_lengths = []
+        document_frequencies = Counter()
+        code_phrase_frequencies = Counter()
+        tag_terms = set()
+        for scheme in schemes:
+            scheme_name = scheme['scheme_name']
+            short_title_tokens = tokenize(scheme.get('schemeShortTitle') or '')
+            acronyms = get_acronyms(scheme_name)
+            tag_terms.update(term for tag in scheme.get('tags') or [] for term in tokenize(tag))
+            tokens = get_terms(scheme_name) + get_terms(scheme.get('schemeShortTitle') or '') + sorted(acronyms) + [
+                term for tag in scheme.get('tags') or [] for term in get_terms(tag)]
+            code_phrases = {(acronym,) for acronym in acronyms}
+            if len(''.join(short_title_tokens)) >= 3:
+                code_phrases.add(tuple(short_title_tokens))
+            term_frequencies = Counter(tokens)
+            self.scheme_names.append(scheme_name)
+            self.name_tokens.append(set(get_terms(scheme_name)))
+            self.name_phrases.append(tokenize(scheme_name))
+            self.code_phrases.append(code_phrases)
+            self.term_frequencies.append(term_frequencies)
+            self.document_lengths.append(len(tokens))
+            document_frequencies.update(term_frequencies.keys())
+            code_phrase_frequencies.update(code_phrases)
+        common_words = get_dictionary_words(schemes) | tag_terms | STOP_WORDS
+        # matched against the tokens of the query as written, codes have to be in capitals
+        self.code_phrases = [[[token.upper() for token in phrase] for phrase in sorted(code_phrases)
+                              if code_phrase_frequencies[phrase] == 1
+                              and (len(phrase) > 1 or document_frequencies[phrase[0]] == 1)
+                              and not all(token in common_words for token in phrase)]
+                             for code_phrases in self.code_phrases]
+        self.documents = {scheme_name: document for document, scheme_name in enumerate(self.scheme_names)}
+        self.average_document_length = sum(self.document_lengths) / max(len(self.document_lengths), 1)
+        self.postings = {}
+        for document, term_frequencies in enumerate(self.term_frequencies):
+            for term in term_frequencies:
+                self.postings.setdefault(term, []).append(document)
+        documents = len(self.scheme_names)
+        self.idf = {term: math.log(1 + (documents - frequency + 0.5) / (frequency + 0.5))
+                    for term, frequency in document_frequencies.items()}
+
+    def search(self, query, k=10) -> list[tuple[str, float]]:
+        """Returns the `k` best schemes for the query as (scheme name, BM25 score), best first"""
+        scores = Counter()
+        for term in set(get_terms(query)):
+            for document in self.postings.get(term, ()):
+                term_frequency = self.term_frequencies[document][term]
+                length_norm = 1 - self.b + self.b * self.document_lengths[document] / self.average_document_length
+                scores[document] += self.idf[term] * term_frequency * (self.k1 + 1) / (
+                        term_frequency + self.k1 * length_norm)
+        return [(self.scheme_names[document], score) for document, score in scores.most_common(k)]
+
+    def is_named(self, document, tokens_text, code_tokens_text) -> bool:
+        return contains_phrase(tokens_text, self.name_phrases[document]) or any(
+            contains_phrase(code_tokens_text, phrase) for phrase in self.code_phrases[document])
+
+    def find_named_scheme(self, query):
+        """
+        Returns the scheme whose full name, distinctive short title or acronym appears in the query, None when no
+        scheme or more than one scheme is named
+        """
+        tokens_text = f' {" ".join(tokenize(query))} '
+        code_tokens_text = f' {" ".join(TOKEN_REGEX.findall(str(query)))} '
+        named = {self.scheme_names[document] for document in range(len(self.scheme_names))
+                 if self.is_named(document, tokens_text, code_tokens_text)}
+        return named.pop() if len(named) == 1 else None
+
+    def name_coverage(self, scheme_name, query) -> float:
+        """
+        Share of the distinctive words of the scheme name which appear in the query, 1 when its full name, distinctive
+        short title or one of its distinctive acronyms appears
+        """
+        document = self.documents[scheme_name]
+        tokens_text = f' {" ".join(tokenize(query))} '
+        if self.is_named(document, tokens_text, f' {" ".join(TOKEN_REGEX.findall(str(query)))} '):
+            return 1
+        name_tokens = self.name_tokens[document]
+        if not name_tokens:
+            return 0
+        return len(name_tokens & set(get_terms(query))) / len(name_tokens)
+
+
+def reciprocal_rank_fusion(*rankings, k=60) -> list[str]:
+    """Fuses rankings of (scheme name, score) tuples, every ranking contributes 1 / (k + rank) for its schemes"""
+    scores = Counter()
+    for ranking in rankings:
+        for rank, (scheme_name, _) in enumerate(ranking, start=1):
+            scores[scheme_name] += 1 / (k + rank)
+    return [scheme_name for scheme_name, _ in scores.most_common()]
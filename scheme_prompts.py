@@ -0,0 +1,51 @@
+import json
+import re
+from types import MappingProxyType
+
+prompts = MappingProxyType(json.load(open('./data/prompts.json')))
+all_schemes_information = json.load(open('./data/myschemes_scraped_combined.json'))
+all_schemes_information_dict = {i['scheme_name']: i for i in all_schemes_information}
+
+
+def build_specific_scheme_prompt(interested_scheme_name, interested_scheme_details, scheme_chatbot_prompt) -> (str, str):
+    """
+    Returns the details of the input specific scheme which can be used as prompt for that scheme
+    """
+    prompt = scheme_chatbot_prompt
+    if interested_scheme_details['eligibility_criteria']:
+        eligibility = interested_scheme_details['eligibility_criteria']
+
+        prompt = prompt + '\n\nScheme Name: ' + interested_scheme_name + "\n\nStart of scheme " \
+                                                                         "details\n\nEligibility_Criteria:\n\"\"\"\nApplicant may be eligible for " + interested_scheme_name + " if he/she meet the following criteria:\n" + str(
+            eligibility) + "\"\"\""
+
+    if interested_scheme_details['documents_required'] != '':
+        documents = interested_scheme_details['documents_required']
+        documents = re.sub('Documents Required\n', '', documents)
+        prompt = prompt + "\n\nDocuments Required:\n" + documents
+
+    if interested_scheme_details['benefits'] != '':
+        benefits = interested_scheme_details['benefits']
+        benefits = re.sub('Benefits\n', '', benefits)
+        prompt = prompt + "\n\nBenefits:\n" + benefits
+
+    summary = interested_scheme_details['details']
+
+    prompt = prompt + '\nEnd of scheme details.\n\n'
+    return prompt, summary
+
+
+######## built once when the catalog loads, the conversation turns only look them up
+specific_scheme_prompts = MappingProxyType(
+    {scheme_name: build_specific_scheme_prompt(scheme_name, scheme_details, prompts['scheme_chatbot_prompt'])
+     for scheme_name, scheme_details in all_schemes_information_dict.items()})
+scheme_summary_lines = MappingProxyType(
+    {scheme_name: '- ' + scheme_name + ' : ' + scheme_details['summary']
+     for scheme_name, scheme_details in all_schemes_information_dict.items()})
+
+
+def load_specific_scheme_prompt(interested_scheme_name) -> (str, str):
+    """
+    Returns the precompiled (prompt, summary) of the scheme chatbot for the scheme, empty strings for unknown schemes
+    """
+    return specific_scheme_prompts.get(interested_scheme_name, ('', ''))
@@ -1,18 +1,22 @@
-import ast
 import copy
 import datetime
-import json
 import os
-import pickle
 import re
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Callable
 
 import pytz
-from transitions import Machine
-from openai_utility.openai_utils import call_openAI_api, call_chatgpt_api
+from eligibility_index import EligibilityIndex
+from llm_output_parser import parse_llm_output, parse_scheme_filtering_output
+from embedding_providers import get_embedding_provider
+from openai_utility.openai_utils import acall_openAI_api, acall_chatgpt_api
+from prompt_budget import prompt_budget
+from scheme_index import SchemeIndex
+from scheme_lexical_index import SchemeLexicalIndex, reciprocal_rank_fusion
+from scheme_prompts import all_schemes_information, all_schemes_information_dict, load_specific_scheme_prompt, \
+    prompts, scheme_summary_lines
 
-all_schemes_information = json.load(open('./data/myschemes_scraped_combined.json'))
-all_schemes_information_dict = {i['scheme_name']: i for i in all_schemes_information}
-prompts = json.load(open('data/prompts.json'))
 
 
 async def load_scheme_name_disambiguation_prompt_myscheme(db_obj) -> str:
@@ -33,73 +37,74 @@ async def load_information_extraction_prompt(db_obj) -> str:
     return user_information_extraction_prompt
 
 
-def load_specific_scheme_prompt(interested_scheme_name, scheme_chatbot_prompt) -> (str, str):
-    """
-    Returns the details of the input specific scheme which can be used as prompt for that scheme
-    """
-    # interested_scheme_details = await get_specific_scheme_details_myscheme(engine=engine, scheme_name=interested_scheme_name)
-    interested_scheme_details = all_schemes_information_dict.get(interested_scheme_name)
-    if interested_scheme_details:
-        prompt = scheme_chatbot_prompt
-        if interested_scheme_details['eligibility_criteria']:
-            eligibility = interested_scheme_details['eligibility_criteria']
-
-            prompt = prompt + '\n\nScheme Name: ' + interested_scheme_name + "\n\nStart of scheme " \
-                                                                             "details\n\nEligibility_Criteria:\n\"\"\"\nApplicant may be eligible for " + interested_scheme_name + " if he/she meet the following criteria:\n" + str(
-                eligibility) + "\"\"\""
-
-        if interested_scheme_details['documents_required'] != '':
-            documents = interested_scheme_details['documents_required']
-            documents = re.sub('Documents Required\n', '', documents)
-            prompt = prompt + "\n\nDocuments Required:\n" + documents
-
-        if interested_scheme_details['benefits'] != '':
-            benefits = interested_scheme_details['benefits']
-            benefits = re.sub('Benefits\n', '', benefits)
-            prompt = prompt + "\n\nBenefits:\n" + benefits
-
-        summary = interested_scheme_details['details']
-
-        prompt = prompt + '\nEnd of scheme details.\n\n'
-    else:
-        prompt = ''
-        summary = ''
-    return prompt, summary
+embedding_provider = get_embedding_provider()
+search_index = SchemeIndex.load(os.getenv('SCHEME_INDEX_DIRECTORY', embedding_provider.default_index_directory))
+if search_index.embedding_model != embedding_provider.model:
+    raise ValueError(f'Scheme index was built with {search_index.embedding_model}, '
+                     f'queries are embedded with {embedding_provider.model}')
+search_index.partition_by('schemeCategory', all_schemes_information_dict)
+search_index.partition_by('schemeSubCategory', all_schemes_information_dict)
+lexical_index = SchemeLexicalIndex(all_schemes_information)
+eligibility_index = EligibilityIndex(search_index.scheme_names, all_schemes_information_dict)
+# share of the distinctive words of a scheme name which have to appear in the query to accept a lexical match
+NAME_COVERAGE_THRESHOLD = 0.6
 
 
-with open("./data/scheme_indices_eligibility.pickle", "rb") as f:
-    search_index = pickle.load(f)
+async def search_schemes(query, k, rows=None) -> list[tuple[str, float]]:
+    """Nearest schemes to the query as (scheme name, squared L2 distance), only among `rows` if given"""
+    if rows is not None and len(rows) == 0:
+        return []
+    query_vector = await embedding_provider.embed(query)
+    return search_index.search(query_vector, k=k, rows=rows)
 
 
-def get_best_matching_scheme(question, user_need_scheme_category, do_scheme_category_filtering, k=10)->list[str]:
-    exact_match_threshold = 0.3
-    score_threshold = 0.5
+async def get_best_matching_scheme(question, user_need_scheme_category, do_scheme_category_filtering, k=10,
+                                   user_profile=None) -> list[str]:
+    exact_match_threshold = search_index.exact_match_threshold
+    score_threshold = search_index.score_threshold
     best_matching_schemes = []
 
-    eligible_schemes_chunks = search_index.similarity_search_with_score(query=question, k=k)
+    ######## only the schemes of the category the user needs are ranked
+    rows = search_index.rows_with('schemeCategory', user_need_scheme_category) if do_scheme_category_filtering else None
+    ######## and of those only the schemes the user may be eligible for
+    if user_profile:
+        rows = eligibility_index.eligible_rows(user_profile, rows)
+    eligible_schemes_chunks = await search_schemes(question, k=k, rows=rows)
     if eligible_schemes_chunks:
 
-        exact_matches = [i.metadata['source'] for (i, score) in eligible_schemes_chunks if
+        exact_matches = [scheme_name for (scheme_name, score) in eligible_schemes_chunks if
                          score <= exact_match_threshold]
 
         if len(exact_matches) == 1:
             eligible_schemes = exact_matches
         else:
-            eligible_schemes = [i.metadata['source'] for (i, score) in eligible_schemes_chunks if
+            eligible_schemes = [scheme_name for (scheme_name, score) in eligible_schemes_chunks if
                                 score <= score_threshold]
-
-        ######## check if the schemes returned by the search have same scheme category
-        if do_scheme_category_filtering:
-            for eligible_scheme in eligible_schemes:
-                eligible_scheme_name = eligible_scheme
-                if user_need_scheme_category in all_schemes_information_dict.get(eligible_scheme_name)[
-                    'schemeCategory']:
-                    best_matching_schemes.append(eligible_scheme_name)
-        else:
-            best_matching_schemes = eligible_schemes
+        best_matching_schemes = eligible_schemes
     return best_matching_schemes
 
 
+async def search_named_scheme(user_input, query, k=10) -> list[str]:
+    """
+    Finds the one scheme the user asks about. A scheme named in the user input by its name, distinctive short title
+    or acronym is returned without embedding the query, earlier turns in the query do not name it. Otherwise the
+    vector and BM25 rankings are fused and the best scheme is returned which is close enough to the query or whose
+    name is mostly in the query.
+    """
+    named_scheme = lexical_index.find_named_scheme(user_input)
+    if named_scheme is not None:
+        return [named_scheme]
+
+    vector_results = await search_schemes(query, k=k)
+    lexical_results = lexical_index.search(query, k=k)
+    distances = dict(vector_results)
+    for scheme_name in reciprocal_rank_fusion(vector_results, lexical_results):
+        if distances.get(scheme_name, float('inf')) <= search_index.score_threshold or \
+                lexical_index.name_coverage(scheme_name, query) >= NAME_COVERAGE_THRESHOLD:
+            return [scheme_name]
+    return []
+
+
 def create_user_response_for_best_matching_schemes(best_matching_schemes):
     max_schemes_to_show = 5
     if len(best_matching_schemes) > 0:
@@ -136,35 +141,67 @@ user_information_extraction_prompt = prompts['user_information_extraction']
 
 
 def get_trigger_event_based_on_llm_output(llm_output):
-    if '{"Extracted_Info":' in llm_output:
-        ###### this is output from user information extraction prompt
-        trigger_condition = 'information_extraction'
+    return parse_llm_output(llm_output).trigger
 
-    elif 'ChangingScheme' in llm_output:
-        #### user is talking about different scheme, do need extraction
-        trigger_condition = 'scheme_change'
 
-    elif 'user_selected_filtered_scheme' in llm_output:
-        ####### Need to disambiguate from multiple matching schemes given to user
-        trigger_condition = 'user_selected_scheme_from_options'
+class InvalidTransitionError(Exception):
+    pass
 
-    else:
-        #### this is a specific scheme conversation
-        trigger_condition = 'continue_scheme_conversation'
-    return trigger_condition
+
+@dataclass(frozen=True)
+class FSMTransition:
+    dest: str
+    conditions: tuple
+    after: Callable
 
 
 class scheme_chatbot_fsm():
+    """
+    State machine of the scheme chatbot, one per chat turn. Its transitions are compiled once into
+    scheme_chatbot_transition_table, which every turn dispatches its trigger against.
+    """
     states = ['user_information_extraction', 'specific_scheme_name_disambiguation', 'specific_scheme_conversation']
+    # tried in this order, the first transition of the trigger and source whose conditions are all met is taken
+    transitions = [
+        dict(trigger='information_extraction', source='user_information_extraction',
+             dest='specific_scheme_name_disambiguation',
+             conditions=['check_specific_need_or_specific_scheme', 'check_if_multiple_schemes_found'],
+             after='update_user_response_and_next_prompt_for_multiple_matching_schemes'),
+        dict(trigger='information_extraction', source='user_information_extraction',
+             dest='specific_scheme_conversation',
+             conditions=['check_specific_need_or_specific_scheme', 'check_if_single_scheme_found'],
+             after='update_user_response_and_next_prompt_for_single_matching_schemes'),
+        dict(trigger='user_selected_scheme_from_options', source='specific_scheme_name_disambiguation',
+             dest='specific_scheme_conversation',
+             conditions=['check_if_single_scheme_selected_from_options'],
+             after='update_user_response_and_next_prompt_for_single_matching_schemes'),
+        dict(trigger='user_selected_scheme_from_options', source='specific_scheme_name_disambiguation',
+             dest='specific_scheme_name_disambiguation',
+             conditions=['check_if_ambiguous_scheme_selected_from_options'],
+             after='update_user_response_and_next_prompt_for_ambiguous_scheme_selection'),
+        dict(trigger='scheme_change', source='specific_scheme_name_disambiguation',
+             dest='user_information_extraction',
+             after='request_user_need_extraction_after_scheme_change'),
+        dict(trigger='scheme_change', source='specific_scheme_conversation',
+             dest='user_information_extraction',
+             after='request_user_need_extraction_after_scheme_change'),
+        dict(trigger='continue_scheme_conversation', source='specific_scheme_conversation',
+             dest='specific_scheme_conversation',
+             after='update_user_response_and_next_prompt_for_specific_scheme_continuation'),
+        dict(trigger='continue_scheme_conversation', source='specific_scheme_name_disambiguation',
+             dest='specific_scheme_name_disambiguation',
+             after='update_user_response_and_next_prompt_for_ambiguous_scheme_selection'),
+    ]
 
     def __init__(self, wake_up_state, current_scheme_name, llm_output, user_input, current_prompt,
                  current_scheme_conversation_summary):
-        self.machine = Machine(model=self, states=scheme_chatbot_fsm.states, initial=wake_up_state)
+        self.state = wake_up_state
         self.current_scheme_name = current_scheme_name
         self.user_response = ''
         self.scheme_search_result = None
         self.clarifying_question = None
         self.llm_output = llm_output
+        self.parsed_output = parse_llm_output(llm_output)
         self.llm_output_logging = llm_output
         self.user_information_dict = None
         self.user_input = user_input
@@ -173,74 +210,39 @@ class scheme_chatbot_fsm():
         self.next_prompt = ''
         self.next_scheme_name = ''
         self.search_model = 'gpt3'
-
-        self.machine.add_transition(trigger='information_extraction',
-                                    source='user_information_extraction',
-                                    dest='specific_scheme_name_disambiguation',
-                                    conditions=['check_specific_need_or_specific_scheme',
-                                                'check_if_multiple_schemes_found'],
-                                    after=self.update_user_response_and_next_prompt_for_multiple_matching_schemes)
-
-        self.machine.add_transition(trigger='information_extraction',
-                                    source='user_information_extraction',
-                                    dest='specific_scheme_conversation',
-                                    conditions=['check_specific_need_or_specific_scheme',
-                                                'check_if_single_scheme_found'],
-                                    after=self.update_user_response_and_next_prompt_for_single_matching_schemes)
-
-        self.machine.add_transition(trigger='information_extraction',
-                                    source='user_information_extraction',
-                                    dest='user_information_extraction',
-                                    conditions=['check_specific_need_or_specific_scheme', 'check_if_no_schemes_found'],
-                                    after=self.update_user_response_and_next_prompt_for_no_matching_schemes)
-
-        self.machine.add_transition(trigger='information_extraction',
-                                    source='user_information_extraction',
-                                    dest='user_information_extraction',
-                                    conditions=['check_specific_need_or_specific_scheme',
-                                                'check_if_more_than_5_matching_scheme_found'],
-                                    after=self.update_user_response_and_next_prompt_for_multiple_matching_schemes)
-
-        self.machine.add_transition(trigger='user_selected_scheme_from_options',
-                                    source='specific_scheme_name_disambiguation',
-                                    dest='specific_scheme_conversation',
-                                    conditions=['check_if_single_scheme_selected_from_options'],
-                                    after=self.update_user_response_and_next_prompt_for_single_matching_schemes)
-
-        self.machine.add_transition(trigger='user_selected_scheme_from_options',
-                                    source='specific_scheme_name_disambiguation',
-                                    dest='specific_scheme_name_disambiguation',
-                                    conditions=['check_if_ambiguous_scheme_selected_from_options'],
-                                    after=self.update_user_response_and_next_prompt_for_ambiguous_scheme_selection)
-
-        self.machine.add_transition(trigger='scheme_change',
-                                    source='specific_scheme_name_disambiguation',
-                                    dest='user_information_extraction',
-                                    after=self.perform_user_need_extraction_after_scheme_change)
-
-        self.machine.add_transition(trigger='scheme_change',
-                                    source='specific_scheme_conversation',
-                                    dest='user_information_extraction',
-                                    after=self.perform_user_need_extraction_after_scheme_change)
-
-        self.machine.add_transition(trigger='continue_scheme_conversation',
-                                    source='specific_scheme_conversation',
-                                    dest='specific_scheme_conversation',
-                                    after=self.update_user_response_and_next_prompt_for_specific_scheme_continuation)
-
-        self.machine.add_transition(trigger='continue_scheme_conversation',
-                                    source='specific_scheme_name_disambiguation',
-                                    dest='specific_scheme_name_disambiguation',
-                                    after=self.update_user_response_and_next_prompt_for_ambiguous_scheme_selection)
+        self.user_need_extraction_requested = False
+        self.memory_cleared = False
+
+    def trigger(self, trigger_condition) -> bool:
+        """Takes the transition for the trigger from the current state, returns whether a transition was taken"""
+        transitions = scheme_chatbot_transition_table.get((trigger_condition, self.state))
+        if transitions is None:
+            raise InvalidTransitionError(f"Can't trigger event {trigger_condition} from state {self.state}!")
+        for transition in transitions:
+            if all(condition(self) for condition in transition.conditions):
+                self.state = transition.dest
+                transition.after(self)
+                return True
+        return False
+
+    async def process_trigger(self, trigger_condition):
+        """
+        Triggers the transition for the llm output. Work that needs awaiting is done outside of the state machine: the
+        scheme search used by the conditions is done before triggering and the user need extraction requested by a
+        scheme change is done after the transition.
+        """
+        if trigger_condition == 'information_extraction' and self.state == 'user_information_extraction' and \
+                self.check_specific_need_or_specific_scheme():
+            await self.search_scheme_for_user_need()
+        self.trigger(trigger_condition)
+        if self.user_need_extraction_requested:
+            self.user_need_extraction_requested = False
+            await self.perform_user_need_extraction_after_scheme_change()
 
     def check_specific_need_or_specific_scheme(self) -> bool:
         #### check if user has expressed a specific need or asking for specific scheme
         try:
-            # output = output.replace("'", "\'")
-
-            user_information_str = re.sub(r'(^.*)({\"Extracted_Info.*)', r'\2', self.llm_output, flags=re.DOTALL)
-            # user_information_dict = json.loads(user_information_str)
-            self.user_information_dict = ast.literal_eval(user_information_str)
+            self.user_information_dict = self.parsed_output.extracted_info
 
             if self.user_information_dict['User_Message'] == '':
                 ##### User has provided all the information needed for finding best scheme
@@ -257,24 +259,18 @@ class scheme_chatbot_fsm():
 
     def check_if_multiple_schemes_less_than_5_found(self) -> bool:
         #### Return whether multiple schemes have been found for user need
-        if not self.scheme_search_result:
-            self.search_scheme_for_user_need()
         if len(self.scheme_search_result) > 1 and len(self.scheme_search_result) <= 5:
             return True
         else:
             return False
     def check_if_multiple_schemes_found(self) -> bool:
         #### Return whether multiple schemes have been found for user need
-        if not self.scheme_search_result:
-            self.search_scheme_for_user_need()
         if len(self.scheme_search_result) > 1:
             return True
         else:
             return False
     def check_if_single_scheme_found(self) -> bool:
         #### Return whether unique scheme has been found for user need
-        if not self.scheme_search_result:
-            self.search_scheme_for_user_need()
         if len(self.scheme_search_result) == 1:
             self.next_scheme_name = self.scheme_search_result[0]
             return True
@@ -284,9 +280,7 @@ class scheme_chatbot_fsm():
     def check_if_single_scheme_selected_from_options(self) -> bool:
         ###### this is response of user choosing one scheme from multiple recommendations
         try:
-            output = self.llm_output.replace("'", "\'")
-            user_information_str = re.sub(r'(^.*)({\'user_selected_filtered_scheme.*)', r'\2', output, flags=re.DOTALL)
-            user_information_dict = ast.literal_eval(user_information_str)
+            user_information_dict = self.parsed_output.selected_scheme
 
             if user_information_dict['user_selected_filtered_scheme'] == 'MULTIPLE_MATCHES':
                 return False
@@ -301,9 +295,7 @@ class scheme_chatbot_fsm():
     def check_if_ambiguous_scheme_selected_from_options(self) -> bool:
         ###### this is response of user choosing one scheme from multiple recommendations
         try:
-            output = self.llm_output.replace("'", "\'")
-            user_information_str = re.sub(r'(^.*)({\'user_selected_filtered_scheme.*)', r'\2', output, flags=re.DOTALL)
-            user_information_dict = ast.literal_eval(user_information_str)
+            user_information_dict = self.parsed_output.selected_scheme
 
             if user_information_dict['user_selected_filtered_scheme'] == 'MULTIPLE_MATCHES':
                 return True
@@ -317,39 +309,36 @@ class scheme_chatbot_fsm():
 
     def check_if_no_schemes_found(self) -> bool:
         #### Return whether multiple schemes have been found for user need
-        if not self.scheme_search_result:
-            self.search_scheme_for_user_need()
         if self.scheme_search_result is None:
             return True
         else:
             return False
 
     def check_if_more_than_5_matching_scheme_found(self) -> bool:
-        if not self.scheme_search_result:
-            self.search_scheme_for_user_need()
         if len(self.scheme_search_result) > 5:
             return True
         else:
             return False
 
-    def perform_user_need_extraction_after_scheme_change(self):
+    def request_user_need_extraction_after_scheme_change(self):
+        self.user_need_extraction_requested = True
+
+    async def perform_user_need_extraction_after_scheme_change(self):
         prompt = user_information_extraction_prompt
         prompt = prompt + "\nUser: " + self.user_input + "\nBot: "
         prompts_seperator = '\n\n' + '-' * 100 + '\n\n'
         self.current_prompt = '2 prompts were used.' + prompts_seperator + self.current_prompt + prompts_seperator + prompt
-        output = call_openAI_api(prompt)
+        output = await acall_openAI_api(prompt)
         self.llm_output = output
+        self.parsed_output = parse_llm_output(output)
         self.llm_output_logging = self.llm_output + prompts_seperator + copy.deepcopy(output)
         self.current_scheme_conversation_summary = ''  ## clear memory as we are restarting the conversation
-        trigger_condition = get_trigger_event_based_on_llm_output(output)
-        self.trigger(trigger_condition)
+        self.memory_cleared = True
+        trigger_condition = self.parsed_output.trigger
+        await self.process_trigger(trigger_condition)
 
     def get_scheme_summaries(self, scheme_names: list) -> str:
-        summary_list = []
-        for scheme in scheme_names:
-            scheme_summary = '- ' + scheme + ' : ' + all_schemes_information_dict.get(scheme)['summary']
-            summary_list.append(scheme_summary)
-        return '\n'.join(summary_list)
+        return '\n'.join(scheme_summary_lines[scheme] for scheme in scheme_names)
 
     def get_user_inputs_from_conversation_history(self) -> str:
         if self.current_scheme_conversation_summary.strip() != '':
@@ -359,24 +348,31 @@ class scheme_chatbot_fsm():
         else:
             return ''
 
-    def search_scheme_for_user_need(self):
+    async def search_scheme_for_user_need(self):
         do_scheme_category_filtering = True
         k = 10
-        score_threshold = 0.5
+        score_threshold = search_index.score_threshold
         if self.user_information_dict['Extracted_Info']['Specific_Scheme_Information'] == "Yes":
             do_scheme_category_filtering = False
             k = 1
 
         query = self.get_user_inputs_from_conversation_history() + self.user_input
-        faiss_search_results = search_index.similarity_search_with_score(query=query, k=k)
-        faiss_filtered_schemes = [i.metadata['source'] for (i, score) in faiss_search_results if
-                                  score <= score_threshold]
-
-        faiss_filtered_schemes_with_summary = self.get_scheme_summaries(faiss_filtered_schemes)
         if k == 1:
-            self.scheme_search_result = faiss_filtered_schemes
+            self.scheme_search_result = await search_named_scheme(self.user_input, query)
         else:
+            user_profile = self.user_information_dict['Extracted_Info'].get('User_Profile')
             if os.environ.get('SCHEME_SEARCH_FILTERING') == 'cot_filtering':
+                rows = eligibility_index.eligible_rows(user_profile) if user_profile else None
+                faiss_search_results = await search_schemes(query, k=k, rows=rows)
+                faiss_filtered_schemes = [scheme_name for (scheme_name, score) in faiss_search_results if
+                                          score <= score_threshold]
+                if len(faiss_filtered_schemes) <= 1:
+                    ######## nothing left to choose between, the filtering prompt is not needed
+                    self.scheme_search_result = faiss_filtered_schemes
+                    self.clarifying_question = None
+                    return
+
+                faiss_filtered_schemes_with_summary = self.get_scheme_summaries(faiss_filtered_schemes)
                 #### perform CoT filtering on filtered schemes
                 prompts_seperator = '\n\n' + '-' * 100 + '\n\n'
                 if self.search_model == 'chatgpt':
@@ -386,7 +382,7 @@ class scheme_chatbot_fsm():
                     messages = [{"role": "system", "content": chatgpt_system_prompt},
                                 {"role": "user", "content": user_inputs}]
                     self.current_prompt = '2 prompts were used.' + prompts_seperator + self.current_prompt + prompts_seperator + chatgpt_system_prompt
-                    scheme_filtering_llm_response = call_chatgpt_api(messages, max_tokens=1024)
+                    scheme_filtering_llm_response = await acall_chatgpt_api(messages, max_tokens=1024)
                 else:
 
                     prompt_and_schemes = prompts[
@@ -395,7 +391,7 @@ class scheme_chatbot_fsm():
                              self.current_scheme_conversation_summary.strip() + "\n\nUser: " + self.user_input + '''\n"""\n\nBot:'''
 
                     self.current_prompt = '2 prompts were used.' + prompts_seperator + self.current_prompt + prompts_seperator + prompt_and_schemes
-                    scheme_filtering_llm_response = call_openAI_api(prompt, max_tokens=1024)
+                    scheme_filtering_llm_response = await acall_openAI_api(prompt, max_tokens=1024)
 
 
                 self.llm_output_logging = self.llm_output + prompts_seperator + copy.deepcopy(
@@ -403,8 +399,8 @@ class scheme_chatbot_fsm():
                 self.parse_scheme_filtering_llm_output(scheme_filtering_llm_response)
             else:
                 user_expressed_scheme_category = self.user_information_dict['Extracted_Info']['Scheme_Category']
-                self.scheme_search_result = get_best_matching_scheme(self.user_input, user_expressed_scheme_category,
-                                                                     do_scheme_category_filtering, k)
+                self.scheme_search_result = await get_best_matching_scheme(self.user_input, user_expressed_scheme_category,
+                                                                     do_scheme_category_filtering, k, user_profile)
 
     def update_user_response_and_next_prompt_for_ambiguous_scheme_selection(self):
         ### user has not selected one name from options then ask user for more clarity
@@ -440,8 +436,7 @@ class scheme_chatbot_fsm():
         bot_response = 'I think ' + single_best_scheme + ' best fits your needs.'
         scheme_summary = all_schemes_information_dict.get(single_best_scheme)['summary']
         self.user_response = bot_response + scheme_summary + '\nWhat would you like to know more about this scheme?'
-        self.next_prompt, scheme_summary = load_specific_scheme_prompt(single_best_scheme,
-                                                                       prompts['scheme_chatbot_prompt'])
+        self.next_prompt, scheme_summary = load_specific_scheme_prompt(single_best_scheme)
         self.next_scheme_name = single_best_scheme
 
     def update_user_response_and_next_prompt_for_no_matching_schemes(self):
@@ -455,20 +450,17 @@ class scheme_chatbot_fsm():
         bot_response = 'I think ' + single_best_scheme + ' best fits your needs.'
         scheme_summary = all_schemes_information_dict.get(single_best_scheme)['summary']
         self.user_response = bot_response + scheme_summary + '\nWhat would you like to know more about this scheme?'
-        self.next_prompt, scheme_summary = load_specific_scheme_prompt(single_best_scheme,
-                                                                       prompts['scheme_chatbot_prompt'])
+        self.next_prompt, scheme_summary = load_specific_scheme_prompt(single_best_scheme)
         self.next_scheme_name = single_best_scheme
 
     def update_user_response_and_next_prompt_for_specific_scheme_continuation(self):
-        if "user_message" in self.llm_output:
-            user_message_str = re.sub(r'(^.*)({\"user_message.*)', r'\2', self.llm_output, flags=re.DOTALL)
+        if self.parsed_output.mentions_user_message:
             try:
-                user_messasge_dict = ast.literal_eval(user_message_str)
-                bot_response = user_messasge_dict['user_message']
+                bot_response = self.parsed_output.user_message['user_message']
             except:
-                bot_response = re.sub(r'{\"user_message\"\:\s+\"', '', user_message_str)
-        elif "- Lets think step by step" in self.llm_output:
-            bot_response = self.llm_output.split('\n-')[-1].strip()
+                bot_response = self.parsed_output.user_message_fallback
+        elif self.parsed_output.thinks_step_by_step:
+            bot_response = self.parsed_output.last_step
         else:
             bot_response = self.llm_output
         self.user_response = bot_response
@@ -476,21 +468,10 @@ class scheme_chatbot_fsm():
         self.next_scheme_name = self.current_scheme_name
 
     def parse_scheme_filtering_llm_output(self, scheme_filtering_llm_response):
-        clarifying_questions = re.findall(r'{\s*\'user_message\':.*}', scheme_filtering_llm_response, re.DOTALL)
-        try:
-            self.clarifying_question = ast.literal_eval(clarifying_questions[-1])['user_message']
-        except:
+        self.clarifying_question, self.scheme_search_result = \
+            parse_scheme_filtering_output(scheme_filtering_llm_response)
+        if self.clarifying_question is None or self.scheme_search_result is None:
             print("Error parsing scheme search LLM output")
-            self.clarifying_question = None
-
-        scheme_search_result_str = \
-            re.search(r'relevant_schemes_list.*(\[.*\])', scheme_filtering_llm_response).groups()[0]
-        try:
-            scheme_search_result_str = re.sub(', “', ', "“', scheme_search_result_str)
-            self.scheme_search_result = ast.literal_eval(scheme_search_result_str)
-        except:
-            print("Error parsing scheme search LLM output")
-            self.scheme_search_result = None
 
     def concatenate_user_inputs(self):
         user_inputs = []
@@ -502,18 +483,53 @@ class scheme_chatbot_fsm():
         return ' '.join(user_inputs)
 
 
+def compile_transition_table(model_class, transitions) -> MappingProxyType:
+    """{(trigger, source): transitions in order} with the conditions and callbacks resolved to the methods of the class"""
+    table = {}
+    for transition in transitions:
+        table.setdefault((transition['trigger'], transition['source']), []).append(FSMTransition(
+            dest=transition['dest'],
+            conditions=tuple(getattr(model_class, condition) for condition in transition.get('conditions', [])),
+            after=getattr(model_class, transition['after'])))
+    return MappingProxyType({key: tuple(value) for key, value in table.items()})
+
+
+scheme_chatbot_transition_table = compile_transition_table(scheme_chatbot_fsm, scheme_chatbot_fsm.transitions)
+
+
+def split_prompt_sections(prompt) -> (str, str):
+    """Splits a scheme chatbot prompt into the instructions and the scheme details"""
+    scheme_chatbot_prompt = prompts['scheme_chatbot_prompt']
+    if prompt.startswith(scheme_chatbot_prompt):
+        return scheme_chatbot_prompt, prompt[len(scheme_chatbot_prompt):]
+    return prompt, ''
+
+
 async def get_scheme_fsm_bot_response(current_prompt, current_state, current_scheme_conversation_summary, user_input,
                                       db_obj, current_conversation_chunk_id, current_scheme_name, user_id,
-                                      bot_preference):
-    """Gets response for user's input. It also returns updated prompt and updated conversation """
+                                      bot_preference, rolling_summary=''):
+    """
+    Gets response for user's input. It also returns updated prompt and updated conversation. `rolling_summary` is the
+    summary of the turns which were compressed out of the conversation history (see conversation_summarizer.py).
+    """
 
     if current_prompt == '':
         current_prompt = user_information_extraction_prompt
     end_of_conversation = '\n\"\"\"\n\nFinally,\n\n'
     conversation_history_prefix = "\nConversation History:\n\"\"\""
-    prompt = current_prompt + "\nConversation History:\n\"\"\"" + current_scheme_conversation_summary.strip() + "\n\nUser: " + user_input + end_of_conversation + "Bot: "
+    rolling_summary_prefix = "Summary of the earlier conversation:\n"
+    max_tokens = 1024
+    instructions, scheme_details = split_prompt_sections(current_prompt)
+    user_turn = "\n\nUser: " + user_input + end_of_conversation + "Bot: "
+    rolling_summary_section = rolling_summary_prefix + rolling_summary.strip() + '\n\n' if rolling_summary else ''
+    conversation_history, _ = prompt_budget.fit_history(
+        current_state, current_scheme_conversation_summary, max_tokens,
+        instructions=instructions + conversation_history_prefix, scheme_details=scheme_details,
+        rolling_summary=rolling_summary_section, user_turn=user_turn)
+    prompt = current_prompt + conversation_history_prefix + rolling_summary_section + conversation_history.strip() + \
+             user_turn
     prompt = re.sub(r'\n{3,}', '\n\n', prompt)
-    output = call_openAI_api(prompt.strip(), max_tokens=1024)
+    output = await acall_openAI_api(prompt.strip(), max_tokens=max_tokens)
 
     machine_fsm = scheme_chatbot_fsm(wake_up_state=current_state, current_scheme_name=current_scheme_name,
                                      llm_output=output, user_input=user_input, current_prompt=current_prompt,
@@ -521,13 +537,16 @@ async def get_scheme_fsm_bot_response(current_prompt, current_state, current_sch
 
     try:
         trigger_condition = get_trigger_event_based_on_llm_output(output)
-        machine_fsm.trigger(trigger_condition)
+        await machine_fsm.process_trigger(trigger_condition)
         bot_response = machine_fsm.user_response
         next_prompt_type = machine_fsm.state
         next_prompt = machine_fsm.next_prompt
         scheme_name = machine_fsm.next_scheme_name
         output = machine_fsm.llm_output_logging
         current_scheme_conversation_summary = machine_fsm.current_scheme_conversation_summary
+        memory_cleared = machine_fsm.memory_cleared
+        if memory_cleared:
+            rolling_summary = ''
         prompt = machine_fsm.current_prompt + conversation_history_prefix + current_scheme_conversation_summary.strip() + "\n\nUser: " + user_input + end_of_conversation + "Bot: "
         new_conversation_chunk_id = current_conversation_chunk_id
     except:
@@ -538,24 +557,25 @@ async def get_scheme_fsm_bot_response(current_prompt, current_state, current_sch
         output = output
         current_scheme_conversation_summary = current_scheme_conversation_summary
         new_conversation_chunk_id = current_conversation_chunk_id
+        memory_cleared = False
 
-    window_size = 19
-    current_scheme_conversation_summary = '\nUser:'.join(
-        current_scheme_conversation_summary.split('\nUser:')[:window_size])
+    history_user_input = user_input.replace("'", "")
+    history_bot_response = bot_response.replace("'", "")
+    current_scheme_conversation_summary = prompt_budget.trim_history(
+        current_scheme_conversation_summary + "\n\nUser: " + history_user_input + "\nBot: " + history_bot_response)
 
-    current_scheme_conversation_summary = current_scheme_conversation_summary + "\n\nUser: " + user_input + "\nBot: " + bot_response
-
-    if new_conversation_chunk_id == current_conversation_chunk_id and new_conversation_chunk_id != '':
-        await db_obj.update_user_prompt_with_new_scheme(new_conversation_chunk_id, scheme_name, next_prompt_type)
-    else:
+    if new_conversation_chunk_id != current_conversation_chunk_id or new_conversation_chunk_id == '':
         import uuid
         new_conversation_chunk_id = uuid.uuid4().hex
+        rolling_summary = ''
         await db_obj.insert_user_prompt(chat_id=user_id, conversation_chunk_id=new_conversation_chunk_id,
                                         scheme_name=scheme_name,
                                         created_at=datetime.datetime.now(pytz.UTC),
                                         updated_at=datetime.datetime.now(pytz.UTC),
-                                        conversation_summary=current_scheme_conversation_summary,
                                         bot_preference=bot_preference,
                                         prompt_type=next_prompt_type
                                         )
-    return bot_response, prompt, new_conversation_chunk_id, scheme_name, current_scheme_conversation_summary, next_prompt_type, next_prompt, output
+    # the turn is appended to the conversation, the history written before is never rewritten
+    await db_obj.append_conversation_turn(new_conversation_chunk_id, scheme_name, next_prompt_type, history_user_input,
+                                          history_bot_response, clear_history=memory_cleared)
+    return bot_response, prompt, new_conversation_chunk_id, scheme_name, current_scheme_conversation_summary, next_prompt_type, next_prompt, output, rolling_summary
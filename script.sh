@@ -1,2 +1,3 @@
+/opt/conda/bin/python database.py
 /opt/conda/bin/uvicorn main:app --host 0.0.0.0 --port 8080  --workers 1
-tail -f /dev/null
\ No newline at end of file
+tail -f /dev/null
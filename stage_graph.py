@@ -0,0 +1,44 @@
+import asyncio
+import time
+
+
+class StageGraph:
+    """
+    Runs async stages as soon as the stages they depend on have finished, so that independent stages run concurrently.
+    A stage can only depend on stages added before it, which keeps the graph acyclic. The wall clock time of every
+    stage, not counting the time spent waiting for its dependencies, is kept in `timings`.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+        self.timings = {}
+
+    def add(self, name, coroutine_function, *dependencies):
+        """Schedules `coroutine_function()` to run after all `dependencies`, which are names of added stages"""
+        for dependency in dependencies:
+            if dependency not in self.tasks:
+                raise KeyError(f'Stage {name} depends on unknown stage {dependency}')
+        dependency_tasks = [self.tasks[dependency] for dependency in dependencies]
+        self.tasks[name] = asyncio.create_task(self.run_stage(name, coroutine_function, dependency_tasks))
+        return self.tasks[name]
+
+    async def run_stage(self, name, coroutine_function, dependency_tasks):
+        await asyncio.gather(*dependency_tasks)
+        started_at = time.perf_counter()
+        try:
+            return await coroutine_function()
+        finally:
+            self.timings[name] = time.perf_counter() - started_at
+
+    async def result(self, name):
+        return await self.tasks[name]
+
+    async def wait(self):
+        """Waits for all the stages added so far, the first failure is raised after every stage has finished"""
+        results = await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    def format_timings(self) -> str:
+        return ', '.join(f'{name}={seconds * 1000:.0f}ms' for name, seconds in self.timings.items())
@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the modules import each other from the repository root and load ./data from it, like the API in its WORKDIR
+sys.path.insert(0, ROOT_DIRECTORY)
+os.chdir(ROOT_DIRECTORY)
@@ -0,0 +1,30 @@
+import pytest
+
+from data.benchmark_llm_output_parser import CORPUS_PATH, find_mismatches, get_fuzzed_outputs, load_corpus
+from llm_output_parser import parse_llm_output, parse_scheme_filtering_output
+
+
+@pytest.fixture(scope='module')
+def corpus():
+    return load_corpus([CORPUS_PATH])
+
+
+def test_corpus_is_parsed_like_before(corpus):
+    assert find_mismatches(corpus) == []
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_fuzzed_corpus_is_parsed_like_before(corpus, seed):
+    assert find_mismatches(get_fuzzed_outputs(corpus, variants=200, seed=seed)) == []
+
+
+def test_payload_after_last_marker():
+    parsed_output = parse_llm_output(' {"Extracted_Info": {}, "User_Message": "a"}\n'
+                                     '{"Extracted_Info": {"Specific_Need_Expressed": "Yes"}, "User_Message": ""}')
+    assert parsed_output.trigger == 'information_extraction'
+    assert parsed_output.extracted_info == {'Extracted_Info': {'Specific_Need_Expressed': 'Yes'}, 'User_Message': ''}
+
+
+def test_scheme_filtering_output_without_relevant_schemes_list():
+    with pytest.raises(ValueError):
+        parse_scheme_filtering_output("{'user_message': 'Which scheme?'}")
@@ -0,0 +1,131 @@
+from dataclasses import replace
+
+import pytest
+
+import scheme_v1_prompt_engineering
+from scheme_prompts import all_schemes_information
+from scheme_v1_prompt_engineering import InvalidTransitionError, scheme_chatbot_fsm
+
+UIE, DISAMBIGUATION, CONVERSATION = scheme_chatbot_fsm.states
+FIRST_SCHEME, SECOND_SCHEME = all_schemes_information[0]['scheme_name'], all_schemes_information[1]['scheme_name']
+NEED_EXPRESSED = ' {"Extracted_Info": {"Specific_Need_Expressed":"Yes","Scheme_Category":"Education & Learning",' \
+                 '"Specific_Scheme_Information": "No"},"User_Message" :""}'
+NEED_MISSING = ' {"Extracted_Info": {"Specific_Need_Expressed":"No","Specific_Scheme_Information": "No"},' \
+               '"User_Message" :"Please elaborate on what help you need."}'
+SCHEME_SELECTED = " {'user_selected_filtered_scheme': '" + FIRST_SCHEME + "'}"
+MULTIPLE_SELECTED = " {'user_selected_filtered_scheme': 'MULTIPLE_MATCHES'}"
+ANSWER = ' {"user_message": "You can apply online on the scheme portal."}'
+
+# transitions of the FSM when it was built with transitions.Machine, the table has to behave the same
+MACHINE_TRANSITIONS = scheme_chatbot_fsm.transitions[:2] + [
+    dict(trigger='information_extraction', source='user_information_extraction', dest='user_information_extraction',
+         conditions=['check_specific_need_or_specific_scheme', 'check_if_no_schemes_found'],
+         after='update_user_response_and_next_prompt_for_no_matching_schemes'),
+    dict(trigger='information_extraction', source='user_information_extraction', dest='user_information_extraction',
+         conditions=['check_specific_need_or_specific_scheme', 'check_if_more_than_5_matching_scheme_found'],
+         after='update_user_response_and_next_prompt_for_multiple_matching_schemes'),
+] + scheme_chatbot_fsm.transitions[2:]
+
+# (state, trigger, llm output, scheme search result, index of the transition expected to be taken, None if no
+# transition is taken, InvalidTransitionError or the exception raised by a condition)
+CASES = [
+    (UIE, 'information_extraction', NEED_EXPRESSED, [FIRST_SCHEME, SECOND_SCHEME], 0),
+    # more than 5 schemes are multiple schemes, the Machine transition for them was never taken
+    (UIE, 'information_extraction', NEED_EXPRESSED, [FIRST_SCHEME] * 6, 0),
+    (UIE, 'information_extraction', NEED_EXPRESSED, [FIRST_SCHEME], 1),
+    # a search without result fails in the conditions of the first transition, the Machine transition for it was
+    # never taken
+    (UIE, 'information_extraction', NEED_EXPRESSED, None, TypeError),
+    (UIE, 'information_extraction', NEED_EXPRESSED, [], None),
+    (UIE, 'information_extraction', NEED_MISSING, [FIRST_SCHEME], None),
+    (UIE, 'information_extraction', ' {"Extracted_Info": {"Specific_Need_Expressed":', [FIRST_SCHEME], None),
+    (DISAMBIGUATION, 'user_selected_scheme_from_options', SCHEME_SELECTED, None, 2),
+    (DISAMBIGUATION, 'user_selected_scheme_from_options', MULTIPLE_SELECTED, None, 3),
+    (DISAMBIGUATION, 'user_selected_scheme_from_options', " {'user_selected_filtered_scheme': ", None, 3),
+    (DISAMBIGUATION, 'scheme_change', ' ChangingScheme', None, 4),
+    (CONVERSATION, 'scheme_change', ' ChangingScheme', None, 5),
+    (CONVERSATION, 'continue_scheme_conversation', ANSWER, None, 6),
+    (CONVERSATION, 'continue_scheme_conversation', '\n- Lets think step by step.\n- Are you a farmer?', None, 6),
+    (DISAMBIGUATION, 'continue_scheme_conversation', ' Which one do you mean?', None, 7),
+    (UIE, 'user_selected_scheme_from_options', SCHEME_SELECTED, None, InvalidTransitionError),
+    (UIE, 'scheme_change', ' ChangingScheme', None, InvalidTransitionError),
+    (UIE, 'continue_scheme_conversation', ANSWER, None, InvalidTransitionError),
+    (DISAMBIGUATION, 'information_extraction', NEED_EXPRESSED, [FIRST_SCHEME], InvalidTransitionError),
+    (CONVERSATION, 'information_extraction', NEED_EXPRESSED, [FIRST_SCHEME], InvalidTransitionError),
+    (CONVERSATION, 'user_selected_scheme_from_options', SCHEME_SELECTED, None, InvalidTransitionError),
+]
+
+
+def create_fsm(state, llm_output, scheme_search_result):
+    fsm = scheme_chatbot_fsm(wake_up_state=state, current_scheme_name=FIRST_SCHEME + '||' + SECOND_SCHEME,
+                             llm_output=llm_output, user_input='I need help', current_prompt='Current prompt',
+                             current_scheme_conversation_summary='')
+    fsm.scheme_search_result = scheme_search_result
+    return fsm
+
+
+def get_outcome(fsm, trigger):
+    """What a chat turn reads from the FSM after the trigger, the name of the exception if it raises"""
+    try:
+        taken = trigger()
+    except Exception as e:
+        return type(e).__name__
+    return (taken, fsm.state, fsm.user_response, fsm.next_prompt, fsm.next_scheme_name,
+            fsm.user_need_extraction_requested)
+
+
+@pytest.fixture
+def taken_transitions(monkeypatch):
+    """Indices of the transitions taken, recorded by the callbacks of the transition table"""
+    taken_transitions = []
+    indices = {}
+    for index, transition in enumerate(scheme_chatbot_fsm.transitions):
+        indices.setdefault((transition['trigger'], transition['source']), []).append(index)
+    transition_table = {key: tuple(replace(transition, after=lambda fsm, index=index, after=transition.after: (
+        taken_transitions.append(index), after(fsm))) for index, transition in zip(indices[key], transitions))
+        for key, transitions in scheme_v1_prompt_engineering.scheme_chatbot_transition_table.items()}
+    monkeypatch.setattr(scheme_v1_prompt_engineering, 'scheme_chatbot_transition_table', transition_table)
+    return taken_transitions
+
+
+@pytest.mark.parametrize('state, trigger, llm_output, scheme_search_result, expected', CASES)
+def test_transition(taken_transitions, state, trigger, llm_output, scheme_search_result, expected):
+    fsm = create_fsm(state, llm_output, scheme_search_result)
+    if isinstance(expected, type):
+        with pytest.raises(expected):
+            fsm.trigger(trigger)
+        assert fsm.state == state
+        return
+    assert fsm.trigger(trigger) == (expected is not None)
+    assert taken_transitions == ([] if expected is None else [expected])
+    if expected is None:
+        assert fsm.state == state
+    else:
+        assert fsm.state == scheme_chatbot_fsm.transitions[expected]['dest']
+
+
+def test_every_transition_is_taken():
+    taken = {expected for *_, expected in CASES if isinstance(expected, int)}
+    assert taken == set(range(len(scheme_chatbot_fsm.transitions)))
+
+
+def test_every_trigger_and_state_has_a_case():
+    triggers = {transition['trigger'] for transition in scheme_chatbot_fsm.transitions}
+    assert {(state, trigger) for state, trigger, *_ in CASES} == {
+        (state, trigger) for state in scheme_chatbot_fsm.states for trigger in triggers}
+
+
+@pytest.mark.parametrize('state, trigger, llm_output, scheme_search_result, expected', CASES)
+def test_same_outcome_as_machine(state, trigger, llm_output, scheme_search_result, expected):
+    transitions = pytest.importorskip('transitions')
+    fsm = create_fsm(state, llm_output, scheme_search_result)
+    outcome = get_outcome(fsm, lambda: fsm.trigger(trigger))
+
+    machine_fsm = create_fsm(state, llm_output, scheme_search_result)
+    # the FSM has its own trigger method, the event is triggered on the machine
+    machine = transitions.Machine(model=machine_fsm, states=scheme_chatbot_fsm.states,
+                                  transitions=MACHINE_TRANSITIONS, initial=state)
+    machine_outcome = get_outcome(machine_fsm, lambda: machine.events[trigger].trigger(machine_fsm))
+    if machine_outcome == 'MachineError':
+        machine_outcome = InvalidTransitionError.__name__
+    assert outcome == machine_outcome
@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+from scheme_lexical_index import SchemeLexicalIndex
+
+SCHEMES_PATH = 'data/myschemes_scraped_combined.json'
+PMAY_SCHEMES = {'Pradhan Mantri Awaas Yojana - Gramin', 'Pradhan Mantri Awas Yojana - Urban'}
+
+
+@pytest.fixture(scope='module')
+def lexical_index():
+    return SchemeLexicalIndex(json.load(open(SCHEMES_PATH)))
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('Tell me about Sukanya Samriddhi Yojana', 'Sukanya Samriddhi Yojana'),
+    ('how do i open a sukanya samriddhi yojana account', 'Sukanya Samriddhi Yojana'),
+    ('Is SSY good for my daughter?', 'Sukanya Samriddhi Yojana'),
+    ('Tell me about PMAY-G', 'Pradhan Mantri Awaas Yojana - Gramin'),
+    ('PMAY - U eligibility', 'Pradhan Mantri Awas Yojana - Urban'),
+    ('I want to join APY', 'Atal Pension Yojana'),
+    ('What is DAY-NRLM', 'Deendayal Antyodaya Yojana - National Rural Livelihoods Mission'),
+])
+def test_named_scheme(lexical_index, query, expected):
+    assert lexical_index.find_named_scheme(query) == expected
+    assert lexical_index.name_coverage(expected, query) == 1
+
+
+@pytest.mark.parametrize('query', [
+    # short title of the transgender persons scheme
+    'I am a student and want scholarship for my degree',
+    'Tell me about the post matric scholarship',
+    # acronyms of Deendayal Antyodaya Yojana and National Apprenticeship Promotion Scheme
+    'I need help for one day',
+    'I want to take a nap',
+    # an acronym written in lowercase is a word
+    'ssy account',
+    # acronym of the rural and the urban scheme
+    'Tell me about PMAY',
+])
+def test_no_named_scheme(lexical_index, query):
+    assert lexical_index.find_named_scheme(query) is None
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('Tell me about PMAY', PMAY_SCHEMES),
+    ('Tell me about Sukanta Samriddhi', {'Sukanya Samriddhi Yojana'}),
+])
+def test_ranked_first_when_not_named(lexical_index, query, expected):
+    ranking = lexical_index.search(query, k=len(expected))
+    assert {scheme_name for scheme_name, _ in ranking} == expected
@@ -0,0 +1,117 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+
+from cachetools import LRUCache
+
+logger = logging.getLogger('jugalbandi_telegram')
+
+# lines and sentences are translated and remembered separately, the separators are kept as they are
+SEGMENT_SEPARATOR_REGEX = re.compile(r'(\n+|(?<=[.?!।])[ \t]+)')
+
+
+def get_text_hash(text) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def split_into_segments(text) -> list[str]:
+    """Returns segments at even and separators at odd positions, so that `''.join` gives back the text"""
+    return SEGMENT_SEPARATOR_REGEX.split(text)
+
+
+class TranslationMemory:
+    """
+    Memory of already translated texts keyed on (source language, target language, provider, text hash). Whole texts
+    and their sentences are remembered, so a templated response only sends the sentences never seen before to the
+    translation API. An in memory LRU is always used, translations can additionally be kept in the
+    `jugalbandi_translation_memory` table so that they are shared by all workers and survive restarts.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.entries = LRUCache(maxsize=maxsize) if maxsize > 0 else None
+        self.engine = None
+        self.background_tasks = set()
+        self.hits = 0
+        self.misses = 0
+
+    def enable_persistent_tier(self, engine):
+        self.engine = engine
+
+    async def lookup(self, source, dest, provider, text_hashes) -> dict:
+        found = {}
+        if self.entries is not None:
+            for text_hash in text_hashes:
+                translated_text = self.entries.get((source, dest, provider, text_hash))
+                if translated_text is not None:
+                    found[text_hash] = translated_text
+        missing = [text_hash for text_hash in text_hashes if text_hash not in found]
+        if missing and self.engine is not None:
+            from database import PostgresDatabase
+            try:
+                persisted = await PostgresDatabase(self.engine).get_translations(source, dest, provider, missing)
+            except Exception:
+                logger.exception('Failed to read the persistent translation memory')
+                persisted = {}
+            self.remember(source, dest, provider, persisted, persist=False)
+            found.update(persisted)
+        return found
+
+    def remember(self, source, dest, provider, translations: dict, persist=True):
+        if self.entries is not None:
+            for text_hash, translated_text in translations.items():
+                self.entries[(source, dest, provider, text_hash)] = translated_text
+        if persist and translations and self.engine is not None:
+            task = asyncio.create_task(self.store_persistently(source, dest, provider, translations))
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+
+    async def store_persistently(self, source, dest, provider, translations):
+        from database import PostgresDatabase
+        try:
+            await PostgresDatabase(self.engine).insert_translations(source, dest, provider, translations)
+        except Exception:
+            logger.exception('Failed to write the persistent translation memory')
+
+    async def stop(self):
+        """Waits for the persistent writes still running in background"""
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+
+    async def translate(self, text, source, dest, provider, translate_segments) -> str:
+        """
+        Translates `text` reusing remembered translations. `translate_segments(segments, source, dest)` is awaited
+        with the segments which are not known yet and has to return their translations in the same order.
+        """
+        text_hash = get_text_hash(text)
+        parts = split_into_segments(text)
+        segments = {get_text_hash(part): part for part in parts[::2] if part.strip()}
+        found = await self.lookup(source, dest, provider, [text_hash] + list(segments))
+        if text_hash in found:
+            self.hits += 1
+            return found[text_hash]
+
+        missing = [text_hash_ for text_hash_ in segments if text_hash_ not in found]
+        self.hits += len(segments) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            translated_segments = await translate_segments([segments[i] for i in missing], source, dest)
+            new_translations = dict(zip(missing, translated_segments))
+            found.update(new_translations)
+        else:
+            new_translations = {}
+
+        for i in range(0, len(parts), 2):
+            if parts[i].strip():
+                parts[i] = found[get_text_hash(parts[i])]
+        translated_text = ''.join(parts)
+        new_translations[text_hash] = translated_text
+        self.remember(source, dest, provider, new_translations)
+        return translated_text
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses,
+                'memory_entries': len(self.entries) if self.entries is not None else 0}
+
+
+translation_memory = TranslationMemory(maxsize=int(os.getenv('TRANSLATION_MEMORY_SIZE', 10000)))
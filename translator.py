@@ -1,38 +1,52 @@
+import asyncio
 import base64
-import json
-from io import BytesIO
+import os
 
-import requests
-from google.cloud import translate, speech
-from pydub import AudioSegment
+import aiohttp
+from google.cloud import translate, speech, texttospeech
 
+from audio_transcoding import ogg_to_wav
+from translation_memory import translation_memory
 
-class translator:
-    def __init__(self, mode="google", input_language='hi'):
-        self.mode = mode
-        self.input_language = input_language
+# HTTP session and google clients are created once per process and shared by all the requests
+http_session = None
+google_clients = {}
 
-    def get_wav_encoded_string(self, audio_data):
-        # Read the audio file from memory
-        given_audio = AudioSegment.from_file(audio_data, format="ogg")
-        given_audio = given_audio.set_frame_rate(16000)
-        given_audio = given_audio.set_channels(1)
 
-        # Export the audio file to WAV format in memory
-        wav_file = BytesIO()
-        given_audio.export(wav_file, format="wav", parameters=["-sample_fmt", "s16"])
+def get_http_session() -> aiohttp.ClientSession:
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(limit=int(os.getenv('TRANSLATOR_MAX_CONNECTIONS', 32)))
+        http_session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60))
+    return http_session
 
-        # Move the pointer to the start of the file
-        wav_file.seek(0)
 
-        # Read the WAV file from memory and encode string
-        wav_data = base64.b64encode(wav_file.read())
+def get_google_client(client_class):
+    if client_class not in google_clients:
+        google_clients[client_class] = client_class()
+    return google_clients[client_class]
 
-        # Encode the file. This is a requirement for bhashini.
-        encoded_string = str(wav_data, 'ascii', 'ignore')
-        return encoded_string, wav_file
 
-    def ai4b_s2t(self, encoded_string):
+async def close_translator_sessions():
+    global http_session
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+    # the grpc channels of the async clients are only closed through their transport
+    for client in google_clients.values():
+        await client.transport.close()
+    google_clients.clear()
+
+
+class translator:
+    # primary text to speech provider, google is only used as fallback
+    tts_provider = 'bhashini'
+
+    def __init__(self, mode="google", input_language='hi'):
+        self.mode = mode
+        self.input_language = input_language
+
+    async def ai4b_s2t(self, encoded_string):
         service_id = {'en': 'ai4bharat/whisper-medium-en--gpu--t4',
                       'hi': 'ai4bharat/conformer-multilingual-indo_aryan-gpu--t4',
                       'bn': 'ai4bharat/conformer-multilingual-indo_aryan-gpu--t4',
@@ -40,7 +54,6 @@ class translator:
                       'ta': 'ai4bharat/conformer-multilingual-dravidian-gpu--t4',
                       'pa': 'ai4bharat/conformer-multilingual-indo_aryan-gpu--t4'}
 
-        header = {"Content-Type", "application/json"}
         data = {"config": {"language": {"sourceLanguage": f"{self.input_language}"},
                            "transcriptionFormat": {"value": "transcript"},
                            "audioFormat": "wav",
@@ -52,86 +65,92 @@ class translator:
         # Bhashini Url
         api_url = "https://asr-api.ai4bharat.org/asr/v1/recognize/" + self.input_language
 
-        response = requests.post(api_url, data=json.dumps(data), timeout=60)
-        regional_lang_text = json.loads(response.text)["output"][0]["source"]
+        async with get_http_session().post(api_url, json=data) as response:
+            response_json = await response.json(content_type=None)
+        regional_lang_text = response_json["output"][0]["source"]
         return regional_lang_text
 
-    def ulca_s2t(self, encoded_string):
+    async def ulca_s2t(self, encoded_string):
         url = "https://meity-auth.ulcacontrib.org/ulca/apis/asr/v1/model/compute"
 
-        payload = json.dumps({
+        payload = {
             "modelId": "620fb9fc7c69fa1fc5bba7be",
             "task": "asr",
             "source": f"{self.input_language}",
             "userId": None,
             "audioContent": encoded_string
-        })
-        headers = {
-            'Content-Type': 'application/json'
         }
 
-        response = requests.request("POST", url, headers=headers, data=payload)
-        return response.json()
+        async with get_http_session().post(url, json=payload) as response:
+            return await response.json(content_type=None)
 
-    def google_s2t(self, wav_file):
-        client = speech.SpeechClient()
-        audio = speech.RecognitionAudio(content=wav_file.getvalue())
+    async def google_s2t(self, wav_data):
+        client = get_google_client(speech.SpeechAsyncClient)
+        audio = speech.RecognitionAudio(content=wav_data)
         config = speech.RecognitionConfig(
             encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
             sample_rate_hertz=16000,
             language_code=self.input_language + '-IN',
         )
 
-        response = client.recognize(config=config, audio=audio)
+        response = await client.recognize(config=config, audio=audio)
 
         # Each result is for a consecutive portion of the audio. Iterate through
         # them to get the transcripts for the entire audio file.
         return response.results[0].alternatives[0].transcript
 
-    def google_translate_text(self, text, source, dest, project_id="indian-legal-bert"):
+    async def google_translate_text(self, text, source, dest, project_id="indian-legal-bert"):
+        translated_texts = await self.google_translate_texts([text], source, dest, project_id=project_id)
+        return translated_texts[0]
+
+    async def google_translate_texts(self, texts, source, dest, project_id="indian-legal-bert"):
 
-        client = translate.TranslationServiceClient()
+        client = get_google_client(translate.TranslationServiceAsyncClient)
         location = "global"
         parent = f"projects/{project_id}/locations/{location}"
-        response = client.translate_text(
+        response = await client.translate_text(
             request={
                 "parent": parent,
-                "contents": [text],
+                "contents": texts,
                 "mime_type": "text/plain",
                 "source_language_code": source,
                 "target_language_code": dest,
             }
         )
 
-        return response.translations[0].translated_text
+        return [i.translated_text for i in response.translations]
 
-    def indicTrans(self, text, source, dest):
-        """
-        This function converts
-        """
+    async def bhashini_translate_text(self, text, source, dest):
+        data = {
+            "source_language": source,
+            "target_language": dest,
+            "text": text
+        }
+        api_url = "https://nmt-api.ai4bharat.org/translate_sentence"
+        async with get_http_session().post(api_url, json=data) as response:
+            indicText = await response.json(content_type=None)
+        return indicText['text']
+
+    async def translate_segments(self, segments, source, dest):
         if self.mode == 'google':
-            indicText = text if source == dest else self.google_translate_text(text, source, dest)
-            indicText = {'text': indicText}
-            service_name = 'google'
+            return await self.google_translate_texts(segments, source, dest)
         else:
-            service_name = 'bhashini'
-            header = {"Content-Type", "application/json"}
-            data = {
-                "source_language": source,
-                "target_language": dest,
-                "text": text
-            }
-            api_url = "https://nmt-api.ai4bharat.org/translate_sentence"
-            response = requests.post(api_url, data=json.dumps(data), timeout=60)
-            indicText = json.loads(response.text)
+            return await asyncio.gather(*[self.bhashini_translate_text(i, source, dest) for i in segments])
 
-        return indicText['text'], service_name
+    async def indicTrans(self, text, source, dest):
+        """
+        This function converts the text from source to dest language, already known sentences are taken from the
+        translation memory
+        """
+        service_name = 'google' if self.mode == 'google' else 'bhashini'
+        if self.mode == 'google' and source == dest:
+            return text, service_name
+        indicText = await translation_memory.translate(text, source, dest, service_name, self.translate_segments)
+        return indicText, service_name
 
-    def google_text_to_speech(self, text, language):
+    async def google_text_to_speech(self, text, language):
         """Synthesizes speech from the input string of text."""
-        from google.cloud import texttospeech
-
-        client = texttospeech.TextToSpeechClient()
+        client = get_google_client(texttospeech.TextToSpeechAsyncClient)
 
         input_text = texttospeech.SynthesisInput(text=text)
 
@@ -146,35 +165,36 @@ class translator:
             audio_encoding=texttospeech.AudioEncoding.MP3
         )
 
-        response = client.synthesize_speech(
+        response = await client.synthesize_speech(
             request={"input": input_text, "voice": voice, "audio_config": audio_config}
         )
         return response.audio_content
 
-    def audioInput2text(self, audio_data):
+    async def audioInput2text(self, audio_data):
 
-        # uses audio data and converts it into encoded string
-        encoded_string, wav_file = self.get_wav_encoded_string(audio_data)
+        # ogg audio is converted to 16 kHz mono wav, the encoded string is a requirement for bhashini
+        wav_data = await ogg_to_wav(audio_data)
+        encoded_string = base64.b64encode(wav_data).decode('ascii')
 
         # Speech2Text
         if self.mode == "AI4B" or self.mode == 'google':
             api_name = "bhashini"
-            indicText = self.ai4b_s2t(encoded_string)
+            indicText = await self.ai4b_s2t(encoded_string)
             if indicText is None:
                 api_name = "google"
-                indicText = self.google_s2t(wav_file)
+                indicText = await self.google_s2t(wav_data)
         # elif self.mode == 'google':
         #     api_name = "google"
         #     indicText = self.google_s2t(wav_file)
         else:
             api_name = "bhashini"
-            indicText = self.ulca_s2t(encoded_string)
+            indicText = await self.ulca_s2t(encoded_string)
 
         # Translation to English
         # en_input, _ = self.indicTrans(text=indicText, source=self.input_language, dest='en')
         return indicText, api_name
 
-    def text2speech(self, language, text, gender='female'):
+    async def text2speech(self, language, text, gender='female'):
         service_id = {'en': 'ai4bharat/indic-tts-coqui-misc-gpu--t4',
                       'hi': 'ai4bharat/indic-tts-coqui-indo_aryan-gpu--t4',
                       'bn': 'ai4bharat/indic-tts-coqui-indo_aryan-gpu--t4',
@@ -187,16 +207,25 @@ class translator:
                 # Bhashini api
                 api_url = "https://tts-api.ai4bharat.org/"
 
-                header = {"Content-Type", "application/json"}
                 payload = {"input": [{"source": text}],
                            "config": {"gender": gender, "language": {"sourceLanguage": language}}}
-                response = requests.post(api_url, json=payload, timeout=60)
-                audio_content = response.json()['audio'][0]['audioContent']
+                async with get_http_session().post(api_url, json=payload) as response:
+                    response_json = await response.json(content_type=None)
+                audio_content = response_json['audio'][0]['audioContent']
                 audio_content = base64.b64decode(audio_content)
-                audio_content = BytesIO(audio_content)
-            except:
-                audio_content = self.google_text_to_speech(text, language)
+            except Exception:
+                audio_content = await self.google_text_to_speech(text, language)
                 is_google = True
-        except:
+        except Exception:
             audio_content = False
         return audio_content, is_google
+
+
+translators = {}
+
+
+def get_translator(input_language, mode='google') -> translator:
+    """Translator objects are stateless apart from language and mode, one is shared per combination"""
+    if (mode, input_language) not in translators:
+        translators[(mode, input_language)] = translator(mode=mode, input_language=input_language)
+    return translators[(mode, input_language)]
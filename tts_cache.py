@@ -0,0 +1,82 @@
+import hashlib
+import logging
+import os
+from dataclasses import dataclass
+
+from cachetools import LRUCache
+
+logger = logging.getLogger('jugalbandi_telegram')
+
+TTS_MEDIA_FOLDER = 'tts_cache'
+
+
+@dataclass(frozen=True)
+class CachedSpeech:
+    audio_url: str
+    tts_service_name: str
+    audio: bytes = None
+
+
+class TTSCache:
+    """
+    Content addressed cache of synthesized responses. The key is the hash of (language, gender, provider, text), the
+    encoded mp3 is uploaded once under that key and its public url is returned for every repeated response, without
+    doing TTS, encoding or upload again. Audio and url are kept in an in memory LRU, the url can additionally be kept in
+    the `jugalbandi_tts_cache` table so that it is shared by all workers and survives restarts.
+    """
+
+    def __init__(self, maxsize=256):
+        self.entries = LRUCache(maxsize=maxsize) if maxsize > 0 else None
+        self.engine = None
+        self.hits = 0
+        self.misses = 0
+
+    def enable_persistent_tier(self, engine):
+        self.engine = engine
+
+    @staticmethod
+    def make_key(language, gender, provider, text) -> str:
+        return hashlib.sha256('\x1f'.join([language, gender, provider, text]).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_remote_filename(cache_key) -> str:
+        return cache_key + '.mp3'
+
+    async def get(self, cache_key):
+        cached_speech = self.entries.get(cache_key) if self.entries is not None else None
+        if cached_speech is None and self.engine is not None:
+            from database import PostgresDatabase
+            try:
+                result = await PostgresDatabase(self.engine).get_tts_audio(cache_key)
+            except Exception:
+                logger.exception('Failed to read the persistent TTS cache')
+                result = None
+            if result is not None:
+                cached_speech = CachedSpeech(audio_url=result['audio_url'],
+                                             tts_service_name=result['tts_service_name'])
+                if self.entries is not None:
+                    self.entries[cache_key] = cached_speech
+        if cached_speech is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return cached_speech
+
+    async def set(self, cache_key, audio_url, tts_service_name, audio=None):
+        cached_speech = CachedSpeech(audio_url=audio_url, tts_service_name=tts_service_name, audio=audio)
+        if self.entries is not None:
+            self.entries[cache_key] = cached_speech
+        if self.engine is not None:
+            from database import PostgresDatabase
+            try:
+                await PostgresDatabase(self.engine).insert_tts_audio(cache_key, audio_url, tts_service_name)
+            except Exception:
+                logger.exception('Failed to write the persistent TTS cache')
+        return cached_speech
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses,
+                'memory_entries': len(self.entries) if self.entries is not None else 0}
+
+
+tts_cache = TTSCache(maxsize=int(os.getenv('TTS_CACHE_SIZE', 256)))
@@ -0,0 +1,61 @@
+import os
+from dataclasses import dataclass, replace
+
+from cachetools import TTLCache
+
+from database import build_prompts_v1
+from prompt_budget import prompt_budget
+
+
+@dataclass(frozen=True)
+class UserContext:
+    chat_id: int
+    language_preference: str
+    bot_preference: str = None
+    conversation_chunk_id: str = None
+    scheme_name: str = None
+    conversation_summary: str = None
+    rolling_summary: str = None
+    prompt_type: str = None
+
+    def prompts_v1(self):
+        """Same as `PostgresDatabase.get_prompts_v1` but without a database round trip"""
+        return build_prompts_v1({'conversation_chunk_id': self.conversation_chunk_id,
+                                 'scheme_name': self.scheme_name,
+                                 'conversation_summary': self.conversation_summary,
+                                 'rolling_summary': self.rolling_summary,
+                                 'prompt_type': self.prompt_type})
+
+
+class UserContextLoader:
+    """
+    Loads everything `chatbot_flow` needs to know about the user before answering, with a single query. Contexts can
+    optionally be kept for `ttl` seconds per chat_id, they are updated after every chat turn of this worker and have to
+    be invalidated whenever language preference or memory of the user are changed.
+    """
+
+    def __init__(self, maxsize=10000, ttl=0):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl) if ttl > 0 else None
+
+    async def load(self, db_object, chat_id) -> UserContext:
+        if self.entries is not None and chat_id in self.entries:
+            return self.entries[chat_id]
+        result = await db_object.get_user_context(chat_id=chat_id, history_turns=prompt_budget.max_history_turns)
+        if result is None:
+            raise ValueError(f'User with chat_id {chat_id} is not registered')
+        user_context = UserContext(chat_id=chat_id, **dict(result))
+        if self.entries is not None:
+            self.entries[chat_id] = user_context
+        return user_context
+
+    def update(self, chat_id, **changes):
+        if self.entries is not None and chat_id in self.entries:
+            self.entries[chat_id] = replace(self.entries[chat_id], **changes)
+
+    def invalidate(self, chat_id):
+        if self.entries is not None:
+            self.entries.pop(chat_id, None)
+
+
+user_context_loader = UserContextLoader(maxsize=int(os.getenv('USER_CONTEXT_CACHE_SIZE', 10000)),
+                                        ttl=float(os.getenv('USER_CONTEXT_CACHE_TTL', 0)))